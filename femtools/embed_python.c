@@ -35,6 +35,465 @@ USA
 #ifdef HAVE_NUMPY
 #include "numpy/arrayobject.h"
 #endif
+#ifdef HAVE_MPI
+#include <mpi.h>
+#endif
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/time.h>
+#include <sys/wait.h>
+
+#ifdef HAVE_PYTHON
+// Each distinct piece of user code is executed once, and the namespace it
+// creates is kept and reused by later calls with the same code. The code
+// string itself is the key, so any change to it is a different entry. Each
+// entry is labelled, in the statistics, by the label set when it was first
+// seen, if any.
+typedef struct {
+  PyObject *pSource;
+  PyObject *pLocals;
+  char *label;
+  long calls;
+  double seconds;
+} user_code;
+
+static PyObject *pUserCodeIndex = NULL;
+static user_code *user_codes = NULL;
+static int user_code_count = 0;
+static user_code *current_user_code = NULL;
+static double current_user_code_start;
+
+// The label, such as an option path, of the user code in the next call, set
+// with python_function_label_c.
+static char *next_user_code_label = NULL;
+
+// Force a garbage collection after every this many calls; 0 never forces one.
+// Set with the FLUIDITY_PYTHON_GC_INTERVAL environment variable.
+static long gc_interval = -1;
+static long gc_calls = 0;
+
+static double seconds_now(void)
+{
+  struct timeval tv;
+
+  gettimeofday(&tv, NULL);
+  return tv.tv_sec + 1.0e-6 * tv.tv_usec;
+}
+
+// Return a new reference to the namespace created by executing the user's
+// code, executing it only if it has not been seen before. Returns NULL with
+// the Python error set if executing the code fails.
+static PyObject *user_namespace(char *function)
+{
+  PyObject *pSource, *pIndex, *pGlobals, *pLocals, *pCode;
+  user_code *codes;
+  char *label;
+
+  current_user_code=NULL;
+  current_user_code_start=seconds_now();
+
+  // The label applies to this call only.
+  label=next_user_code_label;
+  next_user_code_label=NULL;
+
+  if (pUserCodeIndex == NULL){
+    pUserCodeIndex=PyDict_New();
+    if (pUserCodeIndex == NULL){
+      free(label);
+      return NULL;
+    }
+  }
+
+  pIndex=PyDict_GetItemString(pUserCodeIndex, function);
+  if (pIndex != NULL){
+    free(label);
+    current_user_code=&user_codes[PyInt_AsLong(pIndex)];
+    current_user_code->calls++;
+    Py_INCREF(current_user_code->pLocals);
+    return current_user_code->pLocals;
+  }
+
+  // Execute the user's code in a fresh local namespace.
+  pGlobals=PyModule_GetDict(PyImport_AddModule("__main__"));
+  pLocals=PyDict_New();
+  pCode=PyRun_String(function, Py_file_input, pGlobals, pLocals);
+  if (pCode == NULL){
+    free(label);
+    Py_DECREF(pLocals);
+    return NULL;
+  }
+  Py_DECREF(pCode);
+
+  codes=realloc(user_codes, (user_code_count + 1) * sizeof(user_code));
+  if (codes == NULL){
+    free(label);
+    Py_DECREF(pLocals);
+    PyErr_NoMemory();
+    return NULL;
+  }
+  user_codes=codes;
+
+  pSource=PyString_FromString(function);
+  pIndex=PyInt_FromLong(user_code_count);
+  PyDict_SetItem(pUserCodeIndex, pSource, pIndex);
+  Py_DECREF(pIndex);
+
+  current_user_code=&user_codes[user_code_count++];
+  current_user_code->pSource=pSource;
+  current_user_code->pLocals=pLocals;
+  current_user_code->label=label;
+  current_user_code->calls=1;
+  current_user_code->seconds=0.0;
+
+  // One reference is kept by the cache, the other is returned.
+  Py_INCREF(pLocals);
+  return pLocals;
+}
+
+// Record the time spent in the call to the user's code that has just
+// finished, and force a garbage collection if one is due.
+static void user_code_done(void)
+{
+  char *interval;
+
+  if (current_user_code != NULL){
+    current_user_code->seconds+=seconds_now() - current_user_code_start;
+    current_user_code=NULL;
+  }
+
+  if (gc_interval < 0){
+    interval=getenv("FLUIDITY_PYTHON_GC_INTERVAL");
+    gc_interval=interval == NULL ? 1 : atol(interval);
+    if (gc_interval < 0)
+      gc_interval=0;
+  }
+
+  if (gc_interval > 0 && ++gc_calls >= gc_interval){
+    PyGC_Collect();
+    gc_calls=0;
+  }
+}
+
+// Finish a failed call of the user's code: print any Python error, release
+// the namespace pLocals, which may be NULL, record the call and set stat.
+static void user_code_failed(PyObject *pLocals, int *stat)
+{
+  if (PyErr_Occurred())
+    PyErr_Print();
+  Py_XDECREF(pLocals);
+  user_code_done();
+  *stat=1;
+}
+
+// Set in forked worker processes, which never fork workers of their own.
+static int in_worker = 0;
+
+// Whether this is one of several MPI processes. Forking an MPI process is
+// unsupported by many MPI transports, such as InfiniBand and shared memory, so
+// workers are then never forked.
+static int in_parallel_run(void)
+{
+#ifdef HAVE_MPI
+  int initialised, finalised, size;
+
+  if (MPI_Initialized(&initialised) != MPI_SUCCESS || !initialised)
+    return 0;
+  if (MPI_Finalized(&finalised) != MPI_SUCCESS || finalised)
+    return 0;
+  if (MPI_Comm_size(MPI_COMM_WORLD, &size) != MPI_SUCCESS)
+    return 1;
+  return size > 1;
+#else
+  return 0;
+#endif
+}
+
+// Return the number of processes to evaluate the per-node function pFunc for
+// nodes nodes in, from its processes attribute: 0 means one per online
+// processor. Returns 1 if it should just be evaluated in this process, which
+// it always is in a parallel run.
+static int worker_processes(PyObject *pFunc, int nodes)
+{
+  static int warned = 0;
+  PyObject *pProcesses;
+  long processes;
+
+  if (in_worker || pFunc == NULL)
+    return 1;
+
+  pProcesses=PyObject_GetAttrString(pFunc, "processes");
+  if (pProcesses == NULL){
+    PyErr_Clear();
+    return 1;
+  }
+  processes=PyInt_AsLong(pProcesses);
+  Py_DECREF(pProcesses);
+  if (PyErr_Occurred()){
+    PyErr_Clear();
+    return 1;
+  }
+
+  if (processes == 0)
+    processes=sysconf(_SC_NPROCESSORS_ONLN);
+  if (processes > nodes)
+    processes=nodes;
+  if (processes <= 1)
+    return 1;
+
+  if (in_parallel_run()){
+    if (!warned){
+      fprintf(stderr, "Warning: ignoring the processes attribute of a Python function in a parallel run, which cannot fork worker processes\n");
+      fflush(stderr);
+      warned=1;
+    }
+    return 1;
+  }
+
+  return (int) processes;
+}
+
+// Return an array of n doubles shared with forked worker processes, to be
+// released with munmap, or NULL on failure.
+static double *shared_doubles(size_t n)
+{
+  void *shared;
+
+  shared=mmap(NULL, n * sizeof(double), PROT_READ | PROT_WRITE,
+              MAP_SHARED | MAP_ANON, -1, 0);
+  if (shared == MAP_FAILED){
+    perror("Error: mmap failed");
+    return NULL;
+  }
+  return (double *) shared;
+}
+
+// Fork processes worker processes to evaluate nodes nodes in contiguous
+// chunks. In each worker this returns 1, with *start and *count set to its
+// chunk, and the worker must then finish with worker_exit. In the calling
+// process it waits for all the workers, and returns 0 if they all succeeded or
+// -1 otherwise.
+static int fork_workers(int processes, int nodes, int *start, int *count)
+{
+  pid_t *pids;
+  int i, forked, status, failed=0;
+
+  pids=malloc(processes * sizeof(pid_t));
+  if (pids == NULL)
+    return -1;
+
+  // Flush any pending output so that the workers do not repeat it.
+  fflush(stdout);
+  fflush(stderr);
+
+  for (forked = 0; forked < processes; forked++){
+    pids[forked]=fork();
+    if (pids[forked] == 0){
+      free(pids);
+      in_worker=1;
+      *start=(int) ((long) nodes * forked / processes);
+      *count=(int) ((long) nodes * (forked + 1) / processes) - *start;
+      return 1;
+    }
+    if (pids[forked] < 0){
+      perror("Error: fork failed");
+      failed=1;
+      break;
+    }
+  }
+
+  for (i = 0; i < forked; i++){
+    if (waitpid(pids[i], &status, 0) < 0 || !WIFEXITED(status) ||
+        WEXITSTATUS(status) != 0)
+      failed=1;
+  }
+  free(pids);
+
+  return failed ? -1 : 0;
+}
+
+// Finish a worker process, reporting stat to the process that forked it.
+static void worker_exit(int stat)
+{
+  fflush(stdout);
+  fflush(stderr);
+  _exit(stat == 0 ? 0 : 1);
+}
+#endif
+
+#define python_function_label_c F77_FUNC(python_function_label_c, PYTHON_FUNCTION_LABEL_C)
+void python_function_label_c(char *label, int *label_len)
+{
+  // Label the Python code evaluated by the next call, such as with the option
+  // path it was read from. The label is used in the statistics if that code
+  // has not been evaluated before.
+#ifdef HAVE_PYTHON
+  free(next_user_code_label);
+  next_user_code_label=malloc(*label_len + 1);
+  if (next_user_code_label != NULL){
+    memcpy(next_user_code_label, label, *label_len);
+    next_user_code_label[*label_len]='\0';
+  }
+#endif
+}
+
+#define python_function_count_c F77_FUNC(python_function_count_c, PYTHON_FUNCTION_COUNT_C)
+void python_function_count_c(int *count)
+{
+  // The number of distinct pieces of Python code evaluated so far.
+#ifdef HAVE_PYTHON
+  *count=user_code_count;
+#else
+  *count=0;
+#endif
+}
+
+#define python_function_statistics_c F77_FUNC(python_function_statistics_c, PYTHON_FUNCTION_STATISTICS_C)
+void python_function_statistics_c(int *index, int *calls, double *seconds,
+                                  char *label, int *label_len)
+{
+  // Return the number of calls of, and time spent in, the index'th (counting
+  // from 1) piece of Python code evaluated, together with a label for it in
+  // the *label_len characters of label. On return *label_len is the length
+  // of the label.
+#ifdef HAVE_PYTHON
+  char *source, *def;
+  int i, j;
+
+  i=*index-1;
+  *calls=(int) user_codes[i].calls;
+  *seconds=user_codes[i].seconds;
+
+  // Label each piece of code by the label it was first evaluated with, or
+  // otherwise by its first function definition.
+  if (user_codes[i].label != NULL){
+    source=user_codes[i].label;
+  }
+  else{
+    source=PyString_AsString(user_codes[i].pSource);
+    def=strstr(source, "def ");
+    if (def != NULL)
+      source=def;
+  }
+  for (j = 0; j < *label_len && source[j] != '\0' && source[j] != '\n'; j++)
+    label[j]=source[j];
+  *label_len=j;
+#else
+  *calls=0;
+  *seconds=0.0;
+  *label_len=0;
+#endif
+}
+
+#ifdef HAVE_NUMPY
+// Return a borrowed reference to the vectorised form of the user's function
+// in pLocals: val_array, or val if it has a true vectorised attribute. Returns
+// NULL if there is none.
+static PyObject *vectorised_function(PyObject *pLocals)
+{
+  PyObject *pFunc, *pFlag;
+  int vectorised;
+
+  pFunc=PyDict_GetItemString(pLocals, "val_array");
+  if (pFunc != NULL)
+    return pFunc;
+
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL)
+    return NULL;
+
+  pFlag=PyObject_GetAttrString(pFunc, "vectorised");
+  if (pFlag == NULL){
+    PyErr_Clear();
+    return NULL;
+  }
+  vectorised=PyObject_IsTrue(pFlag);
+  Py_DECREF(pFlag);
+  if (vectorised != 1){
+    PyErr_Clear();
+    return NULL;
+  }
+
+  return pFunc;
+}
+
+// Call the vectorised function pFunc with the positions of all nodes as a
+// read-only (nodes, dim) array, and the time. The positions array wraps the
+// Fortran coordinate buffers if they are contiguous, and is otherwise a copy.
+// Returns a new reference to the result as a contiguous array of doubles with
+// nd dimensions, the first of which is checked to be nodes, or NULL on error.
+static PyArrayObject *call_vectorised_function(PyObject *pFunc, int dim,
+                                               int nodes, double x[],
+                                               double y[], double z[],
+                                               double t, int nd)
+{
+  PyObject *pPos, *pComponents, *pResult;
+  PyArrayObject *pArray;
+  double *components[3];
+  npy_intp dims[2];
+  int i, j, contiguous;
+
+  if (PyArray_API == NULL && _import_array() < 0)
+    return NULL;
+
+  components[0]=x;
+  components[1]=y;
+  components[2]=z;
+  contiguous=1;
+  for (j = 1; j < dim; j++){
+    if (components[j] != x + j * nodes)
+      contiguous=0;
+  }
+
+  if (contiguous){
+    // A (dim, nodes) view of the coordinates, transposed.
+    dims[0]=dim;
+    dims[1]=nodes;
+    pComponents=PyArray_SimpleNewFromData(2, dims, PyArray_DOUBLE, x);
+    if (pComponents == NULL)
+      return NULL;
+    pPos=PyArray_Transpose((PyArrayObject *)pComponents, NULL);
+    Py_DECREF(pComponents);
+    if (pPos == NULL)
+      return NULL;
+  }
+  else{
+    dims[0]=nodes;
+    dims[1]=dim;
+    pPos=PyArray_SimpleNew(2, dims, PyArray_DOUBLE);
+    if (pPos == NULL)
+      return NULL;
+    for (i = 0; i < nodes; i++){
+      for (j = 0; j < dim; j++){
+        ((double *)((PyArrayObject *)pPos)->data)[i * dim + j]=components[j][i];
+      }
+    }
+  }
+  // The user's function must not write to the coordinates.
+  ((PyArrayObject *)pPos)->flags &= ~NPY_WRITEABLE;
+
+  pResult=PyObject_CallFunction(pFunc, "Od", pPos, t);
+  Py_DECREF(pPos);
+  if (pResult == NULL)
+    return NULL;
+
+  pArray=(PyArrayObject *)PyArray_ContiguousFromObject(pResult, PyArray_DOUBLE, nd, nd);
+  Py_DECREF(pResult);
+  if (pArray == NULL)
+    return NULL;
+
+  if (pArray->dimensions[0] != nodes){
+    PyErr_Format(PyExc_ValueError,
+                 "vectorised function returned values for %d nodes, but the field has %d",
+                 (int) pArray->dimensions[0], nodes);
+    Py_DECREF(pArray);
+    return NULL;
+  }
+
+  return pArray;
+}
+#endif
 
 #define set_scalar_field_from_python F77_FUNC(set_scalar_field_from_python, SET_SCALAR_FIELD_FROM_PYTHON)
 void set_scalar_field_from_python(char *function, int *function_len, int *dim, 
@@ -54,11 +513,17 @@ void set_scalar_field_from_python(char *function, int *function_len, int *dim,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pPos, *px, *pT;
   
   char *function_c;
   int i;
+  int processes, worker, start, count;
+  double *shared;
+#ifdef HAVE_NUMPY
+  PyObject *pVecFunc;
+  PyArrayObject *pArray;
+#endif
   
   // the function string passed down from Fortran needs terminating,
   // so make a copy and fiddle with it (remember to free it)
@@ -66,31 +531,74 @@ void set_scalar_field_from_python(char *function, int *function_len, int *dim,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
 
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
 
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
+  // Clean up memory from null termination.
+  free(function_c);
   
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
+  // Check for errors in executing user code.
+  if (PyErr_Occurred()){
+    user_code_failed(pLocals, stat);
+    return;
+  }
+
+#ifdef HAVE_NUMPY
+  // If the user's code defines a vectorised function, evaluate it for all
+  // nodes at once.
+  pVecFunc=vectorised_function(pLocals);
+  if (pVecFunc != NULL){
+    pArray=call_vectorised_function(pVecFunc, *dim, *nodes, x, y, z, *t, 1);
+    if (pArray == NULL){
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    memcpy(result, pArray->data, *nodes * sizeof(double));
+    Py_DECREF(pArray);
+    Py_DECREF(pLocals);
+
+    // Record the call, and force a garbage collection if one is due
+    user_code_done();
+
+    *stat=0;
+    return;
+  }
+#endif
 
   // Extract the function from the code.
   pFunc=PyDict_GetItemString(pLocals, "val");
   if (pFunc == NULL) {
       printf("Couldn't find a 'val' function in your Python code.\n");
-      *stat=1;
+      user_code_failed(pLocals, stat);
       return;
   }
 
-  // Clean up memory from null termination.
-  free(function_c);
-  
-  // Check for errors in executing user code.
-  if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+  // If the user's function asks for it, evaluate it for chunks of the nodes
+  // in parallel worker processes, which write into shared memory.
+  processes=worker_processes(pFunc, *nodes);
+  if (processes > 1){
+    shared=shared_doubles(*nodes);
+    if (shared == NULL){
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    worker=fork_workers(processes, *nodes, &start, &count);
+    if (worker == 1){
+      set_scalar_field_from_python(function, function_len, dim, &count,
+                                   x + start, y + start, z + start, t,
+                                   shared + start, stat);
+      worker_exit(*stat);
+    }
+    if (worker == 0)
+      memcpy(result, shared, *nodes * sizeof(double));
+    munmap(shared, *nodes * sizeof(double));
+    Py_DECREF(pLocals);
+
+    // Record the call, and force a garbage collection if one is due
+    user_code_done();
+
+    *stat=worker == 0 ? 0 : 1;
     return;
   }
 
@@ -107,8 +615,8 @@ void set_scalar_field_from_python(char *function, int *function_len, int *dim,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -130,8 +638,9 @@ void set_scalar_field_from_python(char *function, int *function_len, int *dim,
     
     // Check for a Python error in the function call
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -139,8 +648,9 @@ void set_scalar_field_from_python(char *function, int *function_len, int *dim,
 
     // Check for a Python error in result.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -150,10 +660,9 @@ void set_scalar_field_from_python(char *function, int *function_len, int *dim,
   // Clean up
     Py_DECREF(pArgs);  
     Py_DECREF(pLocals);  
-    Py_DECREF(pCode);  
 
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
 
 
   *stat=0;
@@ -178,7 +687,7 @@ void set_integer_array_from_python(char* function, int* function_len, int* dim,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pPos, *px, *pT;
   
   char *function_c;
@@ -190,29 +699,27 @@ void set_integer_array_from_python(char* function, int* function_len, int* dim,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
 
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
 
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
 
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
 
@@ -226,8 +733,8 @@ void set_integer_array_from_python(char* function, int* function_len, int* dim,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -249,8 +756,9 @@ void set_integer_array_from_python(char* function, int* function_len, int* dim,
     
     // Check for a Python error in the function call
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -258,8 +766,9 @@ void set_integer_array_from_python(char* function, int* function_len, int* dim,
 
     // Check for a Python error in result.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -269,10 +778,9 @@ void set_integer_array_from_python(char* function, int* function_len, int* dim,
   // Clean up
     Py_DECREF(pArgs);  
     Py_DECREF(pLocals);  
-    Py_DECREF(pCode);  
 
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
 
 
   *stat=0;
@@ -299,10 +807,16 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pPos, *px, *pT;
   char *function_c;
   int i;
+  int processes, worker, start, count;
+  double *shared;
+#ifdef HAVE_NUMPY
+  PyObject *pVecFunc;
+  PyArrayObject *pArray;
+#endif
   
   // the function string passed down from Fortran needs terminating,
   // so make a copy and fiddle with it (remember to free it)
@@ -310,28 +824,100 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
   
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-  
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
   
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
+    return;
+  }
+
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+
+#ifdef HAVE_NUMPY
+  // If the user's code defines a vectorised function, evaluate it for all
+  // nodes at once.
+  pVecFunc=vectorised_function(pLocals);
+  if (pVecFunc != NULL){
+    pArray=call_vectorised_function(pVecFunc, *dim, *nodes, x, y, z, *t, 2);
+    if (pArray == NULL){
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    if (pArray->dimensions[1] != *result_dim){
+      fprintf(stderr, "Error: dimension of array returned from python (%d) does not match the allocated dimension of the vector field (%d).\n",
+              (int) pArray->dimensions[1], *result_dim);
+      Py_DECREF(pArray);
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    for (i = 0; i < *nodes; i++){
+      result_x[i]=((double *)pArray->data)[i * *result_dim];
+      if (*result_dim>1) {
+        result_y[i]=((double *)pArray->data)[i * *result_dim + 1];
+        if (*result_dim>2) {
+          result_z[i]=((double *)pArray->data)[i * *result_dim + 2];
+        }
+      }
+    }
+    Py_DECREF(pArray);
+    Py_DECREF(pLocals);
+
+    // Record the call, and force a garbage collection if one is due
+    user_code_done();
+
+    *stat=0;
     return;
   }
+#endif
+
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
   
+  // If the user's function asks for it, evaluate it for chunks of the nodes
+  // in parallel worker processes, which write into shared memory.
+  processes=worker_processes(pFunc, *nodes);
+  if (processes > 1){
+    shared=shared_doubles(3 * *nodes);
+    if (shared == NULL){
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    worker=fork_workers(processes, *nodes, &start, &count);
+    if (worker == 1){
+      set_vector_field_from_python(function, function_len, dim, &count,
+                                   x + start, y + start, z + start, t,
+                                   result_dim, shared + start,
+                                   shared + *nodes + start,
+                                   shared + 2 * *nodes + start, stat);
+      worker_exit(*stat);
+    }
+    if (worker == 0){
+      memcpy(result_x, shared, *nodes * sizeof(double));
+      if (*result_dim > 1)
+        memcpy(result_y, shared + *nodes, *nodes * sizeof(double));
+      if (*result_dim > 2)
+        memcpy(result_z, shared + 2 * *nodes, *nodes * sizeof(double));
+    }
+    munmap(shared, 3 * *nodes * sizeof(double));
+    Py_DECREF(pLocals);
+
+    // Record the call, and force a garbage collection if one is due
+    user_code_done();
+
+    *stat=worker == 0 ? 0 : 1;
+    return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
   
@@ -345,8 +931,8 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
   
@@ -367,8 +953,9 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
     pResult=PyObject_CallObject(pFunc, pArgs);
     // Check for a Python error in the function call
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -376,7 +963,9 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
     {
       fprintf(stderr, "Error: length of object returned from python (%d) does not match the allocated dimension of the vector field (%d).\n",
               (int) PyObject_Length(pResult), *result_dim);
-      *stat = 1;
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -386,8 +975,10 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
     result_x[i]=PyFloat_AsDouble(px);
     // Check for a Python error in unpacking tuple.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(px);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     Py_DECREF(px);
@@ -397,7 +988,10 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
       result_y[i]=PyFloat_AsDouble(px);  
       // Check for a Python error in unpacking tuple.  
       if (PyErr_Occurred()){  
-         PyErr_Print();  
+         Py_XDECREF(px);
+         Py_DECREF(pResult);
+         Py_DECREF(pArgs);
+         user_code_failed(pLocals, stat);
          return;  
       }  
       
@@ -407,7 +1001,10 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
         result_z[i]=PyFloat_AsDouble(px);  
       // Check for a Python error in unpacking tuple.  
        if (PyErr_Occurred()){  
-          PyErr_Print();  
+          Py_XDECREF(px);
+          Py_DECREF(pResult);
+          Py_DECREF(pArgs);
+          user_code_failed(pLocals, stat);
           return;  
        }  
         Py_DECREF(px);  
@@ -420,10 +1017,9 @@ void set_vector_field_from_python(char *function, int *function_len, int *dim,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
   
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
   
   *stat=0;
   return;
@@ -448,11 +1044,14 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pPos, *px, *pT;
   PyArrayObject *pArray;
+  PyObject *pVecFunc;
   char *function_c;
   int i, ii, jj;
+  int processes, worker, start, count;
+  double *shared;
 
   import_array()
   
@@ -462,28 +1061,96 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
   
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-  
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
   
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
+    return;
+  }
+
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+
+#ifdef HAVE_NUMPY
+  // If the user's code defines a vectorised function, evaluate it for all
+  // nodes at once.
+  pVecFunc=vectorised_function(pLocals);
+  if (pVecFunc != NULL){
+    pArray=call_vectorised_function(pVecFunc, *dim, *nodes, x, y, z, *t, 3);
+    if (pArray == NULL){
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    if (pArray->dimensions[1] != result_dim[0] || pArray->dimensions[2] != result_dim[1]){
+      fprintf(stderr, "Error: dimensions of array returned from python ([%d, %d]) do not match allocated dimensions of the tensor_field ([%d, %d])).\n", 
+             (int) pArray->dimensions[1], (int) pArray->dimensions[2], result_dim[0], result_dim[1]);
+      Py_DECREF(pArray);
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    for (i = 0; i < *nodes; i++){
+      for (ii = 0; ii < result_dim[0]; ii++){
+        for (jj = 0; jj < result_dim[1]; jj++){
+          // Note the transpose for fortran.
+          result[i*(result_dim[0] * result_dim[1]) + jj * result_dim[0] + ii] =
+            ((double *)pArray->data)[i*(result_dim[0] * result_dim[1]) + ii * result_dim[1] + jj];
+        }
+      }
+    }
+    Py_DECREF(pArray);
+    Py_DECREF(pLocals);
+
+    // Record the call, and force a garbage collection if one is due
+    user_code_done();
+
+    *stat=0;
     return;
   }
+#endif
+
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
   
+  // If the user's function asks for it, evaluate it for chunks of the nodes
+  // in parallel worker processes, which write into shared memory.
+  processes=worker_processes(pFunc, *nodes);
+  if (processes > 1){
+    shared=shared_doubles(*nodes * result_dim[0] * result_dim[1]);
+    if (shared == NULL){
+      user_code_failed(pLocals, stat);
+      return;
+    }
+    worker=fork_workers(processes, *nodes, &start, &count);
+    if (worker == 1){
+      set_tensor_field_from_python(function, function_len, dim, &count,
+                                   x + start, y + start, z + start, t,
+                                   result_dim,
+                                   shared + start * result_dim[0] * result_dim[1],
+                                   stat);
+      worker_exit(*stat);
+    }
+    if (worker == 0)
+      memcpy(result, shared,
+             *nodes * result_dim[0] * result_dim[1] * sizeof(double));
+    munmap(shared, *nodes * result_dim[0] * result_dim[1] * sizeof(double));
+    Py_DECREF(pLocals);
+
+    // Record the call, and force a garbage collection if one is due
+    user_code_done();
+
+    *stat=worker == 0 ? 0 : 1;
+    return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
   
@@ -497,8 +1164,8 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
   
@@ -520,8 +1187,9 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
     
     // Check for a Python error in the function call
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -529,8 +1197,10 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
       PyArray_ContiguousFromObject(pResult, PyArray_DOUBLE, 2, 2);
 
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pArray);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -538,7 +1208,10 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
     {
       fprintf(stderr, "Error: dimensions of array returned from python ([%d, %d]) do not match allocated dimensions of the tensor_field ([%d, %d])).\n", 
              (int) pArray->dimensions[0], (int) pArray->dimensions[1], result_dim[0], result_dim[1]);
-      *stat=1;
+      Py_DECREF(pArray);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -555,8 +1228,9 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
     Py_DECREF(pArray);
 
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -566,10 +1240,9 @@ void set_tensor_field_from_python(char *function, int *function_len, int *dim,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
   
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
   
   *stat=0;
   return;
@@ -592,7 +1265,7 @@ void set_particle_sfield_from_python(char *function, int *function_len,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pParticle, *pIpart, *pT;
   
   char *function_c;
@@ -604,27 +1277,26 @@ void set_particle_sfield_from_python(char *function, int *function_len,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
   
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-  
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
   
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
+
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
   
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
@@ -639,8 +1311,8 @@ void set_particle_sfield_from_python(char *function, int *function_len,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
   
@@ -652,8 +1324,9 @@ void set_particle_sfield_from_python(char *function, int *function_len,
     
     // Check for a Python error in the function call
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -661,8 +1334,9 @@ void set_particle_sfield_from_python(char *function, int *function_len,
     
     // Check for a Python error in result.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -672,10 +1346,9 @@ void set_particle_sfield_from_python(char *function, int *function_len,
   // Clean up
   Py_DECREF(pArgs);  
     Py_DECREF(pLocals);  
-    Py_DECREF(pCode);  
     
-    // Force a garbage collection
-    PyGC_Collect();
+    // Record the call, and force a garbage collection if one is due
+    user_code_done();
     
     *stat=0;
     return;
@@ -699,7 +1372,7 @@ void set_particle_vfield_from_python(char *function, int *function_len,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pParticle, *pIpart, *pT;
   char *function_c;
   int i;
@@ -710,27 +1383,26 @@ void set_particle_vfield_from_python(char *function, int *function_len,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
   
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-  
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
   
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
+
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
   
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
@@ -745,8 +1417,8 @@ void set_particle_vfield_from_python(char *function, int *function_len,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
   
@@ -757,8 +1429,9 @@ void set_particle_vfield_from_python(char *function, int *function_len,
     
     // Check for a Python error in the function call
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -767,8 +1440,10 @@ void set_particle_vfield_from_python(char *function, int *function_len,
     result_x[i]=PyFloat_AsDouble(pIpart);
     // Check for a Python error in unpacking tuple.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pIpart);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     Py_DECREF(pIpart);
@@ -778,7 +1453,10 @@ void set_particle_vfield_from_python(char *function, int *function_len,
     result_y[i]=PyFloat_AsDouble(pIpart);  
     // Check for a Python error in unpacking tuple.  
     if (PyErr_Occurred()){  
-      PyErr_Print();  
+      Py_XDECREF(pIpart);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;  
     }  
     
@@ -787,7 +1465,10 @@ void set_particle_vfield_from_python(char *function, int *function_len,
     result_z[i]=PyFloat_AsDouble(pIpart);  
     // Check for a Python error in unpacking tuple.  
     if (PyErr_Occurred()){  
-      PyErr_Print();  
+      Py_XDECREF(pIpart);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;  
     }  
     Py_DECREF(pIpart);  
@@ -799,10 +1480,9 @@ void set_particle_vfield_from_python(char *function, int *function_len,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
   
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
   
   *stat=0;
   return;
@@ -827,7 +1507,7 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, *pResultItem, 
+  PyObject *pLocals, *pFunc, *pResult, *pResultItem, 
     *pArgs, *px, *pT;
   char *function_c;
   int i;
@@ -838,27 +1518,26 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
   
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-  
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
   
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
+
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
   
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
@@ -869,8 +1548,8 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
   
@@ -878,8 +1557,9 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
     
   // Check for a Python error in the function call
    if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -892,8 +1572,11 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
     result_x[i]=PyFloat_AsDouble(px);
     // Check for a Python error in unpacking tuple.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(px);
+      Py_XDECREF(pResultItem);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      user_code_failed(pLocals, stat);
       return;
     }
     Py_DECREF(px);
@@ -903,7 +1586,11 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
       result_y[i]=PyFloat_AsDouble(px);  
       // Check for a Python error in unpacking tuple.  
       if (PyErr_Occurred()){  
-         PyErr_Print();  
+         Py_XDECREF(px);
+         Py_DECREF(pResultItem);
+         Py_DECREF(pResult);
+         Py_DECREF(pArgs);
+         user_code_failed(pLocals, stat);
          return;  
       }  
       
@@ -913,7 +1600,11 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
         result_z[i]=PyFloat_AsDouble(px);  
       // Check for a Python error in unpacking tuple.  
        if (PyErr_Occurred()){  
-          PyErr_Print();  
+          Py_XDECREF(px);
+          Py_DECREF(pResultItem);
+          Py_DECREF(pResult);
+          Py_DECREF(pArgs);
+          user_code_failed(pLocals, stat);
           return;  
        }  
         Py_DECREF(px);  
@@ -928,10 +1619,9 @@ void set_detectors_from_python(char *function, int *function_len, int *dim,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
   
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
   
   *stat=0;
   return;
@@ -954,7 +1644,7 @@ void real_from_python(char* function, int* function_len,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pT;
   
   char *function_c;
@@ -965,29 +1655,27 @@ void real_from_python(char* function, int* function_len,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
 
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
 
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
 
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
 
@@ -997,8 +1685,8 @@ void real_from_python(char* function, int* function_len,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1006,8 +1694,9 @@ void real_from_python(char* function, int* function_len,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1015,8 +1704,9 @@ void real_from_python(char* function, int* function_len,
 
   // Check for a Python error in result.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_DECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1025,10 +1715,9 @@ void real_from_python(char* function, int* function_len,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
 
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
 
 
   *stat=0;
@@ -1058,7 +1747,7 @@ void real_vector_from_python(char* function, int* function_len,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pT, *pResultItem;
   
   char *function_c;
@@ -1069,29 +1758,27 @@ void real_vector_from_python(char* function, int* function_len,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
 
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
 
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
 
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
 
@@ -1101,8 +1788,8 @@ void real_vector_from_python(char* function, int* function_len,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1110,8 +1797,9 @@ void real_vector_from_python(char* function, int* function_len,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1119,8 +1807,9 @@ void real_vector_from_python(char* function, int* function_len,
   
   // Check for a Python error in result_dim.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_DECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
   
@@ -1131,8 +1820,12 @@ void real_vector_from_python(char* function, int* function_len,
     pResultItem = PySequence_GetItem(pResult, i);    
     // Check for a Python error in unpacking tuple.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResultItem);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      free(*result);
+      *result=NULL;
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -1140,8 +1833,12 @@ void real_vector_from_python(char* function, int* function_len,
 
     // Check we really got a float.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_DECREF(pResultItem);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      free(*result);
+      *result=NULL;
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -1154,10 +1851,9 @@ void real_vector_from_python(char* function, int* function_len,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
 
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
 
 
   *stat=0;
@@ -1182,7 +1878,7 @@ void integer_vector_from_python(char* function, int* function_len,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pT, *pResultItem;
   
   char *function_c;
@@ -1193,29 +1889,27 @@ void integer_vector_from_python(char* function, int* function_len,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
 
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
 
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
 
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
 
@@ -1225,8 +1919,8 @@ void integer_vector_from_python(char* function, int* function_len,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1234,8 +1928,9 @@ void integer_vector_from_python(char* function, int* function_len,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1243,8 +1938,9 @@ void integer_vector_from_python(char* function, int* function_len,
   
   // Check for a Python error in result_dim.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_DECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
   
@@ -1255,8 +1951,12 @@ void integer_vector_from_python(char* function, int* function_len,
     pResultItem = PySequence_GetItem(pResult, i);    
     // Check for a Python error in unpacking tuple.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_XDECREF(pResultItem);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      free(*result);
+      *result=NULL;
+      user_code_failed(pLocals, stat);
       return;
     }
 
@@ -1264,8 +1964,12 @@ void integer_vector_from_python(char* function, int* function_len,
 
     // Check we really got a float.
     if (PyErr_Occurred()){
-      PyErr_Print();
-      *stat=1;
+      Py_DECREF(pResultItem);
+      Py_DECREF(pResult);
+      Py_DECREF(pArgs);
+      free(*result);
+      *result=NULL;
+      user_code_failed(pLocals, stat);
       return;
     }
     
@@ -1278,10 +1982,9 @@ void integer_vector_from_python(char* function, int* function_len,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
 
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
 
 
   *stat=0;
@@ -1305,7 +2008,7 @@ void integer_from_python(char* function, int* function_len,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pT;
   
   char *function_c;
@@ -1316,29 +2019,27 @@ void integer_from_python(char* function, int* function_len,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
 
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
 
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
 
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
 
@@ -1348,8 +2049,8 @@ void integer_from_python(char* function, int* function_len,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1357,8 +2058,9 @@ void integer_from_python(char* function, int* function_len,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1366,8 +2068,9 @@ void integer_from_python(char* function, int* function_len,
 
   // Check for a Python error in result.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_DECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1376,10 +2079,9 @@ void integer_from_python(char* function, int* function_len,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
 
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
 
 
   *stat=0;
@@ -1404,7 +2106,7 @@ void string_from_python(char* function, int* function_len,
   *stat=1;
   return;
 #else
-  PyObject *pMain, *pGlobals, *pLocals, *pFunc, *pCode, *pResult, 
+  PyObject *pLocals, *pFunc, *pResult, 
     *pArgs, *pT;
   int pResult_len;
   
@@ -1416,29 +2118,27 @@ void string_from_python(char* function, int* function_len,
   memcpy( function_c, function, *function_len );
   function_c[*function_len] = 0;
 
-  // Get a reference to the main module and global dictionary
-  pMain = PyImport_AddModule("__main__");
-
-  pGlobals = PyModule_GetDict(pMain);
-  // Global and local namespace dictionaries for our code.
-  pLocals=PyDict_New();
-  
-  // Execute the user's code.
-  pCode=PyRun_String(function_c, Py_file_input, pGlobals, pLocals);
-
-  // Extract the function from the code.
-  pFunc=PyDict_GetItemString(pLocals, "val");
+  // Fetch the namespace created by executing the user's code, which is only
+  // executed the first time it is seen.
+  pLocals=user_namespace(function_c);
 
   // Clean up memory from null termination.
   free(function_c);
   
   // Check for errors in executing user code.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    user_code_failed(pLocals, stat);
     return;
   }
 
+  // Extract the function from the code.
+  pFunc=PyDict_GetItemString(pLocals, "val");
+  if (pFunc == NULL) {
+      printf("Couldn't find a 'val' function in your Python code.\n");
+      user_code_failed(pLocals, stat);
+      return;
+  }
+
   // Python form of time variable.
   pT=PyFloat_FromDouble(*t);
 
@@ -1448,8 +2148,8 @@ void string_from_python(char* function, int* function_len,
 
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1457,12 +2157,22 @@ void string_from_python(char* function, int* function_len,
   
   // Check for a Python error in the function call
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_XDECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
   pResult_len = PyString_Size(pResult);
+
+  // Check that the result is a string.
+  if (PyErr_Occurred()){
+    Py_DECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
+    return;
+  }
+
   if(pResult_len > *result_len){
     fprintf(stderr, "In string_from_python\n");
     fprintf(stderr, "Warning: Truncating returned string\n");
@@ -1475,8 +2185,9 @@ void string_from_python(char* function, int* function_len,
 
   // Check for a Python error in result.
   if (PyErr_Occurred()){
-    PyErr_Print();
-    *stat=1;
+    Py_DECREF(pResult);
+    Py_DECREF(pArgs);
+    user_code_failed(pLocals, stat);
     return;
   }
 
@@ -1485,10 +2196,9 @@ void string_from_python(char* function, int* function_len,
   // Clean up
   Py_DECREF(pArgs);  
   Py_DECREF(pLocals);  
-  Py_DECREF(pCode);  
 
-  // Force a garbage collection
-  PyGC_Collect();
+  // Record the call, and force a garbage collection if one is due
+  user_code_done();
 
 
   *stat=0;
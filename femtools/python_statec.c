@@ -1,5 +1,22 @@
 #define ALLOW_IMPORT_ARRAY
 #include "python_statec.h"
+#include <stdarg.h>
+
+#ifdef HAVE_NUMPY
+// States are built directly through the C API and cached by name. When a
+// cached state is added again, its fields and meshes are reused wherever the
+// Fortran arrays they wrap have not moved, and only the rest are rebuilt. The
+// cache is cleared by python_clear_state_cache_, once per timestep.
+static PyObject *pStateCache = NULL;       // name -> State
+static PyObject *pStateGeneration = NULL;  // name -> reset it was last added in
+static PyObject *pPreviousState = NULL;    // name -> {attribute: old dict}
+static long reset_generation = 0;
+
+// Set while the element of a reused mesh, with its quadratures and
+// polynomials, is being added again; cleared by the next mesh, state,
+// reset or cache clear so that a stale value never drops an element.
+static int skip_element = 0;
+#endif
 
 void python_init_(void){
 #ifdef HAVE_PYTHON
@@ -78,6 +95,14 @@ void python_reset_(void){
     // Reinitialize the variables
     init_vars();
 
+#ifdef HAVE_NUMPY
+    // States cached from before the reset may be added again
+    reset_generation++;
+    if(pPreviousState != NULL)
+      PyDict_Clear(pPreviousState);
+    skip_element = 0;
+#endif
+
     // And run a garbage collection
     PyGC_Collect();
   }
@@ -88,6 +113,7 @@ void python_reset_(void){
 void python_end_(void){
 #ifdef HAVE_PYTHON
   if(Py_IsInitialized()){
+    python_clear_state_cache_();
     // Garbage collection
     PyGC_Collect();
     // Finalize the Python interpreter
@@ -148,20 +174,263 @@ char* fix_string(char *s,int len){
 
 // Functions to add a state and fields: scalar, vector, tensor, mesh, quadrature, polynomial
 
+#ifdef HAVE_NUMPY
+
+static const char *state_dicts[] = {"scalar_fields", "vector_fields",
+  "tensor_fields", "csr_matrices", "meshes"};
+
+// Return a borrowed reference to a global of the __main__ module.
+static PyObject *main_global(const char *name){
+  return PyDict_GetItemString(PyModule_GetDict(PyImport_AddModule("__main__")), name);
+}
+
+// Return a borrowed reference to the dictionary attribute of the state called
+// state, or NULL.
+static PyObject *state_dict(char *state, const char *attribute){
+  PyObject *pStates = main_global("states");
+  PyObject *pState, *pDict;
+
+  if(pStates == NULL || (pState = PyDict_GetItemString(pStates, state)) == NULL){
+    PyErr_Format(PyExc_KeyError, "no state called '%s'", state);
+    return NULL;
+  }
+  pDict = PyObject_GetAttrString(pState, attribute);
+  if(pDict == NULL)
+    return NULL;
+  // The State keeps the dictionary alive.
+  Py_DECREF(pDict);
+  return pDict;
+}
+
+// Return a new reference to the object called name in the dictionary
+// attribute of the state called state when it was last added, or NULL.
+static PyObject *previous_object(char *state, const char *attribute, char *name){
+  PyObject *pPrevious, *pDict, *pObject;
+
+  if(pPreviousState == NULL || (pPrevious = PyDict_GetItemString(pPreviousState, state)) == NULL)
+    return NULL;
+  if((pDict = PyDict_GetItemString(pPrevious, attribute)) == NULL)
+    return NULL;
+  if((pObject = PyDict_GetItemString(pDict, name)) == NULL)
+    return NULL;
+  Py_INCREF(pObject);
+  return pObject;
+}
+
+// Return 1 if the val attribute of pField is an array of the given shape
+// wrapping data, and 0 otherwise.
+static int wraps_array(PyObject *pField, const char *attribute, void *data,
+  int nd, npy_intp dims[]){
+  PyObject *pVal = PyObject_GetAttrString(pField, attribute);
+  PyArrayObject *pArray;
+  int i, same;
+
+  if(pVal == NULL){
+    PyErr_Clear();
+    return 0;
+  }
+  pArray = (PyArrayObject *)pVal;
+  same = PyArray_Check(pVal) && pArray->data == data && pArray->nd == nd;
+  for(i = 0; same && i < nd; i++)
+    same = pArray->dimensions[i] == dims[i];
+  Py_DECREF(pVal);
+  return same;
+}
+
+// Return a new reference to a zero-copy array of shape dims over data, which
+// is addressed with the given byte strides. strides may be NULL for a
+// C-ordered array.
+static PyObject *array_view(int nd, npy_intp dims[], npy_intp strides[],
+  int type, void *data){
+  PyObject *pArray = PyArray_New(&PyArray_Type, nd, dims, type, strides, data,
+    0, NPY_BEHAVED, NULL);
+  if(pArray != NULL)
+    PyArray_UpdateFlags((PyArrayObject *)pArray, NPY_UPDATE_ALL);
+  return pArray;
+}
+
+// Return a new reference to a zero-copy view of a Fortran array of shape dims.
+static PyObject *fortran_array_view(int nd, npy_intp dims[], int type, void *data){
+  return PyArray_New(&PyArray_Type, nd, dims, type, NULL, data, 0,
+    NPY_FARRAY, NULL);
+}
+
+// Set the global name of the __main__ module to a zero-copy view of a
+// Fortran array of shape dims.
+static void add_fortran_array(int nd, npy_intp dims[], int type, void *data,
+  char *name){
+  PyObject *pDict = PyModule_GetDict(PyImport_AddModule("__main__"));
+  PyObject *a = fortran_array_view(nd, dims, type, data);
+
+  if(a == NULL){
+    PyErr_Print();
+    return;
+  }
+  PyDict_SetItemString(pDict,name,a);
+  Py_DECREF(a);
+}
+
+// Add the field pField called name to the dictionary attribute of state, and
+// set its mesh to the mesh called mesh_name in that state.
+static void add_field(char *state, const char *attribute, char *name,
+  PyObject *pField, char *mesh_name){
+  PyObject *pDict, *pMeshes, *pMesh, *pResult;
+
+  if((pDict = state_dict(state, attribute)) == NULL ||
+     PyDict_SetItemString(pDict, name, pField) != 0 ||
+     (pMeshes = state_dict(state, "meshes")) == NULL){
+    PyErr_Print();
+    return;
+  }
+
+  if((pMesh = PyDict_GetItemString(pMeshes, mesh_name)) == NULL){
+    PyErr_Format(PyExc_KeyError, "no mesh called '%s' in state '%s'", mesh_name, state);
+    PyErr_Print();
+    return;
+  }
+  pResult = PyObject_CallMethod(pField, "set_mesh", "O", pMesh);
+  if(pResult == NULL){
+    PyErr_Print();
+    return;
+  }
+  Py_DECREF(pResult);
+}
+
+// Add a field of class class_name wrapping pVal, with the remaining
+// constructor arguments given by format and the following arguments, to the
+// dictionary attribute of state, reusing the previously added field if it
+// still wraps the same array.
+static void add_field_object(char *state, const char *attribute, char *name,
+  char *mesh_name, void *data, PyObject *pVal, const char *class_name,
+  char *format, ...){
+  PyArrayObject *pArray = (PyArrayObject *)pVal;
+  PyObject *pField, *pClass, *pArgs, *pRest;
+  va_list args;
+  Py_ssize_t i;
+
+  pField = previous_object(state, attribute, name);
+  if(pField != NULL && !wraps_array(pField, "val", data, pArray->nd, pArray->dimensions)){
+    Py_DECREF(pField);
+    pField = NULL;
+  }
+
+  if(pField == NULL){
+    if((pClass = main_global(class_name)) == NULL){
+      PyErr_Format(PyExc_NameError, "name '%s' is not defined", class_name);
+      PyErr_Print();
+      return;
+    }
+    va_start(args, format);
+    pRest = Py_VaBuildValue(format, args);
+    va_end(args);
+    if(pRest == NULL){
+      PyErr_Print();
+      return;
+    }
+    pArgs = PyTuple_New(2 + PyTuple_Size(pRest));
+    Py_INCREF(pVal);
+    PyTuple_SET_ITEM(pArgs, 0, PyString_FromString(name));
+    PyTuple_SET_ITEM(pArgs, 1, pVal);
+    for(i = 0; i < PyTuple_Size(pRest); i++){
+      Py_INCREF(PyTuple_GET_ITEM(pRest, i));
+      PyTuple_SET_ITEM(pArgs, 2 + i, PyTuple_GET_ITEM(pRest, i));
+    }
+    Py_DECREF(pRest);
+    pField = PyObject_CallObject(pClass, pArgs);
+    Py_DECREF(pArgs);
+    if(pField == NULL){
+      PyErr_Print();
+      return;
+    }
+  }
+
+  add_field(state, attribute, name, pField, mesh_name);
+  Py_DECREF(pField);
+}
+#endif
+
+void python_clear_state_cache_(void){
+#ifdef HAVE_NUMPY
+  // Forget the cached states, so that they are all rebuilt when next added
+  Py_CLEAR(pStateCache);
+  Py_CLEAR(pStateGeneration);
+  Py_CLEAR(pPreviousState);
+  skip_element = 0;
+#endif
+}
 
 void python_add_statec_(char *name,int *len){
-#ifdef HAVE_PYTHON
-  // Add a new state object to the Python environment
+#ifdef HAVE_NUMPY
+  // Add a state object to the Python environment, reusing the cached state
+  // with the same name if it has not already been added since the last reset
+  PyObject *pGlobals = PyModule_GetDict(PyImport_AddModule("__main__"));
+  PyObject *pStates, *pState, *pGeneration, *pPrevious, *pDict, *pEmpty;
   char *n = fix_string(name,*len);
-  int tlen=23+2*(*len);
-  char t[tlen];
+  int i;
+
+  skip_element = 0;
+  if(pStateCache == NULL){
+    pStateCache = PyDict_New();
+    pStateGeneration = PyDict_New();
+    pPreviousState = PyDict_New();
+  }
+
+  pPrevious = PyDict_New();
+  pState = PyDict_GetItemString(pStateCache, n);
+  pGeneration = PyDict_GetItemString(pStateGeneration, n);
+  if(pState != NULL && PyInt_AsLong(pGeneration) != reset_generation){
+    // Keep the state's dictionaries from the last time it was added, so that
+    // their contents can be reused, and start it with empty ones.
+    Py_INCREF(pState);
+    for(i = 0; i < (int) (sizeof(state_dicts) / sizeof(state_dicts[0])); i++){
+      pDict = PyObject_GetAttrString(pState, state_dicts[i]);
+      if(pDict != NULL){
+        PyDict_SetItemString(pPrevious, state_dicts[i], pDict);
+        Py_DECREF(pDict);
+      }
+      else
+        PyErr_Clear();
+      pEmpty = PyDict_New();
+      PyObject_SetAttrString(pState, state_dicts[i], pEmpty);
+      Py_DECREF(pEmpty);
+    }
+  }
+  else{
+    // Not cached, or already added since the last reset (as when states from
+    // several timesteps are added), so build a new state.
+    if(main_global("State") == NULL){
+      PyErr_SetString(PyExc_NameError, "name 'State' is not defined");
+      pState = NULL;
+    }
+    else
+      pState = PyObject_CallFunction(main_global("State"), "s", n);
+    if(pState == NULL){
+      PyErr_Print();
+      Py_DECREF(pPrevious);
+      free(n);
+      return;
+    }
+    if(PyDict_GetItemString(pStateCache, n) == NULL)
+      PyDict_SetItemString(pStateCache, n, pState);
+  }
+  pGeneration = PyInt_FromLong(reset_generation);
+  PyDict_SetItemString(pStateGeneration, n, pGeneration);
+  Py_DECREF(pGeneration);
+  PyDict_SetItemString(pPreviousState, n, pPrevious);
+  Py_DECREF(pPrevious);
+
   // 'state' in Python will always be the last state added while the 'states' dictionary 
   // includes all added states
-  snprintf(t, tlen, "states[\"%s\"] = State(\"%s\")",n,n);
-  PyRun_SimpleString(t);
-  snprintf(t, tlen, "state = states[\"%s\"]",n);
-  PyRun_SimpleString(t);
+  pStates = PyDict_GetItemString(pGlobals, "states");
+  if(pStates == NULL){
+    pStates = PyDict_New();
+    PyDict_SetItemString(pGlobals, "states", pStates);
+    Py_DECREF(pStates);
+  }
+  PyDict_SetItemString(pStates, n, pState);
+  PyDict_SetItemString(pGlobals, "state", pState);
 
+  Py_DECREF(pState);
   free(n); 
 #endif
 }
@@ -172,45 +441,23 @@ void python_add_scalar_(int *sx,double x[],char *name,int *nlen, int *field_type
   char *mesh_name, int *mesh_name_len){
 #ifdef HAVE_NUMPY
   // Add the Fortran scalar field to the dictionary of the Python interpreter
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
   // Fix the Fortran strings for C and Python
   char *namec = fix_string(name,*nlen);
   char *opc = fix_string(option_path,*oplen);
   char *meshc = fix_string(mesh_name,*mesh_name_len);
-
-  // Create the array
-  python_add_array_double_1d(x,sx,"s");
-
-  PyObject *pname = PyString_FromString(namec);
-  PyDict_SetItemString(pDict,"n",pname); 
-  PyObject *poptionp = PyString_FromString(opc);
-  PyDict_SetItemString(pDict,"op",poptionp);  
-  PyObject *pft = PyInt_FromLong(*field_type);
-  PyDict_SetItemString(pDict,"ft",pft);  
-
-  PyRun_SimpleString("n = string.strip(n)");
-  PyRun_SimpleString("op = string.strip(op)");
-
   char *n = fix_string(state,*slen);
-  int tlen=150+*slen+*mesh_name_len;
-  char t[tlen];
-  snprintf(t, tlen, "field = ScalarField(n,s,ft,op); states['%s'].scalar_fields['%s'] = field",n,namec);
-  PyRun_SimpleString(t);
+  npy_intp dims[] = {*sx};
 
-  // Set the mesh for this field
-  snprintf(t, tlen, "field.set_mesh(states['%s'].meshes['%s'])",n,meshc);
-  PyRun_SimpleString(t);
+  PyObject *pVal = array_view(1, dims, NULL, PyArray_DOUBLE, x);
+  add_field_object(n, "scalar_fields", namec, meshc, x, pVal, "ScalarField",
+    "(is)", *field_type, opc);
 
   // Clean up
-  PyRun_SimpleString("del n; del op; del ft; del s; del field");
+  Py_XDECREF(pVal);
   free(namec); 
   free(opc);
   free(n);
   free(meshc);
-  Py_DECREF(pname);
-  Py_DECREF(poptionp);
-  Py_DECREF(pft);
 #endif
 }
 
@@ -265,50 +512,24 @@ void python_add_vector_(int *num_dim, int *s,
   char *mesh_name, int *mesh_name_len){
 #ifdef HAVE_NUMPY
   // Make the Fortran vector field availabe to the Python interpreter
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
-
-  python_add_array_double_2d(x,num_dim,s,"vector");
-  PyRun_SimpleString("vector = vector.transpose(1, 0)");
-    
   // Fix the Fortran strings for C and Python
   char *namec = fix_string(name,*nlen);
   char *opc = fix_string(option_path,*oplen);
   char *meshc = fix_string(mesh_name,*mesh_name_len);
-
-  PyObject *pname = PyString_FromString(namec);
-  PyDict_SetItemString(pDict,"n",pname); 
-  PyObject *poptionp = PyString_FromString(opc);
-  PyDict_SetItemString(pDict,"op",poptionp);  
-  PyObject *pft = PyInt_FromLong(*field_type);
-  PyDict_SetItemString(pDict,"ft",pft);  
-  PyObject *pnd = PyInt_FromLong(*num_dim);
-  PyDict_SetItemString(pDict,"nd",pnd);  
-
-  PyRun_SimpleString("n = string.strip(n)");
-  PyRun_SimpleString("op = string.strip(op)");
-
   char *n = fix_string(state,*slen);
-  int tlen=150+*slen+*mesh_name_len;
-  char t[tlen];
-  snprintf(t, tlen, "field = VectorField(n,vector,ft,op,nd); states[\"%s\"].vector_fields['%s'] = field",n,namec);
-  PyRun_SimpleString(t);
 
-  // Set the mesh for this field
-  snprintf(t, tlen, "field.set_mesh(states['%s'].meshes['%s'])",n,meshc);
-  PyRun_SimpleString(t);
+  // The Fortran (num_dim, s) array, seen as (s, num_dim)
+  npy_intp dims[] = {*s, *num_dim};
+  PyObject *pVal = array_view(2, dims, NULL, PyArray_DOUBLE, x);
+  add_field_object(n, "vector_fields", namec, meshc, x, pVal, "VectorField",
+    "(isi)", *field_type, opc, *num_dim);
 
   // Clean up
-  PyRun_SimpleString("del n; del op; del ft; del nd; del vector; del field");
+  Py_XDECREF(pVal);
   free(n);
   free(namec); 
   free(opc);
   free(meshc);
-
-  Py_DECREF(pname);
-  Py_DECREF(poptionp);
-  Py_DECREF(pft);
-  Py_DECREF(pnd);
 #endif
 }
 
@@ -318,54 +539,25 @@ void python_add_tensor_(int *sx,int *sy,int *sz, double *x, int num_dim[],
   char *mesh_name, int *mesh_name_len){
 #ifdef HAVE_NUMPY
   // Expose a Fortran tensor field to the Python interpreter
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
-
-  python_add_array_double_3d(x,sx,sy,sz,"val");
-  PyRun_SimpleString("val = val.transpose(2, 0, 1)");
-
   // Fix the Fortran strings for C and Python
-
   char *namec = fix_string(name,*nlen);
   char *opc = fix_string(option_path,*oplen);
   char *meshc = fix_string(mesh_name,*mesh_name_len);
-
-  PyObject *pname = PyString_FromString(namec);
-  PyDict_SetItemString(pDict,"n",pname); 
-  PyObject *poptionp = PyString_FromString(opc);
-  PyDict_SetItemString(pDict,"op",poptionp);  
-  PyObject *pft = PyInt_FromLong(*field_type);
-  PyDict_SetItemString(pDict,"ft",pft);  
-  PyObject *pnd0 = PyInt_FromLong(num_dim[0]);
-  PyDict_SetItemString(pDict,"nd0",pnd0);  
-  PyObject *pnd1 = PyInt_FromLong(num_dim[1]);
-  PyDict_SetItemString(pDict,"nd1",pnd1);  
-
-  PyRun_SimpleString("n = string.strip(n)");
-  PyRun_SimpleString("op = string.strip(op)");
-
   char *n = fix_string(state,*slen);
-  int tlen=150+*slen+*mesh_name_len;
-  char t[tlen];
-  snprintf(t, tlen, "field = TensorField(n,val,ft,op,nd0,nd1); states[\"%s\"].tensor_fields['%s'] = field",n,namec);
-  PyRun_SimpleString(t);  
 
-  // Set the mesh for this field
-  snprintf(t, tlen, "field.set_mesh(states['%s'].meshes['%s'])",n,meshc);
-  PyRun_SimpleString(t);
+  // The Fortran (sx, sy, sz) array, seen as (sz, sx, sy)
+  npy_intp dims[] = {*sz, *sx, *sy};
+  npy_intp strides[] = {*sx * *sy * sizeof(double), sizeof(double), *sx * sizeof(double)};
+  PyObject *pVal = array_view(3, dims, strides, PyArray_DOUBLE, x);
+  add_field_object(n, "tensor_fields", namec, meshc, x, pVal, "TensorField",
+    "(isii)", *field_type, opc, num_dim[0], num_dim[1]);
 
   // Clean up
-  PyRun_SimpleString("del n; del op; del val; del field");
+  Py_XDECREF(pVal);
   free(n);
   free(namec); 
   free(opc); 
   free(meshc);
-
-  Py_DECREF(pname);
-  Py_DECREF(poptionp);
-  Py_DECREF(pft);
-  Py_DECREF(pnd0);
-  Py_DECREF(pnd1);
 #endif
 }
 
@@ -375,43 +567,45 @@ void python_add_mesh_(int ndglno[],int *sndglno, int *elements, int *nodes,
   int *continuity, int region_ids[], int *sregion_ids,
   char *state_name, int *state_name_len){
 #ifdef HAVE_NUMPY
-  // Add the Mesh to the interpreter
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
-
+  // Add the Mesh to the interpreter, reusing the previously added mesh, and
+  // its element, if it still wraps the same connectivity
   // Fix the Fortran strings for C and Python
   char *namec = fix_string(name,*nlen);
   char *opc = fix_string(option_path,*oplen);
-
-  python_add_array_integer_1d(ndglno, sndglno,"mesh_array");
-
-  python_add_array_integer_1d(region_ids, sregion_ids,"region_ids");
-
-  PyObject *pname = PyString_FromString(namec);
-  PyDict_SetItemString(pDict,"n",pname);
-  PyObject *poptionp = PyString_FromString(opc);
-  PyDict_SetItemString(pDict,"op",poptionp);
-
-  PyRun_SimpleString("n = string.strip(n)");
-  PyRun_SimpleString("op = string.strip(op)");
-
   char *n = fix_string(state_name,*state_name_len);
-  int tlen=150 + *state_name_len;
-  char t[tlen];
+  npy_intp dims[] = {*sndglno}, region_dims[] = {*sregion_ids};
+  PyObject *pMesh, *pMeshes, *pNdglno, *pRegionIds, *pClass;
+
+  pMesh = previous_object(n, "meshes", namec);
+  if(pMesh != NULL && !(wraps_array(pMesh, "ndglno", ndglno, 1, dims) &&
+    (*sregion_ids == 0 || wraps_array(pMesh, "region_ids", region_ids, 1, region_dims)))){
+    Py_DECREF(pMesh);
+    pMesh = NULL;
+  }
+  skip_element = pMesh != NULL;
+
+  if(pMesh == NULL){
+    pNdglno = array_view(1, dims, NULL, PyArray_INT, ndglno);
+    pRegionIds = array_view(1, region_dims, NULL, PyArray_INT, region_ids);
+    pClass = main_global("Mesh");
+    if(pClass != NULL && pNdglno != NULL && pRegionIds != NULL)
+      pMesh = PyObject_CallFunction(pClass, "OiiissO", pNdglno, *elements,
+        *nodes, *continuity, namec, opc, pRegionIds);
+    else if(pClass == NULL)
+      PyErr_SetString(PyExc_NameError, "name 'Mesh' is not defined");
+    Py_XDECREF(pNdglno);
+    Py_XDECREF(pRegionIds);
+  }
 
-  snprintf(t, tlen, "states[\"%s\"].meshes[\"%s\"] = Mesh(mesh_array,%d,%d,%d,n,op,region_ids)",n,namec,*elements,*nodes,*continuity);
-  PyRun_SimpleString(t);
-  snprintf(t, tlen, "m = states[\"%s\"].meshes[\"%s\"]",n,namec);
-  PyRun_SimpleString(t);
+  if(pMesh == NULL || (pMeshes = state_dict(n, "meshes")) == NULL ||
+     PyDict_SetItemString(pMeshes, namec, pMesh) != 0)
+    PyErr_Print();
 
   // Clean up
-  PyRun_SimpleString("del n; del op; del m");
+  Py_XDECREF(pMesh);
   free(namec); 
   free(n); 
   free(opc);
-
-  Py_DECREF(pname);
-  Py_DECREF(poptionp);
 #endif
 }
 
@@ -424,6 +618,10 @@ void python_add_element_(int *dim, int *loc, int *ngi, int *degree,
   char* type_name, int* type_name_len,
   double* coords, int* size_coords_x, int* size_coords_y){
 #ifdef HAVE_NUMPY
+  // A reused mesh already has its element
+  if(skip_element)
+    return;
+
   // Fix the Fortran strings for C and Python
   char *meshc = fix_string(mesh_name,*mesh_name_len);
   char *statec = fix_string(state_name,*state_name_len);
@@ -458,6 +656,9 @@ void python_add_quadrature_(int *dim,int *degree,int *loc, int *ngi,
   double *weight, int *weight_size, double *locations, int *l_size, int *is_surfacequadr){
   // Only being called right after an element has been added
 #ifdef HAVE_NUMPY
+  if(skip_element)
+    return;
+
   // Set weights
   python_add_array_double_1d(weight,weight_size,"weight");
 
@@ -480,6 +681,9 @@ void python_add_quadrature_(int *dim,int *degree,int *loc, int *ngi,
 
 void python_add_polynomial_(double *coefs,int *size,int *degree, int *x,int *y, int *spoly){
 #ifdef HAVE_NUMPY
+  if(skip_element)
+    return;
+
   // Add a polynomial to the latest element
   // Set the coefs array
   python_add_array_double_1d(coefs, size, "coefs");
@@ -523,34 +727,16 @@ void python_add_array_double_1d(double *arr, int *size, char *name){
 void python_add_array_double_2d(double *arr, int *sizex, int *sizey, char *name){
 #ifdef HAVE_NUMPY
   // Add an array in Python which will be availabe under the variable name 'name'
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
-
-  // Set the array
-  npy_intp dims[] = {*sizey,*sizex};
-  PyObject *a = PyArray_SimpleNewFromData(2, dims, PyArray_DOUBLE, (char*)arr);
-  PyDict_SetItemString(pDict,name,a);
-  char c[200];
-  snprintf(c, 200, "%s = numpy.transpose(%s,(1,0))",name,name);
-  PyRun_SimpleString(c);
-  Py_DECREF(a);
+  npy_intp dims[] = {*sizex,*sizey};
+  add_fortran_array(2, dims, PyArray_DOUBLE, arr, name);
 #endif
 }
 
 void python_add_array_double_3d(double *arr, int *sizex, int *sizey, int *sizez, char *name){
 #ifdef HAVE_NUMPY
   // Add an array in Python which will be availabe under the variable name 'name'
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
-
-  // Set the array
-  npy_intp dims[] = {*sizez,*sizey,*sizex};
-  PyObject *a = PyArray_SimpleNewFromData(3, dims, PyArray_DOUBLE, (char*)arr);
-  PyDict_SetItemString(pDict,name,a);
-  char c[200];
-  snprintf(c, 200, "%s = numpy.transpose(%s,(2,1,0))",name,name);
-  PyRun_SimpleString(c);
-  Py_DECREF(a);
+  npy_intp dims[] = {*sizex,*sizey,*sizez};
+  add_fortran_array(3, dims, PyArray_DOUBLE, arr, name);
 #endif
 }
 
@@ -570,34 +756,16 @@ void python_add_array_integer_1d(int *arr, int *size, char *name){
 void python_add_array_integer_2d(int *arr, int *sizex, int *sizey, char *name){
 #ifdef HAVE_NUMPY
   // Add an array in Python which will be availabe under the variable name 'name'
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
-
-  // Set the array
-  npy_intp dims[] = {*sizey,*sizex};
-  PyObject *a = PyArray_SimpleNewFromData(2, dims, PyArray_INT, (char*)arr);
-  PyDict_SetItemString(pDict,name,a);
-  char c[200];
-  snprintf(c, 200, "%s = numpy.transpose(%s,(1,0))",name,name);
-  PyRun_SimpleString(c);
-  Py_DECREF(a);
+  npy_intp dims[] = {*sizex,*sizey};
+  add_fortran_array(2, dims, PyArray_INT, arr, name);
 #endif
 }
 
 void python_add_array_integer_3d(int *arr, int *sizex, int *sizey, int *sizez, char *name){
 #ifdef HAVE_NUMPY
   // Add an array in Python which will be availabe under the variable name 'name'
-  PyObject *pMain = PyImport_AddModule("__main__");
-  PyObject *pDict = PyModule_GetDict(pMain);
-
-  // Set the array
-  npy_intp dims[] = {*sizez,*sizey,*sizex};
-  PyObject *a = PyArray_SimpleNewFromData(3, dims, PyArray_INT, (char*)arr);
-  PyDict_SetItemString(pDict,name,a);
-  char c[200];
-  snprintf(c, 200, "%s = numpy.transpose(%s,(2,1,0))",name,name);
-  PyRun_SimpleString(c);
-  Py_DECREF(a);
+  npy_intp dims[] = {*sizex,*sizey,*sizez};
+  add_fortran_array(3, dims, PyArray_INT, arr, name);
 #endif
 }
 
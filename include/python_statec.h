@@ -17,6 +17,7 @@ void python_init_(void);  // Initialize
 void python_end_(void);   // Finalize
 void python_reset_(void); // Clear the dictionary
 void init_vars(void);
+void python_clear_state_cache_(void); // Forget the states cached between additions
 
 void python_add_statec_(char *name,int *len); // Add a new state object to the Python environment, if a state with the same name already exists it will overwrite that state; also the last added state will be accessible as 'state', all others in the 'states' dictionary
 
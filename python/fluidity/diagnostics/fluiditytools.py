@@ -63,62 +63,142 @@ def FluidityBinary(binaries = ["dfluidity-debug", "dfluidity", "fluidity-debug",
 class Stat:
   """
   Class for handling .stat files. Similiar to the dictionary returned by
-  stat_parser, but with some annoying features fixed.
+  stat_parser, but with some annoying features fixed. If lazy is True, only the
+  .stat header is parsed on read, and each entry is read from the file on first
+  access. If follow is True, rows appended to the .stat after it is read can be
+  read with Refresh.
   """
 
-  def __init__(self, filename = None, delimiter = "%", includeMc = False, subsample = 1):
+  def __init__(self, filename = None, delimiter = "%", includeMc = False, subsample = 1, lazy = False, follow = False):
     self.SetDelimiter(delimiter)
     self._s = {}
+    self._follower = None
+    # Views (see _View) delegate to the root Stat
+    self._root = None
+    self._prefix = ""
+    self._ResetIndex()
     if not filename is None:
-      self.Read(filename, includeMc = includeMc, subsample = subsample)
+      self.Read(filename, includeMc = includeMc, subsample = subsample, lazy = lazy, follow = follow)
       
     return
     
+  def _ResetIndex(self):
+    """
+    Discard the flat path index, which is then rebuilt on next use
+    """
+    
+    self._index = None
+    self._views = {}
+    
+    return
+    
+  def _Index(self):
+    """
+    Return the flat path index, building it if necessary. This is a tuple of:
+      a dictionary mapping leaf paths to (dictionary, key) pairs
+      a dictionary mapping internal paths to (dictionary, path list) pairs
+      a list of leaf paths
+      a list of leaf path lists
+    """
+    
+    if self._index is None:
+      leaves = {}
+      nodes = {}
+      paths = []
+      pathLists = []
+      
+      def SIndex(s, base):
+        for key in s.keys():
+          pathList = base + [key]
+          path = self.FormPathFromList(pathList)
+          # Raw dictionary access, so that lazy entries are not read
+          item = dict.__getitem__(s, key)
+          if path in leaves or path in nodes:
+            # Ambiguous path. Keep the first entry found.
+            pass
+          elif isinstance(item, dict):
+            nodes[path] = (item, pathList)
+          else:
+            leaves[path] = (s, key)
+            paths.append(path)
+            pathLists.append(pathList)
+          if isinstance(item, dict):
+            SIndex(item, pathList)
+            
+        return
+      SIndex(self._s, [])
+      
+      self._index = (leaves, nodes, paths, pathLists)
+    
+    return self._index
+    
+  def _View(self, path):
+    """
+    Return a Stat view of the internal entry with the supplied path. Lookups in
+    the view use the index of this Stat.
+    """
+    
+    if not path in self._views:
+      subS = Stat(delimiter = self._delimiter)
+      subS._s = self._Index()[1][path][0]
+      subS._root = self
+      subS._prefix = path + self._delimiter
+      self._views[path] = subS
+      
+    return self._views[path]
+    
   def __getitem__(self, key):
     """
     Index into the .stat with the given key (or path)
     """
-  
-    def SItem(s, key, delimiter):
-      if key in s:
-        return s[key]
-      else:
-        keySplit = key.split(delimiter)
-        for i in range(len(keySplit)):
-          key = utils.FormLine(keySplit[:i], delimiter = delimiter, newline = False)
-          if key in s:
-            if isinstance(s[key], dict):
-              try:
-                # Tolerate a failure when recursing, as the key may have been
-                # eroneously split
-                return SItem(s[key], utils.FormLine(keySplit[i:], delimiter = delimiter, newline = False), delimiter)
-              except Exception:
-                pass
-            else:
-              return s[key]
-
-        raise Exception("Key not found")
     
-    item = SItem(self._s, key, self._delimiter)
-    if isinstance(item, dict):
-      subS = Stat(delimiter = self._delimiter)
-      subS._s = item
-      return subS
-    else:
+    if not self._root is None:
+      return self._root[self._prefix + key]
+  
+    leaves, nodes = self._Index()[:2]
+    if key in leaves:
+      s, leafKey = leaves[key]
+      item = dict.__getitem__(s, leafKey)
+      if isinstance(item, lazy_stat_value):
+        # Lazy entries are read, and cached, here
+        item = item.load()
+        dict.__setitem__(s, leafKey, item)
       return item
+    elif key in nodes:
+      return self._View(key)
+    else:
+      raise Exception("Key not found")
     
   def __setitem__(self, key, value):
+    if not self._root is None:
+      self._root[self._prefix + key] = value
+      return
+      
     keySplit = self.SplitPath(key)
     assert(len(keySplit) > 0)
-    s = self
-    for key in keySplit[:-1]:
-      if s.haskey(key):
-        s = s[key]
-        assert(isinstance(s, Stat))
-      else:
-        s._s[key] = {}
-        s = s[key]
-    s._s[keySplit[-1]] = value
+    s = self._s
+    for subKey in keySplit[:-1]:
+      if not subKey in s:
+        dict.__setitem__(s, subKey, {})
+      s = dict.__getitem__(s, subKey)
+      assert(isinstance(s, dict))
+    dict.__setitem__(s, keySplit[-1], value)
+    
+    if isinstance(value, dict):
+      self._ResetIndex()
+    elif not self._index is None:
+      # Update the index in place
+      leaves, nodes, paths, pathLists = self._index
+      node = self._s
+      for i, subKey in enumerate(keySplit[:-1]):
+        node = dict.__getitem__(node, subKey)
+        path = self.FormPathFromList(keySplit[:i + 1])
+        if not path in nodes:
+          nodes[path] = (node, keySplit[:i + 1])
+      if not key in leaves:
+        paths.append(key)
+        pathLists.append(keySplit)
+      leaves[key] = (s, keySplit[-1])
     
     return
     
@@ -172,49 +252,34 @@ class Stat:
     """
     Return all valid paths
     """
-  
-    def SPaths(s, delimiter, base = ""):
-      if len(base) > 0:
-        base += delimiter
     
-      paths = []
-      for key in s.keys():
-        if isinstance(s[key], dict):
-          paths += SPaths(s[key], delimiter, base = base + key)
-        else:
-          paths.append(base + key)
-          
-      return paths
-    
-    return SPaths(self._s, self._delimiter)
+    if not self._root is None:
+      return [path[len(self._prefix):] for path in self._root.Paths() if path.startswith(self._prefix)]
+  
+    return list(self._Index()[2])
     
   def PathLists(self):
     """
     Return all valid paths as a series of key lists
     """
     
-    def SPathLists(s, delimiter, base = []):    
-      paths = []
-      for key in s.keys():
-        if isinstance(s[key], dict):
-          paths += SPathLists(s[key], delimiter, base = base + [key])
-        else:
-          paths.append(base + [key])
-          
-      return paths
+    if not self._root is None:
+      baseList = self._root._Index()[1][self._prefix[:-len(self._delimiter)]][1]
+      return [pathList[len(baseList):] for pathList in self._root.PathLists() if pathList[:len(baseList)] == baseList]
     
-    return SPathLists(self._s, self._delimiter)
+    return [list(pathList) for pathList in self._Index()[3]]
     
   def HasPath(self, path):
     """
     Return whether the supplied path is valid for this Stat
     """
     
-    try:
-      self[path]
-      return True
-    except Exception:
-      return False
+    if not self._root is None:
+      return self._root.HasPath(self._prefix + path)
+    
+    leaves, nodes = self._Index()[:2]
+    
+    return path in leaves or path in nodes
     
   def FormPath(self, *args):
     path = ""
@@ -237,63 +302,88 @@ class Stat:
   def SplitPath(self, path):
     return path.split(self._delimiter)
     
-  def Read(self, filename, includeMc = False, subsample = 1):
+  def _ParseRawS(self, s, includeMc = False):
     """
-    Read a .stat file
+    Convert a stat_parser style dictionary into the internal dictionary of this
+    Stat
     """
     
-    def ParseRawS(s, delimiter):    
-      newS = {}
-      for key1 in s.keys():
-        assert(not key1 in ["val", "value"])
-        if isinstance(s[key1], dict):
-          if len(s[key1].keys()) == 1 and s[key1].keys()[0] in ["val", "value"]:
-            newS[str(key1)] = s[key1][s[key1].keys()[0]]
-          else:
-            subS = ParseRawS(s[key1], delimiter)
-            newS[str(key1)] = {}
-            for key2 in subS.keys():
-              newS[str(key1)][str(key2)] = subS[key2]
-        else:        
-          rank = len(s[key1].shape)
-          if rank > 1:
-            assert(rank == 2)
-            if includeMc:
-              # Add in this vector
-              
-              # stat_parser gives this in an inconvenient matrix order. Take the
-              # transpose here to make life easier.
-              newS[str(key1)] = s[key1].transpose()
-              
-            # Add in the vector field components
-            for i in range(len(s[key1])):
-              newS[str(key1) + delimiter + str(i + 1)] = s[key1][i]
-          else:
-            try:
-              # Add in this scalar
-              newS[str(key1)] = s[key1]
-            except TypeError:
-              debug.deprint("Type error for data " + str(s[key1]), 0)
-              raise Exception("ParseRawS failure")
-            except ValueError:
-              debug.deprint("Value error for data " + str(s[key1]), 0)
-              raise Exception("ParseRawS failure")
-          
-      return newS
+    # Use raw dictionary access throughout, so that lazy entries are not read
+    newS = lazy_stat_dict()
+    for key1 in s.keys():
+      assert(not key1 in ["val", "value"])
+      item = dict.__getitem__(s, key1)
+      if isinstance(item, dict):
+        if len(item.keys()) == 1 and item.keys()[0] in ["val", "value"]:
+          newS[str(key1)] = dict.__getitem__(item, item.keys()[0])
+        else:
+          subS = self._ParseRawS(item, includeMc = includeMc)
+          newS[str(key1)] = lazy_stat_dict()
+          for key2 in subS.keys():
+            dict.__setitem__(newS[str(key1)], str(key2), dict.__getitem__(subS, key2))
+      elif isinstance(item, lazy_stat_value):
+        if item.components is None:
+          newS[str(key1)] = item
+        else:
+          if includeMc:
+            newS[str(key1)] = lazy_stat_value(item.stat, item.column, item.components, transpose = True)
+          for i in range(item.components):
+            newS[str(key1) + self._delimiter + str(i + 1)] = lazy_stat_value(item.stat, item.column + i)
+      else:        
+        rank = len(s[key1].shape)
+        if rank > 1:
+          assert(rank == 2)
+          if includeMc:
+            # Add in this vector
+            
+            # stat_parser gives this in an inconvenient matrix order. Take the
+            # transpose here to make life easier.
+            newS[str(key1)] = s[key1].transpose()
+            
+          # Add in the vector field components
+          for i in range(len(s[key1])):
+            newS[str(key1) + self._delimiter + str(i + 1)] = s[key1][i]
+        else:
+          try:
+            # Add in this scalar
+            newS[str(key1)] = s[key1]
+          except TypeError:
+            debug.deprint("Type error for data " + str(s[key1]), 0)
+            raise Exception("ParseRawS failure")
+          except ValueError:
+            debug.deprint("Value error for data " + str(s[key1]), 0)
+            raise Exception("ParseRawS failure")
         
+    return newS
+      
+  def Read(self, filename, includeMc = False, subsample = 1, lazy = False, follow = False):
+    """
+    Read a .stat file. If lazy is True, only the .stat header is parsed here. If
+    follow is True, the .stat may still be being written, and rows appended to it
+    can later be read with Refresh.
+    """
+    
     debug.dprint("Reading .stat file: " + filename)
     if filehandling.FileExists(filename + ".dat"):
       debug.dprint("Format: binary")
     else:
       debug.dprint("Format: plain text")
-    if subsample == 1:
+    if follow:
+      assert(subsample == 1)
+      statParser = stat_follower(filename)
+      self._follower = statParser
+      self._includeMc = includeMc
+    elif lazy:
+      statParser = lazy_stat_parser(filename, subsample = subsample)
+    elif subsample == 1:
       # Handle this case separately, as it's convenient to be backwards
       # compatible
       statParser = stat_parser(filename)
     else:
       statParser = stat_parser(filename, subsample = subsample)
 
-    self._s = ParseRawS(statParser, self._delimiter)
+    self._s = self._ParseRawS(statParser, includeMc = includeMc)
+    self._ResetIndex()
     
     if "ElapsedTime" in self.keys():
       t = self["ElapsedTime"]
@@ -304,11 +394,59 @@ class Stat:
     
     return
     
+  def Refresh(self):
+    """
+    Read any rows appended to a .stat read with follow = True since it was last
+    read, and return the number of new rows
+    """
+    
+    assert(not self._follower is None)
+    nNew = self._follower.refresh()
+    if nNew > 0:
+      self._s = self._ParseRawS(self._follower, includeMc = self._includeMc)
+      self._ResetIndex()
+    
+    return nNew
+    
+class JoinedStatValue(lazy_stat_value):
+  """
+  Placeholder for an entry in a joined Stat, which is joined from the entries in
+  the supplied (sorted) stats when first read
+  """
+  
+  def __init__(self, stats, endIndices, path):
+    self._stats = stats
+    self._endIndices = endIndices
+    self._path = path
+    
+    return
+    
+  def load(self):
+    template = None
+    for stat in self._stats:
+      if stat.HasPath(self._path):
+        template = stat[self._path]
+        break
+    assert(not template is None)
+    
+    arrays = []
+    for stat, endIndex in zip(self._stats, self._endIndices):
+      if stat.HasPath(self._path):
+        arrays.append(stat[self._path][:endIndex])
+      else:
+        arr = numpy.empty([endIndex] + list(template.shape[1:]), dtype = template.dtype)
+        arr[:] = calc.Nan()
+        arrays.append(arr)
+    
+    return numpy.concatenate(arrays).astype(template.dtype)
+    
 def JoinStat(*args):
   """
   Joins a series of stat files together. Useful for combining checkpoint .stat
   files. Selects data in later stat files over earlier stat files. Assumes
-  data in stat files are sorted by ElapsedTime.
+  data in stat files are sorted by ElapsedTime. Entries are only joined when
+  they are first read from the returned Stat, so only those entries are read
+  from lazy stats.
   """
 
   nStat = len(args)
@@ -323,13 +461,17 @@ def JoinStat(*args):
   
   endIndices = numpy.array([len(time) for time in times], dtype = int)
   for i, t in enumerate(times[:-1]):
-    for j, time in enumerate(t):
-      if calc.AlmostEquals(startT[i + 1], time, tolerance = 1.0e-6):
+    # Find the first time that is either almost equal to (with a relative
+    # tolerance of 1.0e-6), or later than, the start of the next stat
+    tolerance = 1.0e-6
+    if abs(startT[i + 1]) >= tolerance:
+      tolerance *= abs(startT[i + 1])
+    j = numpy.searchsorted(t, startT[i + 1] - tolerance, side = "right")
+    if j < len(t):
+      if abs(t[j] - startT[i + 1]) < tolerance:
         endIndices[i] = max(j - 1, 0)
-        break
-      elif startT[i + 1] < time:
+      else:
         endIndices[i] = j
-        break
   debug.dprint("Time ranges:")
   if len(times) > 0:
     for i in range(nStat): 
@@ -337,43 +479,19 @@ def JoinStat(*args):
   else:
     debug.dprint("No data")
     
-  dataIndices = numpy.empty(len(args) + 1, dtype = int)
-  dataIndices[0] = 0
-  for i, index in enumerate(endIndices):
-    dataIndices[i + 1] = dataIndices[i] + index
-    
-  stat = stats[0]
-  data = {}
-  for key in stat.keys():
-    arr = stat[key]
-    shape = list(arr.shape)
-    shape[0] = dataIndices[-1]
-    data[key] = numpy.empty(shape, dtype = arr.dtype)
-    data[key][:dataIndices[1]] = arr[:endIndices[0]]
-    data[key][dataIndices[1]:] = calc.Nan()
-  delimiter = stat.GetDelimiter()
-  
-  for i in range(1, nStat):
-    stat = stats[i]
-    for key in stat.keys(): 
-      arr = stat[key]
-      if not key in data:
-        shape = list(arr.shape)
-        shape[0] = dataIndices[-1]
-        data[key] = numpy.empty(shape, dtype = arr.dtype)
-        data[key][:dataIndices[i]] = calc.Nan()
-        data[key][dataIndices[i + 1]:] = calc.Nan()
-      data[key][dataIndices[i]:dataIndices[i + 1]] = arr[:endIndices[i]]
-  
-  output = Stat(delimiter = delimiter)
-  for key in data.keys():
-    output[key] = numpy.array(data[key])
+  output = Stat(delimiter = stats[0].GetDelimiter())
+  for stat in stats:
+    for key in stat.keys():
+      if not output.HasPath(key):
+        output[key] = JoinedStatValue(stats, endIndices, key)
   
   return output
                 
 def DetectorArrays(stat):
   """
-  Return a dictionary of detector array lists contained in the supplied stat
+  Return a dictionary of detector array lists contained in the supplied stat.
+  For .detectors files, detector_reader provides dense arrays directly from the
+  file header.
   """
   
   # Detector array data is divided in the stat into one path per array entry. We
@@ -382,8 +500,8 @@ def DetectorArrays(stat):
   
   # Find all detector array names and the paths for each entry in the array
   arrays = {}         # The arrays
-  notArrayNames = []  # List of candidate array names that are, in fact, not
-                      # detector array names
+  notArrayNames = set() # Candidate array names that are, in fact, not
+                        # detector array names
   for path in stat.PathLists():  
     if isinstance(stat[stat.FormPathFromList(path)], Stat):
       # This isn't a leaf node
@@ -463,16 +581,16 @@ def DetectorArrays(stat):
       # This isn't a valid index
       
       # This candidate array name isn't in fact a detector array
-      notArrayNames.append(arrayName)
+      notArrayNames.add(arrayName)
       if arrayName in arrays:
-        arrays.remove(arrayName)
+        del arrays[arrayName]
       continue
     if arrayName in arrays and index in arrays[arrayName]:
       # We've seen this index more than once for this array name
     
       # This candidate apparent array name isn't in fact a detector array
-      notArrayNames.append(arrayName)
-      arrays.remove(arrayName)
+      notArrayNames.add(arrayName)
+      del arrays[arrayName]
       continue
         
     if arrayName in arrays:
@@ -484,7 +602,7 @@ def DetectorArrays(stat):
   
   # Convert the dictionaries of data to lists, and check for consecutive
   # indices
-  for name in arrays:
+  for name in arrays.keys():
     array = arrays[name]
     indices = array.keys()
     data = [array[index] for index in indices]
@@ -496,7 +614,7 @@ def DetectorArrays(stat):
         # The indices are not consecutive from one. After all the hard work
         # above, we still have an array name that isn't in fact a detector
         # array.
-        arrays.remove(name)
+        del arrays[name]
         break
   
   # Fantastic! We have our detectors dictionary!
@@ -651,11 +769,99 @@ def FindPFilenames(basename, extension):
   return filenames
 
 class fluiditytoolsUnittests(unittest.TestCase):
+  def _StatHeader(self, constants = ""):
+    return "<header>\n" + \
+           "<constant name=\"FluidityVersion\" type=\"string\" value=\"test\" />\n" + \
+           constants + \
+           "<field column=\"1\" name=\"ElapsedTime\" statistic=\"value\" />\n" + \
+           "<field column=\"2\" name=\"Speed\" statistic=\"max\" material_phase=\"Fluid\" />\n" + \
+           "<field column=\"3\" name=\"Velocity\" statistic=\"max\" material_phase=\"Fluid\" components=\"2\" />\n" + \
+           "</header>\n"
+    
+  def _WriteAsciiStat(self, filename, rows):
+    handle = open(filename, "w")
+    handle.write(self._StatHeader())
+    for row in rows:
+      handle.write(utils.FormLine(row))
+    handle.close()
+    
+    return
+    
+  def _WriteBinaryStat(self, filename, rows):
+    handle = open(filename, "w")
+    handle.write(self._StatHeader( \
+      "<constant name=\"format\" type=\"string\" value=\"binary\" />\n" + \
+      "<constant name=\"real_size\" type=\"integer\" value=\"8\" />\n" + \
+      "<constant name=\"integer_size\" type=\"integer\" value=\"4\" />\n"))
+    handle.close()
+    numpy.array(rows, dtype = numpy.float64).tofile(filename + ".dat")
+    
+    return
+    
   def testFluidityToolsSupport(self):
     import fluidity_tools
     
     return
     
+  def testStatParserAscii(self):
+    tempDir = tempfile.mkdtemp()
+    filename = os.path.join(tempDir, "test.stat")
+    self._WriteAsciiStat(filename, [[float(i), 2.0 * i, 3.0 * i, -3.0 * i] for i in range(10)])
+    
+    s = stat_parser(filename)
+    self.assertEquals(s["ElapsedTime"]["value"].shape, (10,))
+    self.assertAlmostEquals(s["ElapsedTime"]["value"][-1], 9.0)
+    self.assertAlmostEquals(s["Fluid"]["Speed"]["max"][3], 6.0)
+    self.assertEquals(s["Fluid"]["Velocity"]["max"].shape, (2, 10))
+    self.assertAlmostEquals(s["Fluid"]["Velocity"]["max"][1][4], -12.0)
+    
+    s = stat_parser(filename, subsample = 3)
+    self.assertEquals(list(s["ElapsedTime"]["value"]), [0.0, 3.0, 6.0, 9.0])
+    
+    # Small blocks, to exercise growing the preallocated array
+    handle = open(filename, "r")
+    while not "</header>" in handle.readline():
+      pass
+    columns = parse_stat_ascii_data(handle, 4, subsample = 2, chunkBytes = 1)
+    handle.close()
+    self.assertEquals(columns.shape, (4, 5))
+    self.assertEquals(list(columns[0]), [0.0, 2.0, 4.0, 6.0, 8.0])
+    
+    self._WriteAsciiStat(filename, [[0.0, 1.0, 2.0, 3.0], [1.0, 2.0]])
+    self.assertRaises(Exception, stat_parser, filename)
+    
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
+    
+  def testLazyStatParser(self):
+    tempDir = tempfile.mkdtemp()
+    rows = [[float(i), 2.0 * i, 3.0 * i, -3.0 * i] for i in range(10)]
+    for i, write in enumerate([self._WriteAsciiStat, self._WriteBinaryStat]):
+      filename = os.path.join(tempDir, "test" + str(i) + ".stat")
+      write(filename, rows)
+      
+      s = lazy_stat_parser(filename)
+      self.assertEquals(len(s.stat._cache), 0)
+      self.assertAlmostEquals(s["Fluid"]["Speed"]["max"][3], 6.0)
+      self.assertEquals(s.stat._cache.keys(), [1])
+      self.assertEquals(s["Fluid"]["Velocity"]["max"].shape, (2, 10))
+      self.assertAlmostEquals(s["Fluid"]["Velocity"]["max"][1][4], -12.0)
+      self.assertEquals(len(s.stat._cache), 3)
+      
+      s = lazy_stat_parser(filename, subsample = 3)
+      self.assertEquals(list(s["ElapsedTime"]["value"])[:3], [0.0, 3.0, 6.0])
+      
+      stat = Stat(filename, includeMc = True, lazy = True)
+      self.assertTrue(stat.HasPath("Fluid%Velocity%max%2"))
+      self.assertEquals(stat["Fluid%Velocity%max"].shape, (10, 2))
+      self.assertAlmostEquals(stat["Fluid%Velocity%max%2"][4], -12.0)
+      self.assertEquals(len(stat.Paths()), 5)
+    
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
+    
   def testSplitVtuFilename(self):
     project, id, ext = SplitVtuFilename("project_0.vtu")
     self.assertEquals(project, "project")
@@ -679,6 +885,199 @@ class fluiditytoolsUnittests(unittest.TestCase):
     
     return
     
+  def testStatFollower(self):
+    tempDir = tempfile.mkdtemp()
+    rows = [[float(i), 2.0 * i, 3.0 * i, -3.0 * i] for i in range(10)]
+    
+    # Plain text, with a partially written final row
+    filename = os.path.join(tempDir, "test0.stat")
+    self._WriteAsciiStat(filename, rows[:4])
+    handle = open(filename, "a")
+    handle.write("4.0 8.0")
+    handle.close()
+    stat = Stat(filename, follow = True)
+    self.assertEquals(stat["ElapsedTime"].shape, (4,))
+    self.assertEquals(stat.Refresh(), 0)
+    handle = open(filename, "a")
+    handle.write(" 12.0 -12.0\n")
+    for row in rows[5:]:
+      handle.write(utils.FormLine(row))
+    handle.close()
+    self.assertEquals(stat.Refresh(), 6)
+    self.assertEquals(list(stat["ElapsedTime"]), [float(i) for i in range(10)])
+    self.assertAlmostEquals(stat["Fluid%Velocity%max%2"][4], -12.0)
+    
+    # Binary, with a partially written final row
+    filename = os.path.join(tempDir, "test1.stat")
+    self._WriteBinaryStat(filename, rows[:3])
+    handle = open(filename + ".dat", "ab")
+    numpy.array(rows[3][:2], dtype = numpy.float64).tofile(handle)
+    handle.close()
+    s = stat_follower(filename)
+    self.assertEquals(s.nRows, 3)
+    handle = open(filename + ".dat", "ab")
+    numpy.array(rows[3][2:] + rows[4], dtype = numpy.float64).tofile(handle)
+    handle.close()
+    self.assertEquals(s.refresh(), 2)
+    self.assertEquals(list(s["Fluid"]["Speed"]["max"]), [0.0, 2.0, 4.0, 6.0, 8.0])
+    
+    # Restarted
+    self._WriteBinaryStat(filename, rows[:2])
+    self.assertEquals(s.refresh(), 2)
+    self.assertEquals(s["ElapsedTime"]["value"].shape, (2,))
+    
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
+    
+  def testStatCreator(self):
+    tempDir = tempfile.mkdtemp()
+    
+    filename = os.path.join(tempDir, "test0.stat")
+    c = stat_creator(filename)
+    c.add_constant({"time": 1.0})
+    for i in range(3):
+      c[("ElapsedTime", "value")] = float(i)
+      c[("Fluid", "Speed", "max")] = 0.1 * i
+      c.write()
+    s = stat_parser(filename)
+    self.assertEquals(list(s["ElapsedTime"]["value"]), [0.0, 1.0, 2.0])
+    self.assertEquals(s["Fluid"]["Speed"]["max"][1], 0.1)
+    c.close()
+    
+    for realSize in [4, 8]:
+      filename = os.path.join(tempDir, "test" + str(realSize) + ".stat")
+      with stat_creator(filename, binary = True, real_size = realSize, buffer_rows = 16) as c:
+        c.write_rows({("ElapsedTime", "value"): numpy.arange(10.0), ("Fluid", "Speed", "max"): 2.0 * numpy.arange(10.0)})
+        c.write_rows({("ElapsedTime", "value"): [10.0], ("Fluid", "Speed", "max"): [20.0]})
+        c[("ElapsedTime", "value")] = 11.0
+        c[("Fluid", "Speed", "max")] = 22.0
+        c.write()
+        self.assertEquals(os.path.getsize(filename + ".dat"), 0)
+        c.flush()
+        self.assertEquals(os.path.getsize(filename + ".dat"), 12 * 2 * realSize)
+      self.assertEquals(stat_header(filename).real_size, realSize)
+      s = stat_parser(filename)
+      self.assertEquals(list(s["ElapsedTime"]["value"]), [float(i) for i in range(12)])
+      self.assertEquals(s["Fluid"]["Speed"]["max"][-1], 22.0)
+    
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
+    
+  def testStatPaths(self):
+    stat = Stat()
+    stat["ElapsedTime"] = numpy.arange(3.0)
+    stat["Fluid%Speed%max"] = numpy.ones(3)
+    self.assertEquals(len(stat.Paths()), 2)
+    stat["Fluid%Velocity%max%1"] = numpy.zeros(3)
+    self.assertEquals(len(stat.Paths()), 3)
+    self.assertTrue(stat.HasPath("Fluid%Velocity"))
+    self.assertFalse(stat.HasPath("Fluid%Pressure"))
+    self.assertRaises(Exception, stat.__getitem__, "Fluid%Pressure")
+    
+    fluid = stat["Fluid"]
+    self.assertTrue(isinstance(fluid, Stat))
+    self.assertEquals(sorted(fluid.Paths()), ["Speed%max", "Velocity%max%1"])
+    self.assertEquals(sorted(fluid.PathLists()), [["Speed", "max"], ["Velocity", "max", "1"]])
+    self.assertEquals(fluid["Velocity%max%1"].shape, (3,))
+    self.assertEquals(stat["Fluid"]["Velocity"]["max%1"].shape, (3,))
+    
+    # Setting through a view updates the parent
+    fluid["Speed%min"] = numpy.zeros(3)
+    self.assertTrue(stat.HasPath("Fluid%Speed%min"))
+    self.assertEquals(len(fluid.Paths()), 3)
+    stat["Fluid%Speed%max"] = 2.0 * numpy.ones(3)
+    self.assertEquals(fluid["Speed%max"][0], 2.0)
+    self.assertEquals(len(stat.Paths()), 4)
+    
+    return
+    
+  def testJoinStat(self):
+    stat1 = Stat()
+    stat1["ElapsedTime"] = numpy.arange(0.0, 5.0)
+    stat1["Fluid%Speed%max"] = numpy.arange(0.0, 5.0)
+    stat2 = Stat()
+    stat2["ElapsedTime"] = numpy.arange(3.5, 8.0)
+    stat2["Fluid%Speed%max"] = numpy.arange(3.5, 8.0)
+    stat2["Fluid%Speed%min"] = numpy.zeros(5)
+    stat3 = Stat()
+    stat3["ElapsedTime"] = numpy.arange(6.0, 9.0)
+    stat3["Fluid%Speed%max"] = numpy.arange(6.0, 9.0)
+    
+    stat = JoinStat(stat3, stat1, stat2)
+    self.assertEquals(list(stat["ElapsedTime"]), [0.0, 1.0, 2.0, 3.0, 3.5, 4.5, 5.5, 6.0, 7.0, 8.0])
+    self.assertEquals(list(stat["Fluid%Speed%max"]), list(stat["ElapsedTime"]))
+    min = stat["Fluid%Speed%min"]
+    self.assertEquals(min.shape, (10,))
+    self.assertTrue(calc.IsNan(min[0]))
+    self.assertEquals(min[4], 0.0)
+    self.assertTrue(calc.IsNan(min[-1]))
+    
+    # Only the entries read are joined
+    tempDir = tempfile.mkdtemp()
+    filenames = [os.path.join(tempDir, "test" + str(i) + ".stat") for i in range(2)]
+    self._WriteBinaryStat(filenames[0], [[float(i), 2.0 * i, 3.0 * i, -3.0 * i] for i in range(6)])
+    self._WriteAsciiStat(filenames[1], [[i + 0.5, 2.0 * i, 3.0 * i, -3.0 * i] for i in range(4, 10)])
+    stats = [Stat(filename, lazy = True) for filename in filenames]
+    stat = JoinStat(*stats)
+    self.assertEquals(list(stat["Fluid%Speed%max"]), [2.0 * i for i in range(5) + range(4, 10)])
+    for subStat in stats:
+      self.assertTrue(isinstance(dict.__getitem__(subStat._s["Fluid"]["Velocity"], "max%1"), lazy_stat_value))
+    
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
+    
+  def testDetectorReader(self):
+    tempDir = tempfile.mkdtemp()
+    header = "<header>\n" + \
+             "<constant name=\"FluidityVersion\" type=\"string\" value=\"test\" />\n%s" + \
+             "<field column=\"1\" name=\"ElapsedTime\" statistic=\"value\" />\n" + \
+             "<field column=\"2\" name=\"dt\" statistic=\"value\" />\n"
+    column = 3
+    names = ["Point"] + ["Tracers_" + str(i + 1) for i in range(3)]
+    for name in names:
+      header += "<field column=\"%i\" name=\"%s\" statistic=\"position\" components=\"2\" />\n" % (column, name)
+      column += 2
+    for name in names:
+      header += "<field column=\"%i\" name=\"Temperature\" statistic=\"%s\" material_phase=\"Fluid\" />\n" % (column, name)
+      column += 1
+    header += "</header>\n"
+    nColumns = column - 1
+    data = numpy.array([[float(i * nColumns + j) for j in range(nColumns)] for i in range(5)])
+    
+    for binary in [False, True]:
+      filename = os.path.join(tempDir, "test" + str(binary) + ".detectors")
+      handle = open(filename, "w")
+      if binary:
+        handle.write(header % ("<constant name=\"format\" type=\"string\" value=\"binary\" />\n" + \
+                               "<constant name=\"real_size\" type=\"integer\" value=\"8\" />\n"))
+        data.tofile(filename + ".dat")
+      else:
+        handle.write(header % "")
+        for row in data:
+          handle.write(utils.FormLine(row))
+      handle.close()
+      
+      d = detector_reader(filename)
+      self.assertEquals(d.detector_names, names)
+      self.assertEquals(d.arrays.keys(), ["Tracers"])
+      self.assertEquals(list(d.elapsed_time()), list(data[:, 0]))
+      positions = d.positions()
+      self.assertEquals(positions.shape, (5, 4, 2))
+      self.assertEquals(positions[2, 1, 1], data[2, 5])
+      positions = d.positions("Tracers", times = slice(1, None, 2))
+      self.assertEquals(positions.shape, (2, 3, 2))
+      self.assertEquals(positions[1, 2, 0], data[3, 8])
+      temperature = d.field("Fluid", "Temperature", ["Tracers_3", "Point"], times = [0, 4])
+      self.assertEquals(temperature.shape, (2, 2))
+      self.assertEquals(list(temperature[1]), [data[4, 13], data[4, 10]])
+    
+    filehandling.Rmdir(tempDir, force = True)
+    
+    return
+    
   def testFindVtuFilenames(self):
     tempDir = tempfile.mkdtemp()
     project = os.path.join(tempDir, "project")
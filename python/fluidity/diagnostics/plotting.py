@@ -23,6 +23,12 @@ import tempfile
 import unittest
 
 import fluidity.diagnostics.debug as debug
+
+try:
+  import numpy
+except ImportError:
+  debug.deprint("Warning: Failed to import numpy module")
+
 import fluidity.diagnostics.gui as gui
 import fluidity.diagnostics.utils as utils
 
@@ -254,6 +260,125 @@ class LinePlot(ScatterPlot):
    
     return    
     
+class DecimatedSeries:
+  """
+  Min/max envelope decimation of a line series, for plotting very long series.
+  The data in a visible x range are reduced to the minimum and maximum y values
+  in each of around width buckets (for a plot width pixels wide), so that peaks
+  are kept. Bucket extrema are cached in a pyramid of levels, each halving the
+  resolution of the last, so that re-decimating on zoom is cheap.
+  """
+  
+  # The finest cached level has buckets of 2 ** _baseLevel points
+  _baseLevel = 3
+  
+  def __init__(self, x, y):
+    assert(len(x) == len(y))
+    
+    self._x = numpy.asarray(x)
+    self._y = numpy.asarray(y)
+    assert(len(self._y.shape) == 1)
+    # Visible x ranges can only be located if x is sorted
+    self._sorted = len(self._x) < 2 or numpy.all(self._x[1:] >= self._x[:-1])
+    self._levels = []
+    
+    return
+    
+  def _NanArg(self, arg, blocks):
+    """
+    Apply the supplied numpy.nanargmin or numpy.nanargmax to each row of blocks.
+    Rows that are entirely NaN, for which these raise a ValueError, give index
+    zero.
+    """
+    
+    allNan = numpy.all(numpy.isnan(blocks), axis = 1)
+    if numpy.any(allNan):
+      blocks = blocks.copy()
+      blocks[allNan, :] = 0.0
+      
+    return arg(blocks, axis = 1)
+    
+  def _Level(self, level):
+    """
+    Return the (minimum index, maximum index) arrays for the buckets of the
+    supplied level
+    """
+  
+    assert(level >= self._baseLevel)
+    
+    if len(self._levels) == 0:
+      bucket = 2 ** self._baseLevel
+      nFull = len(self._y) / bucket
+      blocks = self._y[:nFull * bucket].reshape((nFull, bucket))
+      offsets = numpy.arange(nFull) * bucket
+      minIndices = self._NanArg(numpy.nanargmin, blocks) + offsets
+      maxIndices = self._NanArg(numpy.nanargmax, blocks) + offsets
+      if nFull * bucket < len(self._y):
+        tail = self._y[nFull * bucket:].reshape((1, len(self._y) - nFull * bucket))
+        minIndices = numpy.append(minIndices, self._NanArg(numpy.nanargmin, tail) + nFull * bucket)
+        maxIndices = numpy.append(maxIndices, self._NanArg(numpy.nanargmax, tail) + nFull * bucket)
+      self._levels.append((minIndices, maxIndices))
+      
+    while len(self._levels) <= level - self._baseLevel:
+      minIndices, maxIndices = self._levels[-1]
+      if len(minIndices) <= 1:
+        break
+      # Comparisons with NaN are False, so a NaN extremum is replaced by any
+      # other value
+      with numpy.errstate(invalid = "ignore"):
+        a, b = minIndices[0::2], minIndices[1::2]
+        if len(b) < len(a):
+          b = numpy.append(b, a[-1])
+        minIndices = numpy.where(numpy.logical_or(self._y[b] < self._y[a], numpy.isnan(self._y[a])), b, a)
+        a, b = maxIndices[0::2], maxIndices[1::2]
+        if len(b) < len(a):
+          b = numpy.append(b, a[-1])
+        maxIndices = numpy.where(numpy.logical_or(self._y[b] > self._y[a], numpy.isnan(self._y[a])), b, a)
+      self._levels.append((minIndices, maxIndices))
+      
+    level = min(level, self._baseLevel + len(self._levels) - 1)
+    
+    return level, self._levels[level - self._baseLevel]
+    
+  def Decimate(self, xMin = None, xMax = None, width = 1024):
+    """
+    Return decimated x and y data for the supplied visible x range, with around
+    two points per unit of width
+    """
+    
+    if not self._sorted:
+      # Buckets of consecutive points are not local in x, so an envelope of
+      # them would misrepresent the data
+      return self._x, self._y
+    
+    n = len(self._x)
+    if xMin is None:
+      start = 0
+    else:
+      start = max(numpy.searchsorted(self._x, xMin, side = "left") - 1, 0)
+    if xMax is None:
+      end = n
+    else:
+      end = min(numpy.searchsorted(self._x, xMax, side = "right") + 1, n)
+    width = max(width, 1)
+    
+    if end - start <= 4 * width:
+      return self._x[start:end], self._y[start:end]
+      
+    level = max(int(numpy.log2(float(end - start) / width)), self._baseLevel)
+    level, (minIndices, maxIndices) = self._Level(level)
+    startBucket = start >> level
+    endBucket = ((end - 1) >> level) + 1
+    minIndices = minIndices[startBucket:endBucket]
+    maxIndices = maxIndices[startBucket:endBucket]
+    
+    # Two points per bucket, in index order
+    indices = numpy.empty(2 * len(minIndices), dtype = minIndices.dtype)
+    indices[0::2] = numpy.minimum(minIndices, maxIndices)
+    indices[1::2] = numpy.maximum(minIndices, maxIndices)
+    
+    return self._x[indices], self._y[indices]
+    
 class ContourPlot(Plot):
   """
   A pylab contour plot
@@ -309,6 +434,45 @@ class plottingUnittests(unittest.TestCase):
     
     return
     
+  def testDecimatedSeries(self):
+    x = numpy.arange(100000.0)
+    y = numpy.sin(x / 1000.0)
+    y[12345] = 10.0
+    y[54321] = -10.0
+    series = DecimatedSeries(x, y)
+    
+    xDec, yDec = series.Decimate(width = 100)
+    self.assertTrue(len(xDec) <= 4 * 100)
+    self.assertTrue(numpy.all(xDec[1:] >= xDec[:-1]))
+    self.assertEquals(yDec.max(), 10.0)
+    self.assertEquals(yDec.min(), -10.0)
+    self.assertEquals(xDec[0], 0.0)
+    self.assertEquals(xDec[-1], 99999.0)
+    
+    # Zoom in
+    xDec, yDec = series.Decimate(12000.0, 13000.0, width = 100)
+    self.assertTrue(len(xDec) <= 4 * 100)
+    self.assertTrue(xDec[0] <= 12000.0 and xDec[-1] >= 13000.0)
+    self.assertEquals(yDec.max(), 10.0)
+    
+    xDec, yDec = series.Decimate(12340.0, 12350.0, width = 100)
+    self.assertEquals(list(xDec), list(x[12339:12352]))
+    
+    # NaNs, including an all-NaN bucket, are skipped
+    y[20000:20100] = numpy.nan
+    y[60001] = numpy.nan
+    series = DecimatedSeries(x, y)
+    xDec, yDec = series.Decimate(width = 100)
+    self.assertEquals(numpy.nanmax(yDec), 10.0)
+    self.assertEquals(numpy.nanmin(yDec), -10.0)
+    
+    # Unsorted x is not decimated
+    series = DecimatedSeries(x[::-1], y)
+    xDec, yDec = series.Decimate(width = 100)
+    self.assertEquals(len(xDec), len(x))
+    
+    return
+    
   def testContourPlot(self):
     plot = ContourPlot([0.0, 1.0], [1.0, 2.0], [[2.0, 3.0], [4.0, 5.0]])
     
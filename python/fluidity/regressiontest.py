@@ -9,6 +9,15 @@ import time
 import glob
 import threading
 import traceback
+import subprocess
+import multiprocessing
+import resource
+import sqlite3
+import signal
+import errno
+import shutil
+import tempfile
+import unittest
 
 try:
     from junit_xml import TestCase
@@ -22,13 +31,16 @@ except ImportError:
 
 class TestProblem:
     """A test records input information as well as tests for the output."""
-    def __init__(self, filename, verbose=False, replace=None, genpbs=False):
-        """Read a regression test from filename and record its details."""
+    def __init__(self, filename, verbose=False, replace=None, genpbs=False, env=None):
+        """Read a regression test from filename and record its details.
+        Commands are run with the environment env, or that of this process if
+        env is None."""
         self.name = ""
         self.command = replace
         self.command_line = ""
         self.length = ""
         self.nprocs = 1
+        self.timeout = None
         self.verbose = verbose
         self.variables = []
         self.pass_tests = []
@@ -36,10 +48,16 @@ class TestProblem:
         self.pass_status = []
         self.warn_status = []
         self.filename = filename.split('/')[-1]
+        self.directory = os.path.dirname(os.path.abspath(filename))
         self.genpbs = genpbs
+        self.env = env
         self.xml_reports=[]
-        # add dir to import path
-        sys.path.insert(0, os.path.dirname(filename))
+        # resources used by the simulation, set by the harness
+        self.usage = None
+        self.output_cache = None
+        # the key under which the results are stored in the harness's result
+        # cache, if they are to be
+        self.result_key = None
 
         dom = xml.dom.minidom.parse(filename)
     
@@ -56,6 +74,8 @@ class TestProblem:
             elif tag == "problem_definition":
                 self.length = child.getAttribute("length")
                 self.nprocs = int(child.getAttribute("nprocs"))
+                if child.hasAttribute("timeout"):
+                  self.timeout = float(child.getAttribute("timeout"))
                 xmlcmd = child.getElementsByTagName("command_line")[0].childNodes[0].nodeValue
                 if self.command is not None:
                   self.command_line = self.command(xmlcmd)
@@ -97,10 +117,15 @@ class TestProblem:
 
         self.random = str
 
+    def call(self, cmd, dir):
+        """Run the shell command cmd in the directory dir, without changing the
+        working directory of this process, and return its exit status."""
+        return subprocess.call(cmd, shell=True, cwd=dir, env=self.env)
+
     def call_genpbs(self, dir):
         cmd = "genpbs \"" + self.filename[:-4] + "\" \"" + self.command_line + "\" \"" + str(self.nprocs) + "\" \"" + self.random + "\""
         self.log("cd "+dir+"; "+cmd)
-        ret = os.system("cd "+dir+"; "+cmd)
+        ret = self.call(cmd, dir)
 
         if ret != 0: 
             self.log("Calling genpbs failed.")
@@ -117,13 +142,16 @@ class TestProblem:
         else:
             return True
 
-    def clean(self):
+    def clean(self, dir=None):
         self.log("Cleaning")
 
+        if dir is None:
+          dir = self.directory
+
         try:
-          os.stat("Makefile")
+          os.stat(os.path.join(dir, "Makefile"))
           self.log("Calling 'make clean':")
-          ret = os.system("make clean")
+          ret = self.call("make clean", dir)
           if not ret == 0:
             self.log("No clean target")
         except OSError:
@@ -133,13 +161,12 @@ class TestProblem:
         self.log("Running")
 
         run_time=0.0
-        start_time=time.clock()
         wall_time=time.time()
 
         try:
           os.stat(dir+"/Makefile")
           self.log("Calling 'make input':")
-          ret = os.system("cd "+dir+"; make input")
+          ret = self.call("make input", dir)
           assert ret == 0
         except OSError:
           self.log("No Makefile, not calling make")
@@ -147,11 +174,12 @@ class TestProblem:
         if self.genpbs:
             ret = self.call_genpbs(dir)
             self.log("cd "+dir+"; qsub " + self.filename[:-4] + ".pbs: " + self.command_line)
-            os.system("cd "+dir+"; qsub " + self.filename[:-4] + ".pbs")
+            self.call("qsub " + self.filename[:-4] + ".pbs", dir)
         else:
           self.log(self.command_line)
-          os.system("cd "+dir+"; "+self.command_line)
-          run_time=time.clock()-start_time
+          start_time=time.time()
+          self.call(self.command_line, dir)
+          run_time=time.time()-start_time
 
         self.xml_reports.append(TestCase(self.name,
                                             '%s.%s'%(self.length,
@@ -160,9 +188,9 @@ class TestProblem:
 
         return run_time
         
-    def fl_logs(self, nLogLines = None):
-      logs = glob.glob("fluidity.log*")
-      errLogs = glob.glob("fluidity.err*")
+    def fl_logs(self, nLogLines = None, dir = "."):
+      logs = glob.glob(os.path.join(dir, "fluidity.log*"))
+      errLogs = glob.glob(os.path.join(dir, "fluidity.err*"))
       
       if nLogLines is None or nLogLines > 0:
         for filename in logs:
@@ -181,7 +209,38 @@ class TestProblem:
       
       return
 
+    def fl_timesteps(self, dir = "."):
+      """Return the number of timesteps recorded in the first fluidity log in
+      dir, or None if there is no log or it records none. Timesteps are counted
+      from the "*** NEW TIMESTEP ***" lines, which fluidity only writes to its
+      log at verbosity 1 and above, so tests run with less verbose logging
+      report None."""
+      logs = sorted(glob.glob(os.path.join(dir, "fluidity.log*")))
+      if len(logs) == 0:
+        return None
+
+      timesteps = 0
+      for line in open(logs[0], "r"):
+        if "*** NEW TIMESTEP ***" in line:
+          timesteps += 1
+      if timesteps == 0:
+        return None
+      return timesteps
+
     def test(self):
+        """Run the variables and tests. While they run, .stat and .vtu files
+        read through stat_parser and vtktools.vtu, or the load_stat and load_vtu
+        functions available to python variables and tests, are cached for this
+        test problem, so that each output file is only parsed once."""
+        if self.output_cache is None:
+            self.output_cache = OutputCache()
+        self.output_cache.install()
+        try:
+            return self.run_tests()
+        finally:
+            self.output_cache.uninstall()
+
+    def run_tests(self):
         def Trim(string):
           if len(string) > 4096:
             return string[:4096] + " ..."
@@ -193,7 +252,7 @@ class TestProblem:
         for var in self.variables:
             tmpdict  = {}
             try:
-              var.run(tmpdict)
+              var.run(tmpdict, self.output_cache.loaders())
             except:
               self.log("failure.")
               self.pass_status.append('F')
@@ -206,7 +265,7 @@ class TestProblem:
             self.log("Running failure tests: ")
             for test in self.pass_tests:
                 self.log("Running %s:" % test.name)
-                status = test.run(varsdict)
+                status = test.run(varsdict, self.output_cache.loaders())
                 tc=TestCase(test.name,
                             '%s.%s'%(self.length,
                                      self.filename[:-4]))
@@ -227,7 +286,7 @@ class TestProblem:
             self.log("Running warning tests: ")
             for test in self.warn_tests:
                 self.log("Running %s:" % test.name)
-                status = test.run(varsdict)
+                status = test.run(varsdict, self.output_cache.loaders())
                 if status == True:
                     self.log("success.")
                     self.warn_status.append('P')
@@ -241,6 +300,134 @@ class TestProblem:
         self.log(''.join(self.pass_status + self.warn_status))
         return self.pass_status + self.warn_status
 
+class OutputCache:
+    """Memoising loaders for simulation output, shared by the variables and
+    tests of a test problem. Results are cached by path and arguments, and
+    reloaded if the file has been modified. Cached objects are shared, so
+    changes made to them by one variable or test are seen by the others."""
+    def __init__(self):
+        self.cache = {}
+        self.installed = []
+
+    def key(self, paths, *args):
+        key = args
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key += (os.path.abspath(path), stat.st_mtime, stat.st_size)
+        return key
+
+    def load_stat(self, path, *args, **kwargs):
+        """Return fluidity_tools.stat_parser(path, ...), parsing path only once."""
+        import fluidity_tools
+        key = self.key([path, path + ".dat"], "stat", args, tuple(sorted(kwargs.items())))
+        try:
+            return self.cache[key]
+        except KeyError:
+            stat = self.create(fluidity_tools, "stat_parser", path, *args, **kwargs)
+            self.cache[key] = stat
+            return stat
+
+    def load_vtu(self, path=None, fields=None):
+        """Return vtktools.vtu(path, fields=fields), reading path only once.
+        A vtu already read with all its fields is also returned for requests
+        for some of them."""
+        import vtktools
+        if path is None:
+            return self.create(vtktools, "vtu")
+        key = self.key([path], "vtu")
+        try:
+            return self.cache[key + (None,)]
+        except KeyError:
+            pass
+        if not fields is None:
+            fields = tuple(sorted(fields))
+        try:
+            return self.cache[key + (fields,)]
+        except KeyError:
+            vtu = self.create(vtktools, "vtu", path, fields=fields)
+            self.cache[key + (fields,)] = vtu
+            return vtu
+
+    def original(self, module, name):
+        """Return module.name as it was before install."""
+        for (m, n, value, cached) in self.installed:
+            if m is module and n == name:
+                return value
+        return getattr(module, name)
+
+    def create(self, module, name, *args, **kwargs):
+        """Construct a new module.name(*args, **kwargs), bypassing the cache.
+        While installed, the object is an instance of the installed class."""
+        for (m, n, value, cached) in self.installed:
+            if m is module and n == name:
+                return cached.create_uncached(*args, **kwargs)
+        return getattr(module, name)(*args, **kwargs)
+
+    def cached_class(self, base, load):
+        """Return a subclass of base, constructing which with arguments returns
+        the shared object from load(*args, **kwargs). Objects are created as
+        instances of the subclass, so isinstance checks against it still work,
+        and subclasses of it are constructed as normal."""
+        class Cached(base, object):
+            __doc__ = base.__doc__
+
+            def __new__(cls, *args, **kwargs):
+                # construction without arguments is also used by copy and
+                # pickle, and is not cached
+                if cls is Cached and (len(args) > 0 or len(kwargs) > 0):
+                    return load(*args, **kwargs)
+                return super(Cached, cls).__new__(cls)
+
+            def __init__(self, *args, **kwargs):
+                # objects returned by load are already initialised
+                if not getattr(self, "_output_cache_loaded", False):
+                    base.__init__(self, *args, **kwargs)
+
+            @classmethod
+            def create_uncached(cls, *args, **kwargs):
+                obj = super(Cached, cls).__new__(cls)
+                base.__init__(obj, *args, **kwargs)
+                obj._output_cache_loaded = True
+                return obj
+
+        Cached.__name__ = base.__name__
+        Cached.__module__ = base.__module__
+        return Cached
+
+    def loaders(self):
+        """Return the loaders, by the names they have in python variables and
+        tests."""
+        return {"load_stat": self.load_stat, "load_vtu": self.load_vtu}
+
+    def install(self):
+        """Replace the fluidity_tools.stat_parser and vtktools.vtu classes,
+        where available, by subclasses that construct through the memoising
+        loaders."""
+        try:
+            import fluidity_tools
+            self.replace(fluidity_tools, "stat_parser", self.load_stat)
+        except ImportError:
+            pass
+        try:
+            import vtktools
+            self.replace(vtktools, "vtu", self.load_vtu)
+        except ImportError:
+            pass
+
+    def replace(self, module, name, load):
+        value = getattr(module, name)
+        cached = self.cached_class(value, load)
+        self.installed.append((module, name, value, cached))
+        setattr(module, name, cached)
+
+    def uninstall(self):
+        for (module, name, value, cached) in self.installed:
+            setattr(module, name, value)
+        self.installed = []
+
 class TestOrVariable:
     """Tests and variables have a lot in common. This code unifies the commonalities."""
     def __init__(self, name, language, code):
@@ -248,8 +435,12 @@ class TestOrVariable:
         self.language = language
         self.code = code
 
-    def run(self, varsdict):
+    def run(self, varsdict, loaders={}):
+        """Run the code with the variables in varsdict. Python code can also
+        use the functions in loaders."""
         func = getattr(self, "run_" + self.language)
+        if self.language == "python":
+            return func(varsdict, loaders)
         return func(varsdict)
 
 class Test(TestOrVariable):
@@ -264,8 +455,9 @@ class Test(TestOrVariable):
         if retcode == 0: return True
         else: return False
     
-    def run_python(self, varsdict):
+    def run_python(self, varsdict, loaders={}):
         tmpdict = copy.copy(varsdict)
+        tmpdict.update(loaders)
         try:
           exec self.code in tmpdict
           return True
@@ -286,7 +478,8 @@ class Variable(TestOrVariable):
         if self.name not in varsdict.keys():
             raise Exception
 
-    def run_python(self, varsdict):
+    def run_python(self, varsdict, loaders={}):
+        varsdict.update(loaders)
         try:
             exec self.code in varsdict
         except:
@@ -305,6 +498,168 @@ class Variable(TestOrVariable):
             print "self.name not found: does the variable define the right name?"
             raise Exception
 
+class TestProcessError(Exception):
+    """An exception raised in a TestProcess, carrying the formatted traceback
+    from the child process."""
+    pass
+
+class TestProcessTimeout(TestProcessError):
+    """Raised by TestProcess.result if the process was killed for running too
+    long."""
+    pass
+
+def _test_process_main(sender, target, args):
+    # run in a new process group, so that everything started by target can be
+    # killed together
+    os.setpgrp()
+    try:
+        result = ("result", target(*args))
+    except:
+        result = ("error", traceback.format_exc())
+    sender.send(result)
+    sender.close()
+
+class TestProcess:
+    """Runs target(*args) in a child process, and collects its return value
+    like a future. The child is forked, so target and args need not be
+    picklable, but the return value must be. Instances may be passed to
+    select.select to wait for any of several processes to finish."""
+    def __init__(self, target, args=()):
+        self.receiver, self.sender = multiprocessing.Pipe(duplex=False)
+        self.process = multiprocessing.Process(target=_test_process_main,
+                                               args=(self.sender, target, args))
+        self.completed = False
+        self.usage = None
+
+    def start(self):
+        self.started = time.time()
+        self.process.start()
+        # only the child writes to the pipe, so that reading hits end of file
+        # if the child dies without sending a result
+        self.sender.close()
+
+    def fileno(self):
+        return self.receiver.fileno()
+
+    def done(self):
+        return self.completed or self.receiver.poll()
+
+    def result(self):
+        """Wait for the child process, and return the value returned by target,
+        or raise TestProcessError if it raised an exception."""
+        if not self.completed:
+            try:
+                self.outcome = self.receiver.recv()
+            except EOFError:
+                self.outcome = ("error", "Test process exited without a result")
+            self.receiver.close()
+            self.process.join()
+            self.completed = True
+
+        kind, value = self.outcome
+        if kind == "error":
+            raise TestProcessError(value)
+        elif kind == "timeout":
+            raise TestProcessTimeout(value)
+        return value
+
+    def terminate(self, grace=10.0):
+        """Kill the child process and everything in its process group, with
+        SIGTERM and then, after grace seconds, SIGKILL. result() then raises
+        TestProcessTimeout. Returns, and records as usage, the wall time and
+        CPU time, in seconds, and the peak resident set size, in kilobytes, of
+        the child process. The CPU time and size are None if the child had
+        already been waited for."""
+        runtime = time.time() - self.started
+        rusage = None
+        for (sig, wait) in [(signal.SIGTERM, grace), (signal.SIGKILL, None)]:
+            try:
+                os.killpg(self.process.pid, sig)
+            except OSError:
+                pass
+            (reaped, rusage) = self.wait_child(wait)
+            if reaped:
+                break
+        self.receiver.close()
+        self.outcome = ("timeout", "killed after %.0f seconds" % runtime)
+        self.completed = True
+        if rusage is None:
+            self.usage = (runtime, None, None)
+        else:
+            self.usage = (runtime, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss)
+        return self.usage
+
+    def wait_child(self, timeout=None):
+        """Wait up to timeout seconds, or indefinitely if timeout is None, for
+        the child process to exit. Returns whether it has exited, and its
+        resource usage if this call waited for it. The child is waited for with
+        os.wait4 rather than Process.join, as only wait4 reports the usage of
+        a child that has been killed."""
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                (pid, status, rusage) = os.wait4(self.process.pid,
+                                                 0 if deadline is None else os.WNOHANG)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                # already waited for
+                return (True, None)
+            if pid != 0:
+                return (True, rusage)
+            if time.time() >= deadline:
+                return (False, None)
+            time.sleep(0.1)
+
+def child_usage():
+    """Return the CPU time, in seconds, and the peak resident set size, in
+    kilobytes, of the largest child process, over all the child processes of
+    this process that have been waited for."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (usage.ru_utime + usage.ru_stime, usage.ru_maxrss)
+
+class TestHistory:
+    """A record of the resources used by each run of each test, kept in an
+    sqlite database."""
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute("""create table if not exists runs (
+                                     test text, started real, wall real,
+                                     cpu real, maxrss integer, timesteps integer,
+                                     status text)""")
+        self.connection.execute("create index if not exists runs_test on runs (test)")
+
+    def record(self, test, wall, cpu=None, maxrss=None, timesteps=None, status=None):
+        self.connection.execute("insert into runs values (?, ?, ?, ?, ?, ?, ?)",
+                                (test, time.time(), wall, cpu, maxrss, timesteps, status))
+
+    def runs(self, test, count=5):
+        """Return the most recent count runs of test, newest first, as
+        dictionaries."""
+        cursor = self.connection.execute("""select started, wall, cpu, maxrss, timesteps, status
+                                            from runs where test = ?
+                                            order by started desc limit ?""", (test, count))
+        keys = ["started", "wall", "cpu", "maxrss", "timesteps", "status"]
+        return [dict(zip(keys, row)) for row in cursor]
+
+    def median(self, test, key, count=5):
+        """Return the median of key over the most recent count runs of test, or
+        None if it has not been recorded."""
+        values = sorted([run[key] for run in self.runs(test, count) if run[key] is not None])
+        if len(values) == 0:
+            return None
+        return values[len(values) // 2]
+
+    def tests(self):
+        return [row[0] for row in self.connection.execute("select distinct test from runs")]
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
 class ThreadIterator(list):
     '''A thread-safe iterator over a list.'''
     def __init__(self, seq):
@@ -328,6 +683,125 @@ class ThreadIterator(list):
         return ans
         
 
+def _sleep_in_subprocess(pidfile):
+    # start a grandchild process in the test process's process group, record
+    # its pid, and wait to be killed
+    child = subprocess.Popen(["sleep", "600"])
+    f = open(pidfile, "w")
+    f.write(str(child.pid))
+    f.close()
+    time.sleep(600)
+
+class regressiontestUnittests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_stat(self, filename, rows):
+        f = open(filename, "w")
+        f.write("<header>\n" +
+                "<field column=\"1\" name=\"ElapsedTime\" statistic=\"value\"/>\n" +
+                "</header>\n")
+        for row in rows:
+            f.write("%r\n" % row)
+        f.close()
+
+    def testOutputCacheKey(self):
+        filename = os.path.join(self.dir, "test.stat")
+        self.write_stat(filename, [0.0, 1.0])
+        cache = OutputCache()
+        key = cache.key([filename], "stat")
+        self.assertEquals(cache.key([filename], "stat"), key)
+        self.assertNotEquals(cache.key([filename], "vtu"), key)
+
+        # a change of modification time alone
+        stat = os.stat(filename)
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+        mtime_key = cache.key([filename], "stat")
+        self.assertNotEquals(mtime_key, key)
+
+        # a change of size alone
+        f = open(filename, "a")
+        f.write("2.0\n")
+        f.close()
+        os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+        self.assertNotEquals(cache.key([filename], "stat"), mtime_key)
+
+        # missing files do not contribute to the key
+        self.assertEquals(cache.key([filename, filename + ".dat"], "stat"),
+                          cache.key([filename], "stat"))
+
+    def testOutputCacheLoadStat(self):
+        import fluidity_tools
+        filename = os.path.join(self.dir, "test.stat")
+        self.write_stat(filename, [0.0, 1.0])
+        cache = OutputCache()
+        stat = cache.load_stat(filename)
+        self.assertEquals(list(stat["ElapsedTime"]["value"]), [0.0, 1.0])
+        self.assertTrue(cache.load_stat(filename) is stat)
+        self.assertFalse(cache.load_stat(filename, subsample=2) is stat)
+
+        self.write_stat(filename, [0.0, 1.0, 2.0])
+        reloaded = cache.load_stat(filename)
+        self.assertFalse(reloaded is stat)
+        self.assertEquals(list(reloaded["ElapsedTime"]["value"]), [0.0, 1.0, 2.0])
+
+        original = fluidity_tools.stat_parser
+        cache.install()
+        try:
+            self.assertTrue(fluidity_tools.stat_parser(filename) is reloaded)
+            self.assertTrue(cache.original(fluidity_tools, "stat_parser") is original)
+            # objects loaded while installed are instances of the installed
+            # class
+            self.write_stat(filename, [0.0])
+            stat = fluidity_tools.stat_parser(filename)
+            self.assertFalse(stat is reloaded)
+            self.assertTrue(isinstance(stat, fluidity_tools.stat_parser))
+            self.assertTrue(isinstance(stat, original))
+            self.assertTrue(cache.load_stat(filename) is stat)
+        finally:
+            cache.uninstall()
+        self.assertTrue(fluidity_tools.stat_parser is original)
+        self.assertFalse(fluidity_tools.stat_parser(filename) is stat)
+
+    def testTestProcessResult(self):
+        process = TestProcess(target=lambda x: x + 1, args=(1,))
+        process.start()
+        self.assertEquals(process.result(), 2)
+        self.assertTrue(process.done())
+
+        process = TestProcess(target=lambda: 1 / 0)
+        process.start()
+        self.assertRaises(TestProcessError, process.result)
+
+    def testTestProcessTimeout(self):
+        pidfile = os.path.join(self.dir, "pid")
+        process = TestProcess(target=_sleep_in_subprocess, args=(pidfile,))
+        process.start()
+        for i in range(100):
+            if os.path.exists(pidfile) and os.path.getsize(pidfile) > 0:
+                break
+            time.sleep(0.1)
+        grandchild = int(open(pidfile).read())
+
+        (wall, cpu, maxrss) = process.terminate(grace=1.0)
+        self.assertTrue(wall > 0.0)
+        self.assertTrue(process.usage == (wall, cpu, maxrss))
+        self.assertRaises(TestProcessTimeout, process.result)
+        self.assertRaises(OSError, os.kill, process.process.pid, 0)
+
+        # the grandchild is killed with the rest of the process group, and
+        # reaped by init
+        for i in range(100):
+            try:
+                os.kill(grandchild, 0)
+            except OSError:
+                break
+            time.sleep(0.1)
+        self.assertRaises(OSError, os.kill, grandchild, 0)
+
 if __name__ == "__main__":
     prob = TestProblem(filename=sys.argv[1], verbose=True)
     prob.run()
@@ -8,6 +8,7 @@
 ##########################################
 
 import numpy,sys,copy,operator
+import unittest
 
 class State:
   def __init__(self,n=""):
@@ -57,13 +58,12 @@ class Field:
       '''Add val to node of this field. If node is a scalar then val must
       have the shape of one data item in this field. If node is a sequence then
       the leading dimension of val must match the length of node and the
-      remaining dimensions must match the shape of a data item in this field.'''
-      try:
-          for ii,vv in zip(node,val):
-              self.val[ii]=self.val[ii]+vv
-      except TypeError:
-          # In this case it's presumably scalars.
-          self.val[node]=self.val[node]+val
+      remaining dimensions must match the shape of a data item in this field.
+      node may also be an array of nodes of any shape, such as that returned
+      by Mesh.ele_nodes_all(), in which case the leading dimensions of val must
+      match its shape. Repeated nodes are added to once for each time they
+      appear.'''
+      numpy.add.at(self.val, numpy.asarray(node), val)
 
   def set(self, node, val):
       '''Set node of this field to val.  If node is a scalar then val must
@@ -72,11 +72,7 @@ class Field:
       remaining dimensions must match the shape of a data item in this
       field.'''
       
-      try:
-          for ii,vv in zip(node,val):
-              self.val[ii]=vv
-      except TypeError:
-          self.val[node]=val
+      self.val[numpy.asarray(node)] = val
 
   def __setitem__(self, node, val):
     self.set(node, val)
@@ -93,7 +89,12 @@ class Field:
 
   def ele_val(self,ele_number):
     # Return the values of field at the nodes of ele_number
-    return numpy.array(map(self.node_val,self.ele_nodes(ele_number)))
+    return numpy.asarray(self.val)[self.ele_nodes(ele_number)]
+
+  def ele_val_all(self):
+    # Return the values of field at the nodes of every element, as an array
+    # of shape (element_count, loc) followed by the shape of one data item
+    return numpy.asarray(self.val)[self.mesh.ele_nodes_all()]
 
   def ele_val_at_quad(self,ele_number):
     # Return the values of field at the quadrature points of ele_number
@@ -101,10 +102,17 @@ class Field:
     ele_val = self.ele_val(ele_number)
     return numpy.array(numpy.dot(ele_val, shape_n))
 
+  def ele_val_at_quad_all(self):
+    # Return the values of field at the quadrature points of every element,
+    # as an array of shape (element_count, ngi) followed by the shape of one
+    # data item
+    return numpy.einsum('lg,el...->eg...', self.mesh.shape.n, self.ele_val_all())
+
   def ele_region_id(self,ele_number):
     return self.mesh.ele_region_id(ele_number)
 
-  def remap_ele(self, ele_number, mesh):
+  def check_remap(self, mesh):
+    # Check that this field can be remapped to mesh
     assert self.mesh.continuity >= mesh.continuity
     if mesh.continuity >= 0: # if we are CG
       assert self.mesh.shape.degree <= mesh.shape.degree
@@ -113,15 +121,47 @@ class Field:
     # we should check for periodic/nonperiodic here, but
     # our mesh type doesn't know whether it's periodic or not ...
 
-    # we really ought to cache locweight, as it's constant
-    # for each element, and only depends on the target mesh --
-    # but we currently don't, sorry
-    locweight = numpy.zeros((mesh.shape.loc, self.mesh.shape.loc))
+  def remap_locweight(self, mesh):
+    # Return the (mesh.shape.loc, self.mesh.shape.loc) matrix interpolating
+    # the values of an element of this field to the nodes of the same element
+    # of mesh. It only depends on the two shapes, so it is cached on the shape
+    # of this field, keyed by the shape of mesh.
+    shape = self.mesh.shape
+    try:
+      cache = shape.remap_locweights
+    except AttributeError:
+      cache = shape.remap_locweights = {}
+    try:
+      return cache[mesh.shape]
+    except KeyError:
+      pass
+
+    locweight = numpy.zeros((mesh.shape.loc, shape.loc))
     for i in range(mesh.shape.loc):
-      for j in range(self.mesh.shape.loc):
-        locweight[i,j] = self.mesh.shape.eval_shape(j, mesh.shape.local_coords(i))
+      for j in range(shape.loc):
+        locweight[i,j] = shape.eval_shape(j, mesh.shape.local_coords(i))
+    cache[mesh.shape] = locweight
+    return locweight
+
+  def remap_ele(self, ele_number, mesh):
+    self.check_remap(mesh)
+    return numpy.dot(self.remap_locweight(mesh), self.ele_val(ele_number))
+
+  def remap(self, mesh):
+    # Return a copy of this field remapped to mesh, which must have the same
+    # elements as the mesh of this field
+    self.check_remap(mesh)
+    assert mesh.element_count == self.mesh.element_count
 
-    return numpy.dot(locweight, self.ele_val(ele_number))
+    ele_vals = numpy.einsum('ij,ej...->ei...', self.remap_locweight(mesh), self.ele_val_all())
+    val = numpy.zeros((mesh.node_count,) + ele_vals.shape[2:])
+    val[mesh.ele_nodes_all()] = ele_vals
+
+    field = copy.copy(self)
+    field.val = val
+    field.node_count = mesh.node_count
+    field.set_mesh(mesh)
+    return field
 
 class ScalarField(Field):
   "A scalar field"  
@@ -200,6 +240,11 @@ class Mesh:
       nodes.append(self.ndglno[base+i]-1)
     return nodes
 
+  def ele_nodes_all(self):
+    # Return the nodes of every element as an array of shape
+    # (element_count, loc), numbered from 0
+    return numpy.asarray(self.ndglno).reshape((self.element_count, self.shape.loc)) - 1
+
   def ele_region_id(ele_number):
     # Return the region_id of element ele_number
     return self.mesh.region_ids[ele_number]
@@ -354,6 +399,53 @@ class Transform:
       return numpy.column_stack((arr,arr,arr))
 
 
+class Transforms:
+  "Transforms of all the elements of a field at once, with their detwei and Jacobians"
+
+  def __init__(self,field):
+    self.element = field.mesh.shape
+    self.field = field
+    # Jacobian matrices and their inverses at each quadrature point of each
+    # element, of shapes (element_count, ngi, dim, ldim) and
+    # (element_count, ngi, ldim, dim)
+    X = field.ele_val_all()
+    self.J = numpy.einsum('eld,lgk->egdk', X, self.element.dn)
+    if self.J.shape[2] == self.J.shape[3]:
+      self.det = abs(numpy.linalg.det(self.J))
+      self.invJ = numpy.linalg.inv(self.J)
+    else:
+      # Embedded manifolds: the pseudo-inverse and the volume scaling of the
+      # map to physical space
+      JTJ = numpy.einsum('egdk,egdl->egkl', self.J, self.J)
+      self.det = numpy.sqrt(abs(numpy.linalg.det(JTJ)))
+      self.invJ = numpy.einsum('egkl,egdl->egkd', numpy.linalg.inv(JTJ), self.J)
+    self.detwei = self.det * self.element.quadrature.weights
+
+  def grad(self,shape):
+    # Return the derivatives of shape in physical space at each quadrature
+    # point of each element, of shape (element_count, loc, ngi, dim)
+    return numpy.einsum('lgk,egkd->elgd', shape.dn, self.invJ)
+
+  def shape_shape(self,shape1,shape2, coeff=None):
+    # For each element, and each node in shape1 and shape2, calculate the
+    # coefficient of the integral int(shape1shape2)dV. coeff, if given, is
+    # the value of a coefficient at each quadrature point of each element.
+    #
+    # In effect, this calculates the element mass matrices, of shape
+    # (element_count, shape1.loc, shape2.loc).
+    detwei = self.detwei
+    if coeff is not None:
+      assert numpy.shape(coeff) == detwei.shape
+      detwei = detwei * coeff
+    return numpy.einsum('ig,jg,eg->eij', shape1.n, shape2.n, detwei)
+
+  def shape_dshape(self,shape,dshape):
+    # For each element, each node in shape and each node in the transformed
+    # gradient dshape, as returned by grad, calculate the coefficient of the
+    # integral int(shape dshape)dV, of shape
+    # (element_count, shape.loc, dshape loc, dim)
+    return numpy.einsum('eg,ig,ejgd->eijd', self.detwei, shape.n, dshape)
+
 
 def test_shape_dshape(state):
   # Tests shape_dshape (surprised?) - pass in the state with the coordiate field
@@ -382,3 +474,202 @@ def test_shape_dshape(state):
   print psi.val[0]/lumpmass.val
 
   return 0
+
+class state_typesUnittests(unittest.TestCase):
+  def _Fields(self, dim = 2):
+    # Return P1 coordinate and scalar fields on a perturbed unit square split
+    # into triangles, on a 4x4 grid of nodes
+    nx = 4
+    coords = numpy.array([[i / 3.0, j / 3.0] for j in range(nx) for i in range(nx)])
+    coords += 0.05 * numpy.random.RandomState(0).rand(*coords.shape)
+    tris = []
+    for j in range(nx - 1):
+      for i in range(nx - 1):
+        a = j * nx + i
+        tris += [[a, a + 1, a + nx], [a + 1, a + nx + 1, a + nx]]
+    mesh = Mesh(numpy.array(tris).flatten() + 1, len(tris), nx * nx, 0, "CoordinateMesh", "", numpy.zeros(0))
+
+    quad = numpy.array([[1 / 6.0, 1 / 6.0], [2 / 3.0, 1 / 6.0], [1 / 6.0, 2 / 3.0]])
+    n = numpy.array([1.0 - quad[:, 0] - quad[:, 1], quad[:, 0], quad[:, 1]])
+    dn = numpy.zeros((3, 3, 2))
+    dn[0] = [-1.0, -1.0]
+    dn[1] = [1.0, 0.0]
+    dn[2] = [0.0, 1.0]
+    # Local coordinates and shape functions are in barycentric coordinates
+    shape = Element(2, 3, 3, 1, n, dn, numpy.identity(3), 3, 3, 0, 0, "simplex", "lagrangian")
+    shape.set_quadrature(Quadrature(numpy.array([1 / 6.0] * 3), quad.flatten(), 2, 2, 3, 3))
+    for i in range(3):
+      for j in range(3):
+        if i == j:
+          shape.set_polynomial_s(Polynomial([0.0, 1.0], 1), i + 1, j + 1)
+        else:
+          shape.set_polynomial_s(Polynomial([1.0], 0), i + 1, j + 1)
+    mesh.shape = shape
+
+    if dim == 3:
+      # A manifold mesh, embedded in 3D
+      coords = numpy.column_stack((coords, coords[:, 0] + coords[:, 1]))
+    positions = VectorField("Coordinate", coords, 1, "", dim)
+    positions.set_mesh(mesh)
+    field = ScalarField("Field", coords[:, 0] ** 2 + coords[:, 1], 1, "")
+    field.set_mesh(mesh)
+
+    return positions, field
+
+  def _P2Mesh(self, mesh):
+    # Return a continuous quadratic mesh with the elements of the linear
+    # simplex mesh
+    coords = numpy.array([[1.0, 0.0, 0.0], [0.5, 0.5, 0.0], [0.0, 1.0, 0.0],
+                          [0.5, 0.0, 0.5], [0.0, 0.5, 0.5], [0.0, 0.0, 1.0]])
+    shape = Element(2, 6, 0, 2, None, None, coords, 3, 6, 0, 0, "simplex", "lagrangian")
+    for node in range(6):
+      vertices = [i for i in range(3) if coords[node, i] > 0.0]
+      for i in range(3):
+        if vertices == [i]:
+          poly = Polynomial([0.0, -1.0, 2.0], 2)
+        elif i == vertices[0] and len(vertices) == 2:
+          poly = Polynomial([0.0, 4.0], 1)
+        elif i in vertices:
+          poly = Polynomial([0.0, 1.0], 1)
+        else:
+          poly = Polynomial([1.0], 0)
+        shape.set_polynomial_s(poly, i + 1, node + 1)
+
+    edges = {}
+    ndglno = []
+    for ele in range(mesh.element_count):
+      vertices = mesh.ele_nodes(ele)
+      for node in range(6):
+        ele_vertices = [vertices[i] for i in range(3) if coords[node, i] > 0.0]
+        if len(ele_vertices) == 1:
+          ndglno.append(ele_vertices[0])
+        else:
+          edge = tuple(sorted(ele_vertices))
+          if not edge in edges:
+            edges[edge] = mesh.node_count + len(edges)
+          ndglno.append(edges[edge])
+    p2_mesh = Mesh(numpy.array(ndglno) + 1, mesh.element_count, mesh.node_count + len(edges), 0, "P2Mesh", "", numpy.zeros(0))
+    p2_mesh.shape = shape
+
+    return p2_mesh
+
+  def _DiscontinuousMesh(self, mesh):
+    # Return a discontinuous mesh with the elements and shape of mesh
+    nodes = mesh.element_count * mesh.shape.loc
+    dg_mesh = Mesh(numpy.arange(nodes) + 1, mesh.element_count, nodes, -1, "DiscontinuousMesh", "", numpy.zeros(0))
+    dg_mesh.shape = mesh.shape
+
+    return dg_mesh
+
+  def testEleValAll(self):
+    positions, field = self._Fields()
+    mesh = field.mesh
+    self.assertEquals(mesh.ele_nodes_all().shape, (mesh.element_count, mesh.shape.loc))
+    for ele in range(mesh.element_count):
+      self.assertEquals(type(mesh.ele_nodes(ele)), list)
+      self.assertEquals(list(mesh.ele_nodes_all()[ele]), mesh.ele_nodes(ele))
+      self.assertTrue(numpy.allclose(positions.ele_val_all()[ele], positions.ele_val(ele)))
+      self.assertTrue(numpy.allclose(field.ele_val_all()[ele], field.ele_val(ele)))
+      self.assertTrue(numpy.allclose(field.ele_val_at_quad_all()[ele], field.ele_val_at_quad(ele)))
+
+    return
+
+  def testTransforms(self):
+    for dim in [2, 3]:
+      positions, field = self._Fields(dim = dim)
+      shape = positions.mesh.shape
+      transforms = Transforms(positions)
+      for ele in range(positions.element_count):
+        transform = Transform(ele, positions)
+        self.assertTrue(numpy.allclose(transforms.det[ele], transform.det))
+        self.assertTrue(numpy.allclose(transforms.detwei[ele], transform.detwei))
+        for gi in range(shape.ngi):
+          self.assertTrue(numpy.allclose(transforms.J[ele, gi], transform.J[gi]))
+          self.assertTrue(numpy.allclose(transforms.invJ[ele, gi], transform.invJ[gi]))
+        self.assertTrue(numpy.allclose(transforms.shape_shape(shape, shape)[ele], transform.shape_shape(shape, shape)))
+        if dim == 2:
+          dshape = transform.grad(shape)
+          self.assertTrue(numpy.allclose(transforms.grad(shape)[ele], dshape.dn))
+          self.assertTrue(numpy.allclose(transforms.shape_dshape(shape, transforms.grad(shape))[ele],
+            transform.shape_dshape(shape, dshape)))
+
+    return
+
+  def testAddto(self):
+    positions, field = self._Fields()
+    mesh = field.mesh
+    shape = mesh.shape
+    transforms = Transforms(positions)
+
+    # Lumped mass, assembled element by element and in one call
+    lumped = numpy.zeros(field.node_count)
+    for ele in range(mesh.element_count):
+      nodes = mesh.ele_nodes(ele)
+      lumped[nodes] += Transform(ele, positions).shape_shape(shape, shape).sum(1)
+    field.val[:] = 0.0
+    field.addto(mesh.ele_nodes_all(), transforms.shape_shape(shape, shape).sum(2))
+    self.assertTrue(numpy.allclose(field.val, lumped))
+    self.assertAlmostEquals(field.val.sum(), 1.0, 1)
+
+    # Repeated nodes are added to once for each time they appear
+    field.val[:] = 0.0
+    field.addto(0, 1.0)
+    field.addto([1, 1, 2], [1.0, 2.0, 4.0])
+    self.assertEquals(list(field.val[:3]), [1.0, 3.0, 4.0])
+    val = positions.val.copy()
+    positions.addto([1, 1], [[1.0, 0.0], [1.0, 0.0]])
+    self.assertTrue(numpy.allclose(positions.val[1], val[1] + [2.0, 0.0]))
+
+    return
+
+  def testRemap(self):
+    positions, field = self._Fields()
+    p2_mesh = self._P2Mesh(field.mesh)
+
+    # Linear to quadratic
+    p2_field = field.remap(p2_mesh)
+    self.assertTrue(p2_field.mesh is p2_mesh)
+    self.assertTrue(field.mesh is positions.mesh)
+    self.assertEquals(p2_field.val.shape, (p2_mesh.node_count,))
+    for ele in range(field.element_count):
+      self.assertTrue(numpy.allclose(p2_field.ele_val(ele), field.remap_ele(ele, p2_mesh)))
+      # Vertex values are kept, and midpoint values are edge averages
+      vertex = field.ele_val(ele)
+      self.assertTrue(numpy.allclose(p2_field.ele_val(ele),
+        [vertex[0], 0.5 * (vertex[0] + vertex[1]), vertex[1], 0.5 * (vertex[0] + vertex[2]), 0.5 * (vertex[1] + vertex[2]), vertex[2]]))
+
+    p2_positions = positions.remap(p2_mesh)
+    self.assertEquals(p2_positions.val.shape, (p2_mesh.node_count, 2))
+    for ele in range(field.element_count):
+      self.assertTrue(numpy.allclose(p2_positions.ele_val(ele), positions.remap_ele(ele, p2_mesh)))
+
+    # Quadratic to discontinuous linear
+    dg_mesh = self._DiscontinuousMesh(field.mesh)
+    dg_field = p2_field.remap(dg_mesh)
+    for ele in range(field.element_count):
+      self.assertTrue(numpy.allclose(dg_field.ele_val(ele), p2_field.remap_ele(ele, dg_mesh)))
+    self.assertTrue(numpy.allclose(dg_field.ele_val_all(), field.ele_val_all()))
+
+    # A quadratic field cannot be remapped to a continuous linear mesh
+    self.assertRaises(AssertionError, p2_field.remap, field.mesh)
+
+    return
+
+  def testRemapCache(self):
+    positions, field = self._Fields()
+    p2_mesh = self._P2Mesh(field.mesh)
+    dg_mesh = self._DiscontinuousMesh(field.mesh)
+
+    p2_locweight = field.remap_locweight(p2_mesh)
+    self.assertEquals(p2_locweight.shape, (6, 3))
+    self.assertTrue(field.remap_locweight(p2_mesh) is p2_locweight)
+
+    # A different target shape misses the cache
+    dg_locweight = field.remap_locweight(dg_mesh)
+    self.assertEquals(dg_locweight.shape, (3, 3))
+    self.assertTrue(numpy.allclose(dg_locweight, numpy.identity(3)))
+    self.assertEquals(len(field.mesh.shape.remap_locweights), 2)
+    self.assertTrue(field.remap_locweight(p2_mesh) is p2_locweight)
+
+    return
+
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import array
+import cStringIO
 import exceptions
 import os
 import math
@@ -235,12 +236,40 @@ class stat_creator(dict):
      c.add_constant({"time": 1.0})
      c[('Material1', 'Speed', 'max')] = 1.0
      c.write()
+
+   Rows are buffered in memory, and written to disk every buffer_rows rows or
+   on flush() or close(). With binary set the data are written, as by Fluidity
+   with binary output enabled, to <filename>.dat using reals of real_size bytes.
+   Whole batches of rows can be added with write_rows, e.g. for a derived stat
+   with many rows:
+
+     with stat_creator("derived.stat", binary=True, buffer_rows=65536) as c:
+       c.write_rows({('ElapsedTime', 'value'): t, ('Speed', 'max'): speed})
   """
 
-  def __init__(self, filename):
+  def __init__(self, filename, binary = False, real_size = 8, buffer_rows = 1):
     self.filename = filename
     self.initialised = False
     self.constants = {}
+    self.binary = binary
+    if real_size == 4:
+      self.real_format = 'f'
+    elif real_size == 8:
+      self.real_format = 'd'
+    else:
+      raise Exception("Unexpected real size: " + str(real_size))
+    self.real_size = real_size
+    self.buffer_rows = max(buffer_rows, 1)
+    self._buffer = []
+    self._buffered_rows = 0
+    self._handle = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+    return False
 
   def add_constant(self, constant):
     if self.initialised:
@@ -248,81 +277,132 @@ class stat_creator(dict):
       return
     self.constants.update(constant)
 
-  def write(self):
-    if not self.initialised:
-      f = open(self.filename, "w")
-      # Create the minidom document
-      doc = Document()
-      # Create the <header> element
-      header = doc.createElement("header")
-      doc.appendChild(header)
-      self.header = [] # We save the header for verification before every write_stat
-      # Write the constants
-      for const_k, const_v in self.constants.items():
-        const_element = doc.createElement("constant")
-        const_element.setAttribute("name", str(const_k))
+  def _initialise(self):
+    f = open(self.filename, "w")
+    # Create the minidom document
+    doc = Document()
+    # Create the <header> element
+    header = doc.createElement("header")
+    doc.appendChild(header)
+    self.header = [] # We save the header for verification before every write_stat
+    # Write the constants
+    constants = self.constants.items()
+    if self.binary:
+      constants += [("format", "binary"), ("real_size", self.real_size), ("integer_size", 4)]
+    for const_k, const_v in constants:
+      const_element = doc.createElement("constant")
+      const_element.setAttribute("name", str(const_k))
+      if const_k in ["real_size", "integer_size"] and self.binary:
+        const_element.setAttribute("type", "integer")
+      else:
         const_element.setAttribute("type", "string")
-        const_element.setAttribute("value", str(const_v))
-        header.appendChild(const_element)
-      # Create the stat elements
-      column = 1
-      for stat in self.keys():
-        stat_element = doc.createElement("field")
-        stat_element.setAttribute("column", str(column))
-        if len(stat) == 2:
-          stat_element.setAttribute("name", stat[0])
-          stat_element.setAttribute("statistic", stat[1])
-        elif len(stat) == 3:
-          stat_element.setAttribute("material_phase", stat[0])
-          stat_element.setAttribute("name", stat[1])
-          stat_element.setAttribute("statistic", stat[2])
-        else:
-          print "Element ", stat, " must have length 2 or 3"
-          exit()
-        header.appendChild(stat_element)
-        self.header.append(stat)
-        column = column+1
-      self.initialised = True
-      try:
-            f.write(doc.toprettyxml(indent="  "))
-      finally:
-            f.close()
-      # Now call the write function again to actually write the first values
-      self.write() 
-      return
-    # Here the header is written and we only want to append data. So lets load the file in append mode 
-    f = open (self.filename, "a")
-    # Check that the dictionary and the header are consistent 
-    if set(self) != set(self.header):
-      print "Error: Columns may not change after initialisation of the stat file."
-      print "Columns you are trying to write: ", self
-      print "Columns in the header: ", self.header
-      exit()
-    output = ""
-    for stat in self.header:
-      output = output + "  " + str(self[stat])
-    output = output + "\n"  
+      const_element.setAttribute("value", str(const_v))
+      header.appendChild(const_element)
+    # Create the stat elements
+    column = 1
+    for stat in self.keys():
+      stat_element = doc.createElement("field")
+      stat_element.setAttribute("column", str(column))
+      if len(stat) == 2:
+        stat_element.setAttribute("name", stat[0])
+        stat_element.setAttribute("statistic", stat[1])
+      elif len(stat) == 3:
+        stat_element.setAttribute("material_phase", stat[0])
+        stat_element.setAttribute("name", stat[1])
+        stat_element.setAttribute("statistic", stat[2])
+      else:
+        print "Element ", stat, " must have length 2 or 3"
+        exit()
+      header.appendChild(stat_element)
+      self.header.append(stat)
+      column = column+1
+    self.initialised = True
     try:
-          f.write(output)
+          f.write(doc.toprettyxml(indent="  "))
     finally:
           f.close()
+    # Here the header is written and we only want to append data. So lets open
+    # the data file in the appropriate mode
+    if self.binary:
+      self._handle = open(self.filename + ".dat", "wb")
+    else:
+      self._handle = open(self.filename, "a")
 
-class stat_parser(dict):
-    """Parse a .stat file. The resulting mapping object is a hierarchy
-of dictionaries. Most entries are of the form:
-
-   parser[material_phase][field][statistic].
+  def _check_columns(self, columns):
+    # Check that the columns and the header are consistent 
+    if set(columns) != set(self.header):
+      print "Error: Columns may not change after initialisation of the stat file."
+      print "Columns you are trying to write: ", columns
+      print "Columns in the header: ", self.header
+      exit()
 
-for example:
+  def _append(self, rows):
+    self._buffer.append(rows)
+    self._buffered_rows += rows.shape[0]
+    if self._buffered_rows >= self.buffer_rows:
+      self.flush()
 
-   p=stat_parser(filename)
-   p['Material1']['Speed']['max']
+  def write(self):
+    """Append a row containing the current values of the stat entries"""
+    if not self.initialised:
+      self._initialise()
+    self._check_columns(self)
+    self._append(numpy.array([[self[stat] for stat in self.header]], dtype = numpy.float64))
+
+  def write_rows(self, data):
+    """Append a batch of rows. data is a dictionary mapping every stat entry to
+    an array of values, one per row. The stat entries are left set to the
+    values in the final row."""
+    if not self.initialised:
+      for stat in data:
+        self[stat] = None
+      self._initialise()
+    self._check_columns(data)
+    rows = numpy.column_stack([numpy.asarray(data[stat], dtype = numpy.float64) for stat in self.header])
+    if rows.shape[0] == 0:
+      return
+    for i, stat in enumerate(self.header):
+      self[stat] = rows[-1, i]
+    self._append(rows)
+
+  def flush(self):
+    """Write any buffered rows to disk"""
+    if len(self._buffer) > 0:
+      rows = numpy.concatenate(self._buffer)
+      self._buffer = []
+      self._buffered_rows = 0
+      if self.binary:
+        rows.astype(self.real_format).tofile(self._handle)
+      else:
+        # repr gives the shortest string that reads back to the same value
+        self._handle.write("".join(["  " + "  ".join(map(repr, row)) + "\n" for row in rows.tolist()]))
+    if not self._handle is None:
+      self._handle.flush()
+
+  def close(self):
+    """Write any buffered rows to disk and close the stat"""
+    self.flush()
+    if not self._handle is None:
+      self._handle.close()
+      self._handle = None
+
+class StatHeaderError(Exception):
+    """Raised when the XML header of a .stat file is missing or incomplete, for
+example because fluidity has not finished writing it"""
+    pass
+
+class stat_header:
+    """The XML header of a .stat file, together with the layout of the data that
+follows it. The header fields are recorded in the list fields, as tuples of the
+form:
+
+   (material_phase, name, statistic, column, components)
+
+where column is zero based, material_phase is empty for fields that do not
+belong to a material phase and components is None for scalar statistics.
 """
 
-    def __init__(self, filename, subsample = 1):
-    
-      assert(subsample > 0)
-
+    def __init__(self, filename):
       statfile=file(filename, "r")
       header_re=re.compile(r"</header>")
       xml="" # xml header.
@@ -331,52 +411,233 @@ for example:
       while 1:
         line=statfile.readline()
         if line=="":
-          raise Exception("Unable to read .stat file header")
+          raise StatHeaderError("Unable to read .stat file header")
         xml=xml+line
         if re.search(header_re, line):
           break
+      self.data_offset = statfile.tell()
+      statfile.close()
 
       # now parse the xml.
       parsed=parseString(xml)
-      
-      binaryFormat = False
+
+      self.constants = {}
+      self.binary = False
+      self.real_size = None
+      self.real_format = None
       constantEles = parsed.getElementsByTagName("constant")
       for ele in constantEles:
         name = ele.getAttribute("name")
         type = ele.getAttribute("type")
         value = ele.getAttribute("value")
+        self.constants[name] = value
         if name == "format":
           assert(type == "string")
           if value == "binary":
-            binaryFormat = True
-       
-      nColumns = 0  
-      for field in parsed.getElementsByTagName("field"):
-        components = field.getAttribute("components")
-        if components:
-          nColumns += int(components)
-        else:
-          nColumns += 1
+            self.binary = True
 
-      if binaryFormat:           
+      if self.binary:
         for ele in constantEles:
           name = ele.getAttribute("name")
           type = ele.getAttribute("type")
           value = ele.getAttribute("value")
           if name == "real_size":
-            assert(type == "integer")            
-            real_size = int(value)            
-            if real_size == 4:
-              realFormat = 'f'
-            elif real_size == 8:
-              realFormat = 'd'
+            assert(type == "integer")
+            self.real_size = int(value)
+            if self.real_size == 4:
+              self.real_format = 'f'
+            elif self.real_size == 8:
+              self.real_format = 'd'
             else:
-              raise Exception("Unexpected real size: " + str(real_size))
+              raise Exception("Unexpected real size: " + str(self.real_size))
           elif name == "integer_size":
-            assert(type == "integer")            
-            integer_size = int(value)            
+            assert(type == "integer")
+            integer_size = int(value)
             if not integer_size == 4:
-              raise Exception("Unexpected integer size: " + str(real_size))
+              raise Exception("Unexpected integer size: " + str(integer_size))
+
+      self.fields = []
+      self.nColumns = 0
+      for field in parsed.getElementsByTagName("field"):
+        components = field.getAttribute("components")
+        if components:
+          components = int(components)
+          self.nColumns += components
+        else:
+          components = None
+          self.nColumns += 1
+        self.fields.append((field.getAttribute("material_phase"),
+                            field.getAttribute("name"),
+                            field.getAttribute("statistic"),
+                            int(field.getAttribute("column")) - 1,
+                            components))
+
+def stat_field_dict(root, material_phase, name, new_dict = dict):
+    """Return the dictionary of statistics for the named field in the
+    stat_parser style hierarchy root, creating it if necessary."""
+
+    if material_phase:
+      if not root.has_key(material_phase):
+        root[material_phase]=new_dict()
+      root=root[material_phase]
+
+    if not root.has_key(name):
+      root[name]=new_dict()
+
+    return root[name]
+
+def stat_ascii_blocks(statfile, nColumns, subsample = 1, chunkBytes = 1 << 22, nBytes = None):
+    """Generate the plain text data rows of a .stat file, starting from the
+    current position of the open statfile, as a sequence of (nRows, nColumns)
+    float64 arrays. Rows are read in blocks of roughly chunkBytes bytes, and
+    each block is converted in a single call. Only every subsample'th row is
+    kept. If nBytes is supplied, no more than nBytes bytes of rows are read."""
+
+    assert(subsample > 0)
+
+    lineNo = 0
+    while True:
+      if nBytes is None:
+        hint = chunkBytes
+        lines = statfile.readlines(hint)
+      elif nBytes > 0:
+        hint = min(chunkBytes, nBytes)
+        lines = statfile.readlines(hint)
+        # Drop any rows beyond the requested byte range
+        for i, line in enumerate(lines):
+          nBytes -= len(line)
+          if nBytes < 0:
+            lines = lines[:i]
+            nBytes = 0
+            break
+      else:
+        break
+      if len(lines) == 0:
+        break
+
+      data = "".join(lines)
+      values = numpy.fromstring(data, sep = " ")
+      complete = values.shape[0] == len(lines) * nColumns
+      if complete and (len(data) < hint or nBytes == 0 or not data.endswith("\n")):
+        # A file that is still being written most likely ends with an
+        # incomplete line, which the total entry count can miss, so the entry
+        # count of every line in the final block is checked too
+        complete = all(len(line.split()) == nColumns for line in lines)
+      if not complete:
+        # Either a line is incomplete, or it contains something the bulk
+        # conversion can't handle. Fall back to a line by line conversion, which
+        # also tells us which line is at fault.
+        values = numpy.empty((len(lines), nColumns))
+        for i, line in enumerate(lines):
+          entries = map(float, line.split())
+          if len(entries) != nColumns:
+            raise Exception("Incomplete line %d: expected %d, but got %d columns" % (lineNo + i, nColumns, len(entries)))
+          values[i, :] = entries
+      else:
+        values = values.reshape((len(lines), nColumns))
+
+      # Ignore non-sampled lines
+      rows = values[(-lineNo) % subsample::subsample]
+      lineNo += len(lines)
+
+      yield rows
+
+def stat_blocks(filename, subsample = 1, chunkBytes = 1 << 22):
+    """Generate the data rows of a plain text or binary .stat file as a sequence
+    of (nRows, nColumns) float64 arrays of roughly chunkBytes bytes each, so that
+    the whole file can be processed with bounded memory. Only every subsample'th
+    row is kept."""
+
+    stat = stat_file(filename, subsample = subsample)
+    if stat.header.binary:
+      data = stat.memmap()
+      blockRows = max(chunkBytes / (stat.header.nColumns * stat.header.real_size), 1) * subsample
+      for start in range(0, data.shape[0], blockRows):
+        yield numpy.array(data[start:start + blockRows:subsample], dtype = numpy.float64)
+    else:
+      statfile = file(filename, "r")
+      statfile.seek(stat.header.data_offset)
+      try:
+        for rows in stat_ascii_blocks(statfile, stat.header.nColumns, subsample = subsample, chunkBytes = chunkBytes):
+          yield rows
+      finally:
+        statfile.close()
+
+def parse_stat_ascii_data(statfile, nColumns, subsample = 1, chunkBytes = 1 << 22, selection = None, nBytes = None):
+    """Parse the plain text data rows of a .stat file, starting from the current
+    position of the open statfile, into a (nColumns, nRows) float64 array.
+
+    The rows are converted in blocks by stat_ascii_blocks into a preallocated
+    array, which is grown only if the initial size estimate turns out to be too
+    small. Only every subsample'th row is kept. If selection is supplied, only
+    the listed (zero based) columns are kept, in the order given. If nBytes is
+    supplied, no more than nBytes bytes of rows are read."""
+
+    if selection is None:
+      nOutputColumns = nColumns
+    else:
+      nOutputColumns = len(selection)
+
+    try:
+      start = statfile.tell()
+      if nBytes is None:
+        remainingBytes = os.fstat(statfile.fileno()).st_size - start
+      else:
+        remainingBytes = nBytes
+    except (AttributeError, IOError, OSError):
+      remainingBytes = None
+
+    columns = None
+    nRows = 0
+    for rows in stat_ascii_blocks(statfile, nColumns, subsample = subsample, chunkBytes = chunkBytes, nBytes = nBytes):
+      if not selection is None:
+        rows = rows[:, selection]
+
+      if columns is None:
+        # Estimate the total number of rows from the size of the first block
+        if remainingBytes is None or statfile.tell() <= start:
+          capacity = rows.shape[0]
+        else:
+          capacity = int(float(remainingBytes) / (statfile.tell() - start) * max(rows.shape[0], 1)) + 1
+        columns = numpy.empty((nOutputColumns, max(capacity, rows.shape[0])))
+      elif nRows + rows.shape[0] > columns.shape[1]:
+        newColumns = numpy.empty((nOutputColumns, max(nRows + rows.shape[0], (3 * columns.shape[1]) / 2)))
+        newColumns[:, :nRows] = columns[:, :nRows]
+        columns = newColumns
+
+      columns[:, nRows:nRows + rows.shape[0]] = rows.transpose()
+      nRows += rows.shape[0]
+
+    if columns is None:
+      return numpy.empty((nOutputColumns, 0))
+    elif nRows < columns.shape[1]:
+      # Trim the unused preallocated space
+      return columns[:, :nRows].copy()
+    else:
+      return columns
+
+class stat_parser(dict):
+    """Parse a .stat file. The resulting mapping object is a hierarchy
+of dictionaries. Most entries are of the form:
+
+   parser[material_phase][field][statistic].
+
+for example:
+
+   p=stat_parser(filename)
+   p['Material1']['Speed']['max']
+"""
+
+    def __init__(self, filename, subsample = 1):
+    
+      assert(subsample > 0)
+
+      header = stat_header(filename)
+      nColumns = header.nColumns
+
+      if header.binary:
+        real_size = header.real_size
+        realFormat = header.real_format
        
         nOutput = (os.path.getsize(filename + ".dat") / (nColumns * real_size)) / subsample
         
@@ -403,41 +664,380 @@ for example:
         statDatFile.close()
         assert(index == nOutput)
       else:
-        columns = [[] for i in range(nColumns)]
-        lineNo = 0
-        for line in statfile:
-          entries = map(float, line.split())
-          # Ignore non-sampled lines
-          if len(entries) == len(columns) and (lineNo % subsample) == 0:
-            map(list.append, columns, entries)
-          elif len(entries) != len(columns):
-            raise Exception("Incomplete line %d: expected %d, but got %d columns" % (lineNo, len(columns), len(entries)))
-          lineNo = lineNo + 1
-        columns = numpy.array(columns)
+        statfile=file(filename, "r")
+        statfile.seek(header.data_offset)
+        columns = parse_stat_ascii_data(statfile, nColumns, subsample = subsample)
+        statfile.close()
               
-      for field in parsed.getElementsByTagName("field"):
-        material_phase=field.getAttribute("material_phase")
-        name=field.getAttribute("name")
-        column=field.getAttribute("column")
-        statistic=field.getAttribute("statistic")
-        components=field.getAttribute("components")
+      for material_phase, name, statistic, column, components in header.fields:
+        current_dict = stat_field_dict(self, material_phase, name)
+        if components is None:
+            current_dict[statistic]=columns[column]
+        else:
+            current_dict[statistic]=columns[column:column+components]
+
+class stat_follower(dict):
+    """Incrementally read a .stat (or .detectors) file that is still being
+written. The resulting mapping object has the same hierarchy as that of
+stat_parser. The byte offset of the last complete row read is recorded, and
+refresh() reads only the rows appended since then. Partial trailing rows are
+ignored until they have been completed, and no file handles are kept open
+between refreshes. If the file is found to have been truncated (e.g. because
+the simulation was restarted) it is read again from the start.
+
+   p=stat_follower(filename)
+   ...
+   if p.refresh() > 0:
+     p['Material1']['Speed']['max']
+"""
 
-        if material_phase:
-          if not self.has_key(material_phase):
-            self[material_phase]={}
-          current_dict=self[material_phase]
+    def __init__(self, filename):
+      self.filename = filename
+      self._reset()
+
+    def _reset(self):
+      self.clear()
+      self.header = stat_header(self.filename)
+      if self.header.binary:
+        self._offset = 0
+      else:
+        self._offset = self.header.data_offset
+      self._columns = numpy.empty((self.header.nColumns, 0))
+      self.nRows = 0
+      self._update_fields()
+      self.refresh()
+
+    def _update_fields(self):
+      columns = self._columns[:, :self.nRows]
+      for material_phase, name, statistic, column, components in self.header.fields:
+        current_dict = stat_field_dict(self, material_phase, name)
+        if components is None:
+            current_dict[statistic]=columns[column]
         else:
-          current_dict=self
+            current_dict[statistic]=columns[column:column+components]
+
+    def refresh(self):
+      """Read any complete rows appended since the last refresh, and return the
+      number of new rows"""
+
+      nColumns = self.header.nColumns
+      if self.header.binary:
+        datFilename = self.filename + ".dat"
+        try:
+          size = os.path.getsize(datFilename)
+        except OSError:
+          size = 0
+        if size < self._offset:
+          self._reset()
+          return self.nRows
+
+        rowBytes = nColumns * self.header.real_size
+        nNew = (size - self._offset) / rowBytes
+        if nNew <= 0:
+          return 0
+        statDatFile = file(datFilename, "rb")
+        statDatFile.seek(self._offset)
+        values = numpy.fromfile(statDatFile, dtype = self.header.real_format, count = nNew * nColumns)
+        statDatFile.close()
+        # Ignore incomplete lines
+        nNew = values.shape[0] / nColumns
+        rows = values[:nNew * nColumns].reshape((nNew, nColumns)).transpose()
+        self._offset += nNew * rowBytes
+      else:
+        size = os.path.getsize(self.filename)
+        if size < self._offset:
+          self._reset()
+          return self.nRows
+
+        statfile = file(self.filename, "r")
+        statfile.seek(self._offset)
+        data = statfile.read(size - self._offset)
+        statfile.close()
+        # Ignore incomplete lines
+        end = data.rfind("\n") + 1
+        if end == 0:
+          return 0
+        rows = parse_stat_ascii_data(cStringIO.StringIO(data), nColumns, nBytes = end)
+        nNew = rows.shape[1]
+        self._offset += end
+
+      if self.nRows + nNew > self._columns.shape[1]:
+        newColumns = numpy.empty((nColumns, max(self.nRows + nNew, (3 * self._columns.shape[1]) / 2)))
+        newColumns[:, :self.nRows] = self._columns[:, :self.nRows]
+        self._columns = newColumns
+      self._columns[:, self.nRows:self.nRows + nNew] = rows
+      self.nRows += nNew
+      self._update_fields()
+
+      return nNew
+
+class stat_file:
+    """Column-selective access to the data in a .stat file. Only the header is
+parsed on construction. Each column is read from disk on first access, through
+a memory map of the .dat file for binary .stat files or with a single pass over
+the rows for plain text .stat files, and is then cached. The rows present when
+the stat_file is created are the only ones ever read.
+"""
 
-        if not current_dict.has_key(name):
-          current_dict[name]={}
+    def __init__(self, filename, subsample = 1):
+      assert(subsample > 0)
 
-        if components:
-            column=int(column)
-            components=int(components)
-            current_dict[name][statistic]=columns[column-1:column-1+components]
+      self.filename = filename
+      self.subsample = subsample
+      self.header = stat_header(filename)
+      if self.header.binary:
+        rowBytes = self.header.nColumns * self.header.real_size
+        self.nRows = (os.path.getsize(filename + ".dat") / rowBytes) / subsample
+      else:
+        self.nRows = None
+        self._dataBytes = os.path.getsize(filename) - self.header.data_offset
+      self._cache = {}
+      self._memmap = None
+
+    def memmap(self):
+      """Return a read-only memory map of the data in a binary .stat file, as an
+      array of reals with one row per output (including any rows skipped by
+      subsampling) and one column per .stat column."""
+
+      assert(self.header.binary)
+      if self._memmap is None:
+        shape = (self.nRows * self.subsample, self.header.nColumns)
+        if self.nRows == 0:
+          # Empty files cannot be memory mapped
+          self._memmap = numpy.empty(shape, dtype = self.header.real_format)
         else:
-            current_dict[name][statistic]=columns[int(column)-1]
+          self._memmap = numpy.memmap(self.filename + ".dat", dtype = self.header.real_format, mode = "r", shape = shape)
+
+      return self._memmap
+
+    def column(self, index):
+      """Return the data in the given (zero based) column"""
+
+      return self.load([index])[0]
+
+    def columns(self, first, count):
+      """Return the data in count consecutive columns, starting from the (zero
+      based) column first, as a (count, nRows) array"""
+
+      return numpy.array(self.load(range(first, first + count)))
+
+    def load(self, indices):
+      """Return a list of the data in the given (zero based) columns. Any
+      columns not already cached are read together."""
+
+      missing = []
+      for index in indices:
+        if not index in self._cache and not index in missing:
+          missing.append(index)
+
+      if len(missing) > 0:
+        if self.header.binary:
+          data = self.memmap()
+          for index in missing:
+            self._cache[index] = numpy.array(data[::self.subsample, index], dtype = numpy.float64)
+        else:
+          statfile = file(self.filename, "r")
+          statfile.seek(self.header.data_offset)
+          data = parse_stat_ascii_data(statfile, self.header.nColumns, subsample = self.subsample,
+            selection = missing, nBytes = self._dataBytes)
+          statfile.close()
+          self.nRows = data.shape[1]
+          for i, index in enumerate(missing):
+            self._cache[index] = data[i]
+
+      return [self._cache[index] for index in indices]
+
+class detector_reader:
+    """Read a .detectors file, returning detector positions and field values as
+dense arrays of shape (nTimes, nDetectors) for scalar fields, or (nTimes,
+nDetectors, nComponents) for positions and vector fields. The header is parsed
+once on construction. Binary detector data are memory mapped, so that only the
+requested detectors and times are read, and where the requested detectors
+occupy a contiguous block of columns (as the detectors in a detector array do)
+the result is a view of the mapped file, in the precision of the file.
+
+Detectors may be selected by detector array name, or with a list of detector
+names. Detector arrays are identified by detector names of the form
+<array name>_<index>, with indices running consecutively from one. Times may be
+selected with a slice or an index array. For example:
+
+   d=detector_reader("run.detectors")
+   d.positions("Tracers", times=slice(-10, None))
+   d.field("Fluid", "Temperature", d.arrays["Tracers"][:100])
+"""
+
+    array_re = re.compile(r"^(.+)_([0-9]+)$")
+
+    def __init__(self, filename):
+      self.stat = stat_file(filename)
+
+      self.detector_names = []
+      self._positions = {}
+      self._fields = {}
+      self._time_column = None
+      for material_phase, name, statistic, column, components in self.stat.header.fields:
+        if material_phase:
+          if not (material_phase, name) in self._fields:
+            self._fields[(material_phase, name)] = {}
+          self._fields[(material_phase, name)][statistic] = (column, components)
+        elif statistic == "position":
+          self.detector_names.append(name)
+          self._positions[name] = (column, components)
+        elif name == "ElapsedTime":
+          self._time_column = column
+
+      candidates = {}
+      for name in self.detector_names:
+        match = self.array_re.match(name)
+        if not match is None:
+          if not match.group(1) in candidates:
+            candidates[match.group(1)] = []
+          candidates[match.group(1)].append((int(match.group(2)), name))
+      self.arrays = {}
+      for array, entries in candidates.items():
+        entries.sort()
+        if [index for index, name in entries] == range(1, len(entries) + 1):
+          self.arrays[array] = [name for index, name in entries]
+
+    def fields(self):
+      """Return a list of the (material_phase, name) pairs of the fields
+      recorded at the detectors"""
+
+      return self._fields.keys()
+
+    def elapsed_time(self, times = None):
+      """Return the elapsed time at each output"""
+
+      assert(not self._time_column is None)
+      if times is None:
+        times = slice(None)
+
+      return self._dense([(self._time_column, None)], times)[:, 0]
+
+    def positions(self, detectors = None, times = None):
+      """Return the positions of the selected detectors, as an (nTimes,
+      nDetectors, dim) array"""
+
+      return self._dense([self._positions[name] for name in self._detectors(detectors)], times)
+
+    def field(self, material_phase, name, detectors = None, times = None):
+      """Return the values of a field at the selected detectors, as an (nTimes,
+      nDetectors) array for scalar fields or an (nTimes, nDetectors, dim) array
+      for vector fields"""
+
+      field = self._fields[(material_phase, name)]
+
+      return self._dense([field[detector] for detector in self._detectors(detectors)], times)
+
+    def _detectors(self, detectors):
+      if detectors is None:
+        return self.detector_names
+      elif isinstance(detectors, basestring):
+        return self.arrays[detectors]
+      else:
+        return detectors
+
+    def _dense(self, entries, times):
+      if times is None:
+        times = slice(None)
+      components = entries[0][1]
+      if components is None:
+        width = 1
+      else:
+        width = components
+      columns = [column for column, entryComponents in entries]
+      assert(len([entry for entry in entries if entry[1] != components]) == 0)
+
+      contiguous = columns == range(columns[0], columns[0] + len(columns) * width, width)
+      if self.stat.header.binary:
+        data = self.stat.memmap()
+        if contiguous:
+          block = data[times, columns[0]:columns[0] + len(columns) * width]
+        else:
+          indices = (numpy.array(columns)[:, numpy.newaxis] + numpy.arange(width)).ravel()
+          if isinstance(times, slice):
+            block = data[times, indices]
+          else:
+            block = data[numpy.ix_(numpy.asarray(times), indices)]
+      else:
+        indices = (numpy.array(columns)[:, numpy.newaxis] + numpy.arange(width)).ravel()
+        block = numpy.array(self.stat.load(indices.tolist())).transpose()[times]
+
+      if components is None:
+        return block.reshape((block.shape[0], len(columns)))
+      else:
+        return block.reshape((block.shape[0], len(columns), width))
+
+class lazy_stat_value:
+    """A placeholder for .stat data that has not yet been read. Loads a single
+column, or a block of components columns as a (components, nRows) array (or a
+(nRows, components) array if transpose is set)."""
+
+    def __init__(self, stat, column, components = None, transpose = False):
+      self.stat = stat
+      self.column = column
+      self.components = components
+      self.transpose = transpose
+
+    def load(self):
+      if self.components is None:
+        return self.stat.column(self.column)
+
+      data = self.stat.columns(self.column, self.components)
+      if self.transpose:
+        data = data.transpose()
+
+      return data
+
+class lazy_stat_dict(dict):
+    """A dictionary in which lazy_stat_value entries are read, and replaced with
+their data, on first access."""
+
+    def __getitem__(self, key):
+      value = dict.__getitem__(self, key)
+      if isinstance(value, lazy_stat_value):
+        value = value.load()
+        dict.__setitem__(self, key, value)
+
+      return value
+
+    def get(self, key, default = None):
+      if key in self:
+        return self[key]
+      else:
+        return default
+
+    def values(self):
+      return [self[key] for key in self.keys()]
+
+    def items(self):
+      return [(key, self[key]) for key in self.keys()]
+
+    def itervalues(self):
+      for key in self.keys():
+        yield self[key]
+
+    def iteritems(self):
+      for key in self.keys():
+        yield (key, self[key])
+
+class lazy_stat_parser(lazy_stat_dict):
+    """Column-selective equivalent of stat_parser. Only the .stat header is parsed
+on construction, and each statistic is read the first time that it is accessed:
+
+   p=lazy_stat_parser(filename)
+   p['Material1']['Speed']['max']
+
+reads just the one column from the file.
+"""
+
+    def __init__(self, filename, subsample = 1):
+      lazy_stat_dict.__init__(self)
+
+      self.stat = stat_file(filename, subsample = subsample)
+      for material_phase, name, statistic, column, components in self.stat.header.fields:
+        current_dict = stat_field_dict(self, material_phase, name, new_dict = lazy_stat_dict)
+        current_dict[statistic] = lazy_stat_value(self.stat, column, components)
 
 def test_steady(vals, error, test_count = 1):
   """
@@ -10,8 +10,9 @@ arr=numpy.array
 
 class vtu:
   """Unstructured grid object to deal with VTK unstructured grids."""
-  def __init__(self, filename = None):
-    """Creates a vtu object by reading the specified file."""
+  def __init__(self, filename = None, fields = None):
+    """Creates a vtu object by reading the specified file. If fields is
+    supplied, only the point and cell fields with those names are read."""
     if filename is None:
       self.ugrid = vtk.vtkUnstructuredGrid()
     else:
@@ -23,6 +24,12 @@ class vtu:
       else:
         raise Exception("ERROR: don't recognise file extension" + filename)
       self.gridreader.SetFileName(filename)
+      if not fields is None:
+        self.gridreader.UpdateInformation()
+        for selection in [self.gridreader.GetPointDataArraySelection(), self.gridreader.GetCellDataArraySelection()]:
+          selection.DisableAllArrays()
+          for field in fields:
+            selection.EnableArray(field)
       self.gridreader.Update()
       self.ugrid=self.gridreader.GetOutput()
       if self.ugrid.GetNumberOfPoints() + self.ugrid.GetNumberOfCells() == 0:
@@ -10,10 +10,14 @@
 stat to csv convertor for Fluidity output stat files.
 """
 
+import fnmatch
 import getopt
+import gzip
 import os
 import sys
 
+import numpy
+
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "tools"),)
 import fluidity_tools
 
@@ -23,14 +27,23 @@ def Help():
   """
   print "Usage: stat2csv [OPTIONS] ... STAT\n" + \
         "\n" + \
-        "Converts a Fluidity .stat file to a .csv file." + \
+        "Converts a Fluidity .stat file to a .csv file. Rows are streamed from the\n" + \
+        "input to the output in blocks, so memory use is bounded." + \
         "\n" + \
         "Options:\n" + \
         "\n" + \
         "-c        Do not output data labels\n" + \
         "-d DELIM The delimiter to use between output columns (default = \",\")\n" + \
         "-o        Output file\n" + \
-        "-s        Output to stdout instead of output file"
+        "-s        Output to stdout instead of output file\n" + \
+        "-z        Compress the output with gzip\n" + \
+        "--columns GLOB      Output only columns with labels matching GLOB (may be\n" + \
+        "                    given more than once)\n" + \
+        "--subsample N       Output only every N'th row\n" + \
+        "--time-range T0,T1  Output only rows with T0 <= ElapsedTime <= T1 (either\n" + \
+        "                    bound may be omitted)\n" + \
+        "--npz               Output the selected columns to a NumPy .npz file instead\n" + \
+        "                    of a .csv file. The selected columns are held in memory."
   sys.stdout.flush()
   
   return
@@ -63,9 +76,9 @@ def Error(message):
   FatalError(message)
     
 try:
-  opts, args = getopt.getopt(sys.argv[1:], "cd:o:s")
+  opts, args = getopt.getopt(sys.argv[1:], "cd:o:sz", ["columns=", "subsample=", "time-range=", "npz"])
 except getopt.GetoptError:
-  pass
+  Error("Invalid option")
 
 try:
   inputFile = args[0]
@@ -77,12 +90,13 @@ if len(args) > 1:
   Error("Unrecognised option \"" + args[1] + "\" entered")
 outputLabels = 1
 delimiter = ","
-if len(inputFile.split(".")) == 1:
-  outputFile = inputFile
-else:
-  outputFile = inputFile[:-len(inputFile.split(".")[-1]) - 1]
-outputFile += ".csv"
+outputFile = None
 useStdout = 0
+useGzip = 0
+useNpz = 0
+columnGlobs = []
+subsample = 1
+timeRange = [None, None]
 for opt in opts:
   if opt[0] == "-c":
     outputLabels = 0
@@ -92,72 +106,120 @@ for opt in opts:
     outputFile = opt[1]
   elif opt[0] == "-s":
     useStdout = 1
+  elif opt[0] == "-z":
+    useGzip = 1
+  elif opt[0] == "--columns":
+    columnGlobs.append(opt[1])
+  elif opt[0] == "--subsample":
+    try:
+      subsample = int(opt[1])
+      assert(subsample > 0)
+    except (ValueError, AssertionError):
+      Error("Invalid subsample \"" + opt[1] + "\"")
+  elif opt[0] == "--time-range":
+    bounds = opt[1].split(",")
+    if len(bounds) != 2:
+      Error("Invalid time range \"" + opt[1] + "\"")
+    for i, bound in enumerate(bounds):
+      if len(bound.strip()) > 0:
+        try:
+          timeRange[i] = float(bound)
+        except ValueError:
+          Error("Invalid time range \"" + opt[1] + "\"")
+  elif opt[0] == "--npz":
+    useNpz = 1
   else:
     Error("Unrecognised option \"" + opt[0] + "\" entered")
     
-# Read the input .stat file    
-s = fluidity_tools.stat_parser(inputFile)
+if outputFile is None:
+  if len(inputFile.split(".")) == 1:
+    outputFile = inputFile
+  else:
+    outputFile = inputFile[:-len(inputFile.split(".")[-1]) - 1]
+  if useNpz:
+    outputFile += ".npz"
+  else:
+    outputFile += ".csv"
+    if useGzip:
+      outputFile += ".gz"
+if useNpz and useStdout:
+  Error("Cannot output a .npz file to stdout")
+
+# Read the input .stat header
+header = fluidity_tools.stat_header(inputFile)
+
+# Form the data labels, in column order
+labels = []
+columns = []
+timeColumn = None
+for material_phase, name, statistic, column, components in header.fields:
+  label = name + "%" + statistic
+  if material_phase:
+    label = material_phase + "%" + label
+  if components is None:
+    labels.append(label)
+    columns.append(column)
+  else:
+    for i in range(components):
+      labels.append(label + "%" + str(i + 1))
+      columns.append(column + i)
+  if name == "ElapsedTime" and not material_phase:
+    timeColumn = column
+  
+if len(columnGlobs) > 0:
+  selected = [i for i, label in enumerate(labels) if len([glob for glob in columnGlobs if fnmatch.fnmatchcase(label, glob)]) > 0]
+  labels = [labels[i] for i in selected]
+  columns = [columns[i] for i in selected]
+  if len(labels) == 0:
+    FatalError("No columns match the supplied --columns filters")
+if not timeRange == [None, None] and timeColumn is None:
+  FatalError("--time-range requires an ElapsedTime column")
 
-def ExtractData(input, labelPrefix = ""):  
+def Blocks():
   """
-  Parse the input stat_parser and return a dictionary of scalar field data
+  Generate the selected rows of the input .stat file, as blocks of selected
+  columns
   """
 
-  if len(labelPrefix) > 0:
-    labelPrefix += "%"
-  
-  data = {}
-  for key in input:
-    if isinstance(input[key], dict):
-      # Internal nodes
-      newData = ExtractData(input[key], labelPrefix + key)
-      for label in newData:
-        data[label] = newData[label]
-    else:
-      # Leaf nodes
-      datum = input[key]
-      if len(datum.shape) == 1:
-        # Rank zero fields (scalars)
-        label = labelPrefix + key
-        data[label] = datum
-      elif len(datum.shape) == 2:
-        # Rank one fields (vectors)
-        for i in range(datum.shape[0]):
-          label = labelPrefix + key + "%" + str(i + 1)
-          data[label] = datum[i, :]
-      else:
-        raise Exception("Unexpected data rank: " + str(len(datum.shape)))
-    
-  return data
-      
-data = ExtractData(s)
-labels = data.keys()
+  for rows in fluidity_tools.stat_blocks(inputFile, subsample = subsample):
+    if not timeRange[0] is None:
+      rows = rows[rows[:, timeColumn] >= timeRange[0]]
+    if not timeRange[1] is None:
+      rows = rows[rows[:, timeColumn] <= timeRange[1]]
+    yield rows[:, columns]
+
+if useNpz:
+  blocks = list(Blocks())
+  if len(blocks) > 0:
+    data = numpy.concatenate(blocks)
+  else:
+    data = numpy.empty((0, len(columns)))
+  arrays = dict([(label, data[:, i]) for i, label in enumerate(labels)])
+  if useGzip:
+    numpy.savez_compressed(outputFile, **arrays)
+  else:
+    numpy.savez(outputFile, **arrays)
+  sys.exit(0)
 
 # Open the output file for writing
 if useStdout:
-  outputHandle = sys.stdout
+  if useGzip:
+    outputHandle = gzip.GzipFile(fileobj = sys.stdout, mode = "wb")
+  else:
+    outputHandle = sys.stdout
+elif useGzip:
+  outputHandle = gzip.open(outputFile, "wb")
 else:
   outputHandle = open(outputFile, "w")
 
 if outputLabels:
   # Labels
-  for i, label in enumerate(labels):
-    outputHandle.write(label)
-    if i < len(labels) - 1:
-      outputHandle.write(delimiter)
-    else:
-      outputHandle.write("\n")
+  outputHandle.write(delimiter.join(labels) + "\n")
    
-if len(labels) > 0:
-  # Data
-  entries = len(data[labels[0]])
-  for i in range(entries):
-    for j, label in enumerate(labels):
-      outputHandle.write(str(data[label][i]))
-      if j < len(labels):
-        outputHandle.write(delimiter)
-    outputHandle.write("\n")
+# Data. repr gives the shortest string that reads back to the same value.
+for rows in Blocks():
+  outputHandle.write("".join([delimiter.join(map(repr, row)) + "\n" for row in rows.tolist()]))
 
 outputHandle.flush()
-if not useStdout:
+if useGzip or not useStdout:
   outputHandle.close()
@@ -12,6 +12,7 @@ import sys
 import time
 
 import gtk
+import numpy
 
 import fluidity.diagnostics.debug as debug
 import fluidity.diagnostics.fluiditytools as fluidity_tools
@@ -49,6 +50,7 @@ class StatplotWindow(gtk.Window):
     assert(len(filenames) > 0)
     
     self._filenames = filenames
+    self._stats = None
   
     gtk.Window.__init__(self)
     self.set_title(self._filenames[-1])
@@ -68,6 +70,7 @@ class StatplotWindow(gtk.Window):
     self._yField = None
     self._xData = None
     self._yData = None
+    self._series = None
     self._plotWidget = None
     self._plotType = plotting.LinePlot
     
@@ -100,31 +103,39 @@ class StatplotWindow(gtk.Window):
     return
     
   def _ReadData(self):
-    stats = []
-    for i, filename in enumerate(self._filenames):
-      failcount = 0
-      while failcount < 5:
-        try:
-          stats.append(fluidity_tools.Stat(filename))
-          break
-        except TypeError, ValueError:
-          # We opened the .stat when it was being written to by fluidity
-          time.sleep(0.2)
-          failcount = failcount + 1
-      if failcount == 5:
-        raise Exception("Could not open %s" % filename)
-    if len(stats) == 1:
-      self._stat = stats[0]
+    if self._stats is None:
+      # Follow the .stat files, so that a re-read only parses the rows appended
+      # since the last read, and ignores any row fluidity is part way through
+      # writing
+      self._stats = [self._FollowStat(filename) for filename in self._filenames]
     else:
-      self._stat = fluidity_tools.JoinStat(*stats)
+      for stat in self._stats:
+        stat.Refresh()
+    if len(self._stats) == 1:
+      self._stat = self._stats[0]
+    else:
+      self._stat = fluidity_tools.JoinStat(*self._stats)
       
     return
     
+  def _FollowStat(self, filename, pollInterval = 0.2, maxPolls = 150):
+    # A .stat opened just after fluidity creates it may not yet contain its
+    # whole header, so poll until the closing header tag has been written
+    for i in range(maxPolls):
+      try:
+        return fluidity_tools.Stat(filename, follow = True)
+      except fluidity_tools.StatHeaderError:
+        pass
+      time.sleep(pollInterval)
+      
+    raise Exception("Could not open %s" % filename)
+    
   def _RefreshData(self, keepBounds = False):
     self._xField = self._xCombo.get_active_text()
     self._xData = self._stat[self._xField]
     self._yField = self._yCombo.get_active_text()
     self._yData = self._stat[self._yField]
+    self._series = None
     if keepBounds:
       axis = self._plotWidget.get_children()[0].figure.get_axes()[0]
       bounds = (axis.get_xbound(), axis.get_ybound())
@@ -151,22 +162,48 @@ class StatplotWindow(gtk.Window):
         if yscale is None:
           yscale = "linear"
         
-      self._plotWidget = self._plotType(x = self._xData, y = self._yData, xLabel = self._xField, yLabel = self._yField).Widget()
+      # Plot min/max decimated data, so that long series remain responsive.
+      # The data are re-decimated for the visible range on zoom.
+      if self._series is None:
+        self._series = plotting.DecimatedSeries(self._xData, self._yData)
+      if bounds is None:
+        x, y = self._series.Decimate(width = self.get_size()[0])
+      else:
+        x, y = self._series.Decimate(bounds[0][0], bounds[0][1], width = self.get_size()[0])
+        
+      self._plotWidget = self._plotType(x = x, y = y, xLabel = self._xField, yLabel = self._yField).Widget()
       axis = self._plotWidget.get_children()[0].figure.get_axes()[0]
       axis.set_xscale(xscale)
       axis.set_yscale(yscale)
       if not bounds is None:
         axis.set_xbound(bounds[0])
         axis.set_ybound(bounds[1])
+      axis.callbacks.connect("xlim_changed", self._XLimChanged)
       
       self._vBox.pack_start(self._plotWidget)
       self._plotWidget.show_all()
     
     return
     
+  def _XLimChanged(self, axis):
+    if self._series is None:
+      return
+      
+    xMin, xMax = axis.get_xlim()
+    x, y = self._series.Decimate(min(xMin, xMax), max(xMin, xMax), width = int(axis.get_window_extent().width))
+    lines = axis.get_lines()
+    if len(lines) > 0:
+      lines[0].set_data(x, y)
+    else:
+      axis.collections[0].set_offsets(numpy.column_stack((x, y)))
+    axis.figure.canvas.draw_idle()
+    
+    return
+    
   def SetXField(self, field):
     self._xField = field
     self._xData = self._stat[self._xField]
+    self._series = None
     
     self._RefreshPlot()
     
@@ -175,6 +212,7 @@ class StatplotWindow(gtk.Window):
   def SetYField(self, field):
     self._yField =  field
     self._yData = self._stat[self._yField]
+    self._series = None
     
     self._RefreshPlot()
       
@@ -5,6 +5,16 @@ import os
 import os.path
 import glob
 import time
+import select
+import json
+import sqlite3
+import hashlib
+import fnmatch
+import subprocess
+import tarfile
+import shutil
+import tempfile
+import unittest
 
 try:
  import fluidity.regressiontest as regressiontest
@@ -16,7 +26,6 @@ except ImportError:
  import fluidity.regressiontest as regressiontest
 
 import traceback
-import threading
 import xml.parsers.expat
 import string
 
@@ -42,8 +51,12 @@ class TestHarness:
     def __init__(self, length="any", parallel="any", exclude_tags=None,
                  tags=None, file="", from_file=None,
                  verbose=True, justtest=False,
-                 valgrind=False, genpbs=False, exit_fails=False, xml_outfile=""):
+                 valgrind=False, genpbs=False, exit_fails=False, xml_outfile="",
+                 thread_count=1, history_file=None, index_file=None,
+                 justlist=False, perf_report=False, perf_threshold=1.5,
+                 shard=None, cache_dir=None, no_cache_tags=[]):
         self.tests = []
+        self.test_files = []
         self.verbose = verbose
         self.length = length
         self.parallel = parallel
@@ -59,6 +72,17 @@ class TestHarness:
         self.cwd=os.getcwd()
         self.xml_outfile=xml_outfile
         self.exit_fails=exit_fails
+        self.thread_count=thread_count
+        self.justlist=justlist
+        self.perf_report=perf_report
+        self.perf_threshold=perf_threshold
+        self.perf_results=[]
+        self.shard=shard
+        self.cache_dir=cache_dir
+        self.no_cache_tags=no_cache_tags
+        self.shared_hash=None
+        # the environment the test problems are run with
+        self.env=dict(os.environ)
 
         fluidity_command = self.decide_fluidity_command()
 
@@ -76,25 +100,53 @@ class TestHarness:
 
         xml_files = []
         rootdir = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), os.pardir))
+        self.rootdir = rootdir
+
+        # the resources used by previous runs of each test, used to schedule
+        # the longest tests first and to report performance regressions
+        if history_file is None:
+          history_file = os.path.join(rootdir, ".testharness_history")
+        self.history_file = history_file
+        self.history = None
+        if not justlist or not shard is None:
+          try:
+            self.history = regressiontest.TestHistory(history_file)
+          except sqlite3.Error as e:
+            print "Warning: unable to open test history %s: %s" % (history_file, e)
+
+        # the details of each test problem, keyed by path and cached by
+        # modification time, so that each xml file is only parsed once
+        if index_file is None:
+          index_file = os.path.join(rootdir, ".testharness_index")
+        self.index_file = index_file
+        self.index = self.read_json(index_file)
+        self.index_modified = False
+
         dirnames = []
         testpaths = ["examples", "tests", "longtests"]
         for directory in testpaths:
           if os.path.exists(os.path.join(rootdir, directory)):
             dirnames.append(directory)
         testdirs = [ os.path.join( rootdir, x ) for x in dirnames ]
+        seen_files = set()
         for directory in testdirs:
           subdirs = [ os.path.join(directory, x) for x in os.listdir(directory)]
           for subdir in subdirs:
             g = glob.glob1(subdir, "*.xml")
             for xml_file in g:
+              seen_files.add(os.path.join(subdir, xml_file))
               try:
-                p = etree.parse(os.path.join(subdir, xml_file))
-                x = p.getroot()
-                if x.tag == "testproblem":
+                if not self.test_info(os.path.join(subdir, xml_file)) is None:
                   xml_files.append(os.path.join(subdir, xml_file))
               except xml.parsers.expat.ExpatError:
                 print "Warning: %s mal-formed" % xml_file
                 traceback.print_exc()
+        # forget files which no longer exist
+        for filename in set(self.index.keys()) - seen_files:
+          del self.index[filename]
+          self.index_modified = True
+        if self.index_modified:
+          self.write_json(index_file, self.index)
 
         # step 2. if the user has specified a particular file, let's use that.
 
@@ -111,32 +163,28 @@ class TestHarness:
         else:
           files = None
 
+        selected = []
         if files:
           for (subdir, xml_file) in [os.path.split(x) for x in xml_files]:
             temp_files=files
             for file in temp_files:
               if xml_file == file:
-                p = etree.parse(os.path.join(subdir,xml_file))
-                prob_defn = p.findall("problem_definition")[0]
-                prob_nprocs = int(prob_defn.attrib["nprocs"])                
-                testprob = regressiontest.TestProblem(filename=os.path.join(subdir, xml_file),
-                                                      verbose=self.verbose, replace=self.modify_command_line(prob_nprocs), genpbs=genpbs)
-                self.tests.append((subdir, testprob))
+                selected.append(os.path.join(subdir, xml_file))
                 files.remove(xml_file)
           if files != []:
             print "Could not find the following specified test files:"
             for f in files:
               print f
             sys.exit(1)
+          self.add_tests(selected)
           return
 
         # step 3. form a cut-down list of the xml files matching the correct length and the correct parallelism.
         working_set = []
         for xml_file in xml_files:
-          p = etree.parse(xml_file)
-          prob_defn = p.findall("problem_definition")[0]
-          prob_length = prob_defn.attrib["length"]
-          prob_nprocs = int(prob_defn.attrib["nprocs"])
+          info = self.test_info(xml_file)
+          prob_length = info["length"]
+          prob_nprocs = info["nprocs"]
           if prob_length == length or (length == "any" and prob_length not in ["special", "long"]):
             if self.parallel == "parallel":
               if prob_nprocs > 1:
@@ -148,14 +196,7 @@ class TestHarness:
               working_set.append(xml_file)
                 
         def get_xml_file_tags(xml_file):
-          p = etree.parse(xml_file)
-          p_tags = p.findall("tags")
-          if len(p_tags) > 0 and not p_tags[0].text is None:
-            xml_tags = p_tags[0].text.split()
-          else:
-            xml_tags = []
-          
-          return xml_tags
+          return self.test_info(xml_file)["tags"]
                 
         # step 4. if there are any excluded tags, let's exclude tests that have
         # them
@@ -189,18 +230,78 @@ class TestHarness:
         else:
           tagged_set = working_set
 
-        for (subdir, xml_file) in [os.path.split(x) for x in tagged_set]:
-          # need to grab nprocs here to pass through to modify_command_line
-          p = etree.parse(os.path.join(subdir,xml_file))
-          prob_defn = p.findall("problem_definition")[0]
-          prob_nprocs = int(prob_defn.attrib["nprocs"])
-          testprob = regressiontest.TestProblem(filename=os.path.join(subdir, xml_file),
-                       verbose=self.verbose, replace=self.modify_command_line(prob_nprocs))
-          self.tests.append((subdir, testprob))
+        self.add_tests(tagged_set)
 
-        if len(self.tests) == 0:
+        if len(self.test_files) == 0:
           print "Warning: no matching tests."
 
+    def test_info(self, filename):
+        '''Return a dictionary of the length, nprocs and tags of the test problem
+        in filename, or None if it is not a test problem. Results are cached in
+        the index by path, and reused while the modification time and size of
+        the file are unchanged.'''
+        stat = os.stat(filename)
+        try:
+          entry = self.index[filename]
+          if entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            return entry["info"]
+        except KeyError:
+          pass
+
+        p = etree.parse(filename)
+        if p.getroot().tag == "testproblem":
+          prob_defn = p.findall("problem_definition")[0]
+          p_tags = p.findall("tags")
+          if len(p_tags) > 0 and not p_tags[0].text is None:
+            xml_tags = p_tags[0].text.split()
+          else:
+            xml_tags = []
+          info = {"length": prob_defn.attrib["length"],
+                  "nprocs": int(prob_defn.attrib["nprocs"]),
+                  "tags": xml_tags}
+        else:
+          info = None
+
+        self.index[filename] = {"mtime": stat.st_mtime, "size": stat.st_size, "info": info}
+        self.index_modified = True
+        return info
+
+    def add_tests(self, filenames):
+        '''Select the test problems in filenames, or this harness's shard of
+        them. The problems are only read in full if the tests are to be run or
+        cleaned, rather than just listed.'''
+        if not self.shard is None:
+          filenames = self.shard_files(filenames, *self.shard)
+        for filename in filenames:
+          self.test_files.append(filename)
+          if self.justlist:
+            continue
+          # need to grab nprocs here to pass through to modify_command_line
+          prob_nprocs = self.test_info(filename)["nprocs"]
+          testprob = regressiontest.TestProblem(filename=filename,
+                       verbose=self.verbose, replace=self.modify_command_line(prob_nprocs), genpbs=self.genpbs,
+                       env=self.env)
+          self.tests.append((os.path.dirname(filename), testprob))
+
+    def shard_files(self, filenames, index, count):
+        '''Return shard index (counting from 1) of count shards of filenames.
+        Each test is weighted by its expected run time times its number of
+        processes, and tests are dealt heaviest first to the shard with the
+        least weight so far, so that the shards use similar core time. The
+        split depends only on the files and the history as it was when this
+        harness started, so shards run separately partition the tests exactly
+        only if the history is frozen until all of them have started: start
+        the shards together, or give each a copy of the same history.'''
+        expected = [(-self.expected_duration(f) * max(self.test_info(f)["nprocs"], 1), self.file_key(f), f)
+                    for f in filenames]
+        loads = [0.0] * count
+        shards = [[] for i in range(count)]
+        for (duration, key, filename) in sorted(expected):
+          i = loads.index(min(loads))
+          loads[i] -= duration
+          shards[i].append(filename)
+        return sorted(shards[index - 1])
+
     def length_matches(self, filelength):
         if self.length == filelength: return True
         if self.length == "medium" and filelength == "short": return True
@@ -273,82 +374,440 @@ class TestHarness:
         if self.verbose == True:
             print str
 
+    def read_json(self, filename):
+      try:
+        f = open(filename, "r")
+        try:
+          return json.load(f)
+        finally:
+          f.close()
+      except (IOError, ValueError):
+        return {}
+
+    def write_json(self, filename, data):
+      try:
+        f = open(filename, "w")
+        try:
+          json.dump(data, f, indent=1, sort_keys=True)
+        finally:
+          f.close()
+      except IOError as e:
+        self.log("Warning: unable to write %s: %s" % (filename, e))
+
+    def file_key(self, filename):
+      '''The name under which the history of the test in filename is
+      recorded.'''
+      return os.path.relpath(filename, self.rootdir)
+
+    def test_key(self, dir, test):
+      return self.file_key(os.path.join(dir, test.filename))
+
+    # run times assumed for tests without a recorded history
+    default_durations = {"short": 30.0, "medium": 300.0, "long": 3600.0}
+
+    def expected_duration(self, filename):
+      duration = None
+      if not self.history is None:
+        duration = self.history.median(self.file_key(filename), "wall")
+      if duration is None:
+        duration = self.default_durations.get(self.test_info(filename)["length"], 300.0)
+      return duration
+
+    def test_cores(self, test):
+      '''The number of cores a test problem's simulation occupies on this
+      machine.'''
+      if self.genpbs:
+        return 1
+      return max(test.nprocs, 1)
+
     def clean(self):
       self.log(" ")
       for t in self.tests:
-        os.chdir(t[0])
-        t[1].clean()
+        t[1].clean(t[0])
 
       return
 
-    def run(self):
-        self.log(" ")
-        if not self.justtest:
-            threadlist=[]
-            self.threadtests=regressiontest.ThreadIterator(self.tests)
-            for i in range(options.thread_count):
-                threadlist.append(threading.Thread(target=self.threadrun)) 
-                threadlist[-1].start()
-            for t in threadlist:
-                '''Wait until all threads finish'''
-                t.join()
-
-            count = len(self.tests)
-            while True:
-                for t in self.tests:
-                  if t is None: continue
-                  test = t[1]
-                  os.chdir(t[0])
-                  if test.is_finished():
-                      if test.length == "long":
-                        test.fl_logs(nLogLines = 20)
-                      else:
-                        test.fl_logs(nLogLines = 0)
-                      try:
-                        self.teststatus += test.test()
-                      except:
-                        self.log("Error: %s raised an exception while testing:" % test.filename)
-                        lines = traceback.format_exception( sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2] )
-                        for line in lines:
-                            self.log(line)
-                        self.teststatus += ['F']
-                        test.pass_status = ['F']
-                      self.completed_tests += [test]
-                      self.xml_parser.test_cases+=test.xml_reports
-                      t = None
-                      count -= 1
-
-                if count == 0: break
-                time.sleep(60)                  
+    # bounds, in seconds, on the interval between checks for finished PBS jobs
+    min_poll_interval = 1.0
+    max_poll_interval = 16.0
+
+    def schedule(self, target, dir, test, completed, cores=1, first=False, timeout=None):
+        '''Queue a call to target(dir, test) in its own child process, using
+        cores cores. When it finishes, completed(dir, test, process) is called
+        in this process, where process.result() returns the value returned by
+        target. If it runs for more than timeout seconds, it is killed with
+        everything it started, and process.result() raises TestProcessTimeout.
+        Jobs are queued at the back, or the front if first is True.'''
+        job = (target, dir, test, completed, cores, timeout)
+        if first:
+            self.pending.insert(0, job)
         else:
-          for t in self.tests:
-            test = t[1]
-            os.chdir(t[0])
-            if self.length == "long":
-              test.fl_logs(nLogLines = 20)
+            self.pending.append(job)
+
+    def wait_for(self, dir, test):
+        '''Queue the pass and warn tests for a test problem, once its simulation
+        has finished.'''
+        self.waiting_tests.append((dir, test))
+
+    def run_scheduled(self):
+        '''Run the queued jobs, using at most thread_count cores at once. Jobs
+        are started in queue order, passing over any that do not fit in the
+        free cores, and a job needing more cores than thread_count is started
+        only when nothing else is running. Test problems waiting for their
+        simulations to finish are checked with a backoff between
+        min_poll_interval and max_poll_interval, and their tests queued at the
+        front as soon as they have.'''
+        running = []
+        try:
+            self.run_jobs(running)
+        except KeyboardInterrupt:
+            # the jobs are in their own process groups, so do not see the
+            # interrupt
+            for r in running:
+                r[0].terminate(grace=0.0)
+            raise
+
+    def run_jobs(self, running):
+        free = self.thread_count
+        interval = self.min_poll_interval
+        while len(self.pending) > 0 or len(running) > 0 or len(self.waiting_tests) > 0:
+            for job in list(self.pending):
+                (target, dir, test, completed, needed, timeout) = job
+                if needed > free and not (len(running) == 0 and free == self.thread_count):
+                    continue
+                self.pending.remove(job)
+                sys.stdout.flush()
+                process = regressiontest.TestProcess(target, (dir, test))
+                process.start()
+                if timeout is None:
+                    deadline = None
+                else:
+                    deadline = time.time() + timeout
+                running.append((process, job, deadline))
+                free -= needed
+                if free <= 0:
+                    break
+
+            waits = [r[2] - time.time() for r in running if not r[2] is None]
+            if len(self.waiting_tests) > 0:
+                waits.append(interval)
+            if len(waits) > 0:
+                wait = max(min(waits), 0.0)
+            else:
+                wait = None
+            if len(running) > 0:
+                ready = select.select([r[0] for r in running], [], [], wait)[0]
             else:
-              test.fl_logs(nLogLines = 0)
-            self.teststatus += test.test()
+                time.sleep(wait)
+                ready = []
+            now = time.time()
+            for r in list(running):
+                if not r[0] in ready:
+                    if r[2] is None or r[2] > now:
+                        continue
+                    r[0].terminate()
+                running.remove(r)
+                (target, dir, test, completed, needed, timeout) = r[1]
+                free += needed
+                completed(dir, test, r[0])
+
+            finished = [t for t in self.waiting_tests if t[1].is_finished()]
+            for t in finished:
+                self.waiting_tests.remove(t)
+                self.schedule(test_problem, t[0], t[1], self.test_completed, first=True)
+            if len(finished) > 0:
+                interval = self.min_poll_interval
+            elif len(ready) == 0:
+                interval = min(2 * interval, self.max_poll_interval)
+
+    def log_exception(self, message):
+        self.log(message)
+        lines = traceback.format_exception( sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2] )
+        for line in lines:
+            self.log(line)
+
+    # simulation time limits, in seconds, for each length of test, unless set
+    # by a timeout attribute on its problem_definition
+    default_timeouts = {"short": 600.0, "medium": 7200.0, "long": 86400.0}
+
+    def test_timeout(self, test):
+        '''The time after which a test problem's simulation is killed, or None.
+        Simulations run under valgrind or submitted with genpbs are not timed
+        out.'''
+        if self.valgrind or self.genpbs:
+            return None
+        if not test.timeout is None:
+            return test.timeout
+        return self.default_timeouts.get(test.length, None)
+
+    def run_completed(self, dir, test, process):
+        try:
+            (runtime, usage, test.xml_reports) = process.result()
+            if not self.genpbs:
+                test.usage = usage
+            if self.length=="short" and runtime>30.0:
+                self.log(("Warning: short test ran for %f seconds which"+
+                          " is longer than the permitted 30s run time")%runtime)
+                self.teststatus += ['W']
+                test.pass_status = ['W']
+            self.wait_for(dir, test)
+        except regressiontest.TestProcessTimeout as e:
+            self.log("Error: %s timed out: %s" % (test.filename, e))
+            self.teststatus += ['T']
+            test.pass_status = ['T']
+            self.completed_tests += [test]
+            (wall, cpu, maxrss) = process.usage
+            if not self.history is None:
+                self.history.record(self.test_key(dir, test), wall, cpu=cpu, maxrss=maxrss, status='T')
+            tc = regressiontest.TestCase(test.name, '%s.%s' % (test.length, test.filename[:-4]),
+                                         elapsed_sec=wall)
+            tc.add_failure_info("Timeout", str(e))
+            self.xml_parser.test_cases += [tc]
+        except:
+            self.log_exception("Error: %s raised an exception while running:" % test.filename)
+            self.teststatus += ['F']
+            test.pass_status = ['F']
             self.completed_tests += [test]
 
-            self.xml_parser.test_cases+=test.xml_reports
+    def test_completed(self, dir, test, process):
+        try:
+            (status, test.pass_status, test.warn_status, test.xml_reports) = process.result()
+            self.teststatus += status
+        except:
+            self.log_exception("Error: %s raised an exception while testing:" % test.filename)
+            self.teststatus += ['F']
+            test.pass_status = ['F']
+        self.completed_tests += [test]
+        self.xml_parser.test_cases+=test.xml_reports
+        self.record_usage(dir, test)
+        self.cache_result(dir, test)
+
+    def record_usage(self, dir, test):
+        '''Record the resources used by a test problem's simulation in the
+        history, after noting the medians of its previous runs for the
+        performance report.'''
+        usage = test.usage
+        if usage is None or self.history is None:
+            return
+        key = self.test_key(dir, test)
+        if self.perf_report:
+            previous = dict([(name, self.history.median(key, name)) for name in usage])
+            self.perf_results.append((key, usage, previous))
+        self.history.record(key, status=''.join(test.pass_status+test.warn_status), **usage)
+
+    def print_perf_report(self):
+        def Change(value, previous, unit, fmt):
+            if previous is None:
+                return (fmt + "%s (new)") % (value, unit)
+            return (fmt + "%s (median " + fmt + "%s)") % (value, unit, previous, unit)
+
+        print
+        print "Performance report (regressions are marked with *):"
+        regressions = 0
+        for (key, usage, previous) in sorted(self.perf_results):
+            regressed = False
+            for name in ["wall", "cpu", "maxrss"]:
+                if usage[name] is None or previous[name] is None:
+                    continue
+                # ignore changes in times of under a second
+                if usage[name] > self.perf_threshold * previous[name] and \
+                  (name == "maxrss" or usage[name] - previous[name] > 1.0):
+                    regressed = True
+            if regressed:
+                regressions += 1
+            line = "%s %s: wall %s, cpu %s, peak rss %s" % ("*" if regressed else " ", key,
+              Change(usage["wall"], previous["wall"], "s", "%.1f"),
+              Change(usage["cpu"], previous["cpu"], "s", "%.1f"),
+              Change(usage["maxrss"], previous["maxrss"], " kB", "%d"))
+            if not usage["timesteps"] is None:
+              line += ", %d timesteps" % usage["timesteps"]
+            print line
+        print "Performance regressions: %d" % regressions
+
+    # files in test directories which are treated as outputs, rather than
+    # inputs, where the inputs cannot be listed with git
+    output_patterns = ["*.vtu", "*.pvtu", "*.stat", "*.detectors", "*.detectors.dat",
+                       "*.dat", "*.convergence", "*.pbs", "*.pyc", "*checkpoint*",
+                       "fluidity.log*", "fluidity.err*", "*.log", "*.err"]
+
+    def hash_files(self, hasher, root, filenames):
+        for filename in sorted(filenames):
+          path = os.path.join(root, filename)
+          if not os.path.isfile(path):
+            continue
+          hasher.update(filename + "\0")
+          f = open(path, "rb")
+          try:
+            for chunk in iter(lambda: f.read(1 << 20), ""):
+              hasher.update(chunk)
+          finally:
+            f.close()
+
+    def test_inputs(self, dir):
+        '''Return the paths, relative to dir, of the input files of the test
+        problem in dir: those tracked by git, or otherwise all files not
+        matching output_patterns.'''
+        try:
+          output = subprocess.Popen(["git", "ls-files", "-z", "."], cwd=dir,
+                                    stdout=subprocess.PIPE, stderr=open(os.devnull, "w")).communicate()[0]
+          files = [f for f in output.split("\0") if len(f) > 0]
+          if len(files) > 0:
+            return files
+        except OSError:
+          pass
+
+        files = []
+        for (root, dirnames, filenames) in os.walk(dir):
+          for filename in filenames:
+            if not any(fnmatch.fnmatch(filename, pattern) for pattern in self.output_patterns):
+              files.append(os.path.relpath(os.path.join(root, filename), dir))
+        return files
+
+    def test_outputs(self, dir):
+        '''Return the paths, relative to dir, of the files in the test problem
+        directory dir that are not inputs.'''
+        inputs = set(self.test_inputs(dir))
+        files = []
+        for (root, dirnames, filenames) in os.walk(dir):
+          for filename in filenames:
+            path = os.path.relpath(os.path.join(root, filename), dir)
+            if not path in inputs:
+              files.append(path)
+        return sorted(files)
+
+    def cache_key(self, dir, test):
+        '''Return a hash of everything the results of a test problem depend on:
+        its input files and command line, the fluidity binaries and tools in
+        bin/, and the python/ tree.'''
+        if self.shared_hash is None:
+          hasher = hashlib.sha1()
+          for directory in ["bin", "python"]:
+            root = os.path.join(self.rootdir, directory)
+            files = []
+            for (walkroot, dirnames, filenames) in os.walk(root):
+              for filename in filenames:
+                if directory == "bin" or filename.endswith(".py"):
+                  files.append(os.path.relpath(os.path.join(walkroot, filename), self.rootdir))
+            self.hash_files(hasher, self.rootdir, files)
+          self.shared_hash = hasher.hexdigest()
+
+        hasher = hashlib.sha1(self.shared_hash)
+        hasher.update(test.command_line + "\0")
+        self.hash_files(hasher, dir, self.test_inputs(dir))
+        return hasher.hexdigest()
+
+    def cached(self, dir, test):
+        '''If the result cache holds the results of a test problem, record them
+        and return True. Otherwise, note the key under which its results will be
+        cached, if it is to be, and return False.'''
+        test.result_key = None
+        if self.cache_dir is None:
+          return False
+        for tag in self.no_cache_tags:
+          if tag in self.test_info(os.path.join(dir, test.filename))["tags"]:
+            return False
+
+        test.result_key = self.cache_key(dir, test)
+        result = self.read_json(os.path.join(self.cache_dir, test.result_key))
+        if len(result) == 0:
+          return False
+
+        # restore the outputs, so that the test directory is as if the test
+        # problem had been run
+        try:
+          archive = tarfile.open(os.path.join(self.cache_dir, test.result_key + ".tar"), "r")
+          try:
+            archive.extractall(dir)
+          finally:
+            archive.close()
+        except (IOError, OSError, tarfile.TarError) as e:
+          test.log("Unable to restore cached outputs, rerunning: %s" % e)
+          return False
+
+        test.pass_status = result["pass_status"]
+        test.warn_status = result["warn_status"]
+        test.log("Cached: " + ''.join(test.pass_status + test.warn_status))
+        self.teststatus += test.pass_status + test.warn_status
+        self.completed_tests += [test]
+        self.xml_parser.test_cases += [regressiontest.TestCase(test.name, '%s.%s' % (test.length, test.filename[:-4]),
+                                                               elapsed_sec=result.get("elapsed", None))]
+        return True
+
+    def cache_result(self, dir, test):
+        '''Store the results of a test problem, its output files and the run
+        time of its simulation in the result cache. Results with failures are
+        not cached, so that failing tests are always rerun.'''
+        if test.result_key is None or 'F' in test.pass_status:
+          return
+        # the archive is written before the results, so that results are only
+        # found with a complete archive
+        filename = os.path.join(self.cache_dir, test.result_key + ".tar")
+        try:
+          archive = tarfile.open(filename + ".tmp", "w")
+          try:
+            for path in self.test_outputs(dir):
+              archive.add(os.path.join(dir, path), arcname=path)
+          finally:
+            archive.close()
+          os.rename(filename + ".tmp", filename)
+        except (IOError, OSError, tarfile.TarError) as e:
+          self.log("Warning: unable to archive the outputs of %s: %s" % (test.filename, e))
+          return
+        if test.usage is None:
+          elapsed = None
+        else:
+          elapsed = test.usage["wall"]
+        self.write_json(os.path.join(self.cache_dir, test.result_key),
+                        {"test": self.test_key(dir, test),
+                         "pass_status": test.pass_status,
+                         "warn_status": test.warn_status,
+                         "elapsed": elapsed})
+
+    def run(self):
+        self.log(" ")
+        self.pending = []
+        self.waiting_tests = []
+        if not self.justtest:
+            if not self.cache_dir is None and not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # longest expected run time first, to minimise the total time. The
+            # tests of each problem are run as soon as its simulation finishes.
+            tests = sorted(self.tests, key=lambda t: self.expected_duration(os.path.join(t[0], t[1].filename)), reverse=True)
+            for (dir, test) in tests:
+                if self.cached(dir, test):
+                    continue
+                self.schedule(run_problem, dir, test, self.run_completed, cores=self.test_cores(test),
+                              timeout=self.test_timeout(test))
+            self.run_scheduled()
+        else:
+          for (dir, test) in self.tests:
+            self.schedule(test_problem, dir, test, self.test_completed)
+          self.run_scheduled()
 
         self.passcount = self.teststatus.count('P')
         self.failcount = self.teststatus.count('F')
         self.warncount = self.teststatus.count('W')
+        self.timeoutcount = self.teststatus.count('T')
         
-        if self.failcount + self.warncount > 0:
+        if self.failcount + self.warncount + self.timeoutcount > 0:
             print
-            print "Summary of test problems with failures or warnings:"
+            print "Summary of test problems with failures, warnings or timeouts:"
             for t in self.completed_tests:
-                if t.pass_status.count('F')+t.warn_status.count('W')>0:
+                if t.pass_status.count('F')+t.pass_status.count('T')+t.warn_status.count('W')>0:
                     print t.filename+':', ''.join(t.pass_status+t.warn_status)
             print
         
-        if self.passcount + self.failcount + self.warncount > 0:
+        if self.passcount + self.failcount + self.warncount + self.timeoutcount > 0:
             print "Passes:   %d" % self.passcount
             print "Failures: %d" % self.failcount
             print "Warnings: %d" % self.warncount
+            print "Timeouts: %d" % self.timeoutcount
+
+        if self.perf_report:
+            self.print_perf_report()
+
+        if not self.history is None:
+            self.history.close()
 
         if self.xml_outfile!="":
             fd=open(self.cwd+'/'+self.xml_outfile,'w')
@@ -356,37 +815,154 @@ class TestHarness:
             fd.close()
 
         if self.exit_fails:
-            sys.exit(self.failcount)
+            sys.exit(self.failcount + self.timeoutcount)
 
           
 
-    def threadrun(self):
-        '''This is the portion of the loop which actually runs the
-        tests. This is split out so that it can be threaded'''
-        
-        for (dir, test) in self.threadtests:
-            try:
-                runtime=test.run(dir)
-                if self.length=="short" and runtime>30.0:
-                    self.log("Warning: short test ran for %f seconds which"+
-                             " is longer than the permitted 30s run time"%runtime)
-                    self.teststatus += ['W']
-                    test.pass_status = ['W']
-                    
-            except:
-                self.log("Error: %s raised an exception while running:" % test.filename)
-                lines = traceback.format_exception( sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2] )
-                for line in lines:
-                    self.log(line)
-                self.tests.remove((dir, test))
-                self.teststatus += ['F']
-                test.pass_status = ['F']
-                self.completed_tests += [test]
-
     def list(self):
-      for (subdir, test) in self.tests:
-        print os.path.join(subdir, test.filename)
+      for filename in self.test_files:
+        print filename
+
+def run_problem(dir, test):
+    '''Run the simulation for a test problem. Called in a child process of
+    the harness, and returns the run time, the resources used and the junit
+    reports.'''
+    start = time.time()
+    runtime = test.run(dir)
+    wall = time.time() - start
+    # this process is forked for the one test, so the usage of its children
+    # is that of the simulation
+    (cpu, maxrss) = regressiontest.child_usage()
+    usage = {"wall": wall, "cpu": cpu, "maxrss": maxrss,
+             "timesteps": test.fl_timesteps(dir)}
+    return (runtime, usage, test.xml_reports)
+
+def test_problem(dir, test):
+    '''Run the pass and warn tests for a test problem. Called in a child process
+    of the harness, so that changing directory and the import path does not
+    affect other tests.'''
+    os.chdir(dir)
+    sys.path.insert(0, dir)
+    if test.length == "long":
+      test.fl_logs(nLogLines = 20)
+    else:
+      test.fl_logs(nLogLines = 0)
+    status = test.test()
+    return (status, test.pass_status, test.warn_status, test.xml_reports)
+
+
+class testharnessUnittests(unittest.TestCase):
+    class Harness(TestHarness):
+      # a harness over the test problems in rootdir, without searching for
+      # tests, that is its own history of the durations given
+      def __init__(self, rootdir, durations={}):
+        self.rootdir = rootdir
+        self.history = self
+        self.durations = durations
+        self.index = {}
+        self.index_modified = False
+        self.shared_hash = None
+        self.verbose = False
+
+      def median(self, test, key, count=5):
+        return self.durations.get(test, None)
+
+    class Problem:
+      def __init__(self, command_line):
+        self.command_line = command_line
+
+    def setUp(self):
+      self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+      shutil.rmtree(self.dir)
 
+    def write_problem(self, name, length="short", nprocs=1, tags=""):
+      filename = os.path.join(self.dir, name + ".xml")
+      f = open(filename, "w")
+      f.write('<testproblem><name>%s</name><tags>%s</tags>'
+              '<problem_definition length="%s" nprocs="%d"/></testproblem>\n' % (name, tags, length, nprocs))
+      f.close()
+      return filename
+
+    def testShardFiles(self):
+      durations = {}
+      filenames = []
+      for i in range(20):
+        filename = self.write_problem("test%d" % i, nprocs=1 + i % 3)
+        durations["test%d.xml" % i] = 10.0 * (i % 7 + 1)
+        filenames.append(filename)
+      # a test without a history is weighted by its length
+      filenames.append(self.write_problem("long", length="long"))
+      harness = self.Harness(self.dir, durations)
+
+      def weight(filename):
+        return harness.expected_duration(filename) * harness.test_info(filename)["nprocs"]
+
+      for count in [1, 2, 3, 7]:
+        shards = [harness.shard_files(filenames, i, count) for i in range(1, count + 1)]
+        # the shards partition the tests
+        self.assertEquals(sorted(sum(shards, [])), sorted(filenames))
+        # and are independent of the order the tests are given in
+        self.assertEquals(shards, [harness.shard_files(list(reversed(filenames)), i, count)
+                                   for i in range(1, count + 1)])
+        # and of the harness
+        other = self.Harness(self.dir, durations)
+        self.assertEquals(shards, [other.shard_files(filenames, i, count)
+                                   for i in range(1, count + 1)])
+
+      # the long test is in a shard of its own, and the other shards are
+      # balanced to within the heaviest of the other tests
+      shards = [harness.shard_files(filenames, i, 3) for i in range(1, 4)]
+      loads = sorted([sum(weight(f) for f in shard) for shard in shards])
+      self.assertTrue(filenames[-1] in shards[0])
+      self.assertEquals(len(shards[0]), 1)
+      self.assertTrue(loads[1] - loads[0] <= max(weight(f) for f in filenames[:-1]))
+
+    def testTestInfoIndex(self):
+      filename = self.write_problem("test", tags="a b")
+      harness = self.Harness(self.dir)
+      self.assertEquals(harness.test_info(filename), {"length": "short", "nprocs": 1, "tags": ["a", "b"]})
+      self.assertTrue(harness.index_modified)
+
+      # unchanged files are not reread
+      harness.index_modified = False
+      harness.index[filename]["info"]["tags"] = ["cached"]
+      self.assertEquals(harness.test_info(filename)["tags"], ["cached"])
+      self.assertFalse(harness.index_modified)
+
+      # a change of modification time alone
+      stat = os.stat(filename)
+      os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+      self.assertEquals(harness.test_info(filename)["tags"], ["a", "b"])
+      self.assertTrue(harness.index_modified)
+
+      # a change of size alone
+      harness.index[filename]["info"]["tags"] = ["cached"]
+      self.write_problem("test", nprocs=10, tags="a b")
+      os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+      self.assertEquals(harness.test_info(filename)["nprocs"], 10)
+      self.assertEquals(harness.test_info(filename)["tags"], ["a", "b"])
+
+    def testCacheKey(self):
+      problem = os.path.join(self.dir, "problem")
+      os.mkdir(problem)
+      harness = self.Harness(self.dir)
+      test = self.Problem("fluidity test.flml")
+      f = open(os.path.join(problem, "test.flml"), "w")
+      f.write("<fluidity_options/>\n")
+      f.close()
+      key = harness.cache_key(problem, test)
+      self.assertEquals(harness.cache_key(problem, test), key)
+      self.assertNotEquals(harness.cache_key(problem, self.Problem("fluidity -v2 test.flml")), key)
+
+      # outputs do not change the key, inputs do
+      open(os.path.join(problem, "test.stat"), "w").close()
+      self.assertEquals(harness.cache_key(problem, test), key)
+      f = open(os.path.join(problem, "test.flml"), "a")
+      f.write("\n")
+      f.close()
+      self.assertNotEquals(harness.cache_key(problem, test), key)
 
 if __name__ == "__main__":
     import optparse
@@ -401,7 +977,19 @@ if __name__ == "__main__":
     parser.add_option("--from-file", dest="from_file", default=None,
                       help="run tests listed in FROM_FILE (one test per line)")
     parser.add_option("-n", "--threads", dest="thread_count", type="int",
-                      help="number of tests to run at the same time", default=1)
+                      help="number of cores to use: tests are run at the same time, each in its own process, while their nprocs fit", default=1)
+    parser.add_option("--history", dest="history_file", default=None,
+                      help="database in which the resources used by each test run are recorded (default=.testharness_history in the source tree)")
+    parser.add_option("--perf-report", action="store_true", dest="perf_report", default=False,
+                      help="report the resources used by each test, and flag regressions against previous runs")
+    parser.add_option("--perf-threshold", dest="perf_threshold", type="float", default=1.5,
+                      help="ratio to the median of previous runs above which --perf-report flags a regression (default=1.5)")
+    parser.add_option("--shard", dest="shard", default=None,
+                      help="run only shard I of N (as I/N) of the selected tests, balanced by expected core time; shards run separately must start from the same --history, so start them together or give each a copy")
+    parser.add_option("--cache", dest="cache_dir", default=None,
+                      help="reuse the results of tests whose inputs, command line, binaries and python are unchanged, cached in CACHE_DIR")
+    parser.add_option("--no-cache-for", dest="no_cache_tags", default=[], action="append",
+                      help="always run tests with this tag, even with --cache")
     parser.add_option("-v", "--valgrind", action="store_true", dest="valgrind")
     parser.add_option("-c", "--clean", action="store_true", dest="clean", default = False)
     parser.add_option("--just-test", action="store_true", dest="justtest", default=False)
@@ -415,16 +1003,25 @@ if __name__ == "__main__":
 
     if options.parallel not in ['serial', 'parallel', 'any']:
       parser.error("Specify parallelism as either serial, parallel or any.")
+
+    if options.shard is None:
+      shard = None
+    else:
+      try:
+        shard = tuple(int(x) for x in options.shard.split("/"))
+        assert len(shard) == 2 and 1 <= shard[0] <= shard[1]
+      except (ValueError, AssertionError):
+        parser.error("Specify the shard as I/N, with 1 <= I <= N.")
     
     os.environ["PATH"] = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..", "bin")) + ":" + os.environ["PATH"]
     try:
       os.environ["PYTHONPATH"] = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..", "python")) + ":" + os.environ["PYTHONPATH"]
     except KeyError:
-      os.putenv("PYTHONPATH", os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..", "python")))
+      os.environ["PYTHONPATH"] = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..", "python"))
     try:
       os.environ["LD_LIBRARY_PATH"] = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..", "lib")) + ":" + os.environ["LD_LIBRARY_PATH"]
     except KeyError:
-      os.putenv("LD_LIBRARY_PATH", os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..", "lib")))
+      os.environ["LD_LIBRARY_PATH"] = os.path.abspath(os.path.join(os.path.dirname(sys.argv[0]), "..", "lib"))
 
     try:
         os.mkdir(os.environ["HOME"] + os.sep + "lock")
@@ -449,7 +1046,15 @@ if __name__ == "__main__":
                               from_file=options.from_file,
                               genpbs=options.genpbs,
                               exit_fails=options.exit_fails,
-                              xml_outfile=options.xml_outfile)
+                              xml_outfile=options.xml_outfile,
+                              thread_count=options.thread_count,
+                              history_file=options.history_file,
+                              perf_report=options.perf_report,
+                              perf_threshold=options.perf_threshold,
+                              justlist=options.justlist,
+                              shard=shard,
+                              cache_dir=options.cache_dir,
+                              no_cache_tags=options.no_cache_tags)
 
     if options.justlist:
       testharness.list()
@@ -3,6 +3,10 @@
 import os
 import os.path
 import glob
+import json
+import subprocess
+import tempfile
+import time
 
 class UnitTest:
     def __init__(self, exe):
@@ -15,19 +19,25 @@ class UnitTest:
         if self.verbose and msg != '':
             print "    %s: %s" % (self.exe.split('/')[-1], msg)
 
-    def run(self):
-        os.chdir(self.dir)
-#        self.log("chdir " + self.dir)
+    def start(self):
+        """Start the test in its own directory, with its output captured."""
         self.log("Running")
-        f = os.popen(self.exe)
-        self.output = f.read()
-        os.chdir(self.cwd)
-        
-        exitStatus = f.close()
-        if exitStatus is None:
-          return 0
-        else:
-          return exitStatus
+        self.outfile = tempfile.TemporaryFile()
+        self.started = time.time()
+        self.process = subprocess.Popen(self.exe, shell=True, cwd=self.dir, stdout=self.outfile)
+
+    def finish(self, exitStatus):
+        """Record the exit status and output of the test, once it has exited."""
+        self.runtime = time.time() - self.started
+        self.process.returncode = exitStatus
+        self.outfile.seek(0)
+        self.output = self.outfile.read()
+        self.outfile.close()
+        return exitStatus
+
+    def run(self):
+        self.start()
+        return self.finish(self.process.wait())
 
     def parse(self):
         passcount = 0
@@ -43,9 +53,18 @@ class UnitTest:
 
         return (passcount, warncount, failcount)
 
+def exit_status(status):
+    """Convert a status from os.wait to a return code as for subprocess."""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
 class UnitTestHarness:
-    def __init__(self, dir):
+    def __init__(self, dir, jobs=1):
         self.tests = []
+        self.jobs = jobs
+        # runtimes of each test, used to run the slowest first
+        self.durations_file = os.path.join(dir, ".unittestharness_durations")
         if dir[-1] == '/': dir = dir + "*"
         else: dir = dir + "/*"
 
@@ -54,6 +73,32 @@ class UnitTestHarness:
             if not os.path.isdir(file):
                 self.tests.append(UnitTest(file))
 
+        try:
+            f = open(self.durations_file, "r")
+            try:
+                self.durations = json.load(f)
+            finally:
+                f.close()
+        except (IOError, ValueError):
+            self.durations = {}
+
+    def run_tests(self):
+        """Run the tests, up to jobs at once, slowest first, with tests without
+        a recorded runtime treated as slowest. Yields (test, exit status) as
+        each test finishes."""
+        pending = sorted(self.tests, key=lambda test: -self.durations.get(test.exe, float("inf")))
+        running = {}
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < self.jobs:
+                test = pending.pop(0)
+                test.start()
+                running[test.process.pid] = test
+            (pid, status) = os.wait()
+            if not pid in running:
+                continue
+            test = running.pop(pid)
+            yield (test, test.finish(exit_status(status)))
+
     def run(self):
         passcount = 0
         warncount = 0
@@ -62,8 +107,8 @@ class UnitTestHarness:
         warntests = []
         failtests = []
 
-        for test in self.tests:
-            exitStatus = test.run()
+        for (test, exitStatus) in self.run_tests():
+            self.durations[test.exe] = test.runtime
             
             (P, W, F) = test.parse()
 
@@ -88,6 +133,15 @@ class UnitTestHarness:
             warncount += W
             failcount += F
 
+        try:
+            f = open(self.durations_file, "w")
+            try:
+                json.dump(self.durations, f, indent=1, sort_keys=True)
+            finally:
+                f.close()
+        except IOError:
+            pass
+
         print "RESULTS"
         print "    Passes:   %d" % passcount
         if len(warntests) == 0:
@@ -100,7 +154,16 @@ class UnitTestHarness:
             print "    Failures: %d; tests = %s" % (failcount, failtests)
 
 if __name__ == "__main__":
-    import sys
+    import optparse
+
+    parser = optparse.OptionParser(usage="%prog [options] DIRECTORY")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+                      help="number of unit tests to run at the same time (default=1)")
+    parser.add_option("--electricfence", action="store_true", dest="electricfence", default=False)
+    (options, args) = parser.parse_args()
+
+    if len(args) == 0: parser.error("Directory must be specified.")
+    if options.jobs < 1: parser.error("Number of jobs must be at least one.")
 
     try:
         os.environ["PYTHONPATH"] = os.path.abspath(os.path.join(os.getcwd(), "python")) + ":" + os.environ["PYTHONPATH"]
@@ -108,13 +171,13 @@ if __name__ == "__main__":
         os.putenv("PYTHONPATH", os.path.abspath(os.path.join(os.getcwd(), "python")))
 
     try:
-        os.environ["LD_LIBRARY_PATH"] = os.getcwd() + os.sep + sys.argv[1] + os.sep + "lib:" + os.environ["LD_LIBRARY_PATH"]
+        os.environ["LD_LIBRARY_PATH"] = os.getcwd() + os.sep + args[0] + os.sep + "lib:" + os.environ["LD_LIBRARY_PATH"]
     except KeyError:
-        os.putenv("LD_LIBRARY_PATH", os.getcwd() + os.sep + sys.argv[1] + os.sep + "lib")
+        os.putenv("LD_LIBRARY_PATH", os.getcwd() + os.sep + args[0] + os.sep + "lib")
 
-    if "--electricfence" in sys.argv:
+    if options.electricfence:
       os.putenv("LD_PRELOAD", "/usr/lib/libefence.so.0.0")
       #os.putenv("EF_DISABLE_BANNER", "1")
 
-    TestHarness = UnitTestHarness(sys.argv[-1])
+    TestHarness = UnitTestHarness(args[-1], jobs=options.jobs)
     TestHarness.run()